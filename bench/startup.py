@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""Time modular.py builds that have little or nothing to do.
+
+A small project of three static libraries and a program linked with them
+is generated in a temporary directory and built once. Then each of these
+builds is timed, as the wall time of the whole modular.py process:
+
+    snapshot   nothing has changed, so the build snapshot is up to date
+    touched    a source's mtime has changed, so with -j2 every command is
+               checked, but none are run as the file's contents are the same
+    server     the same build done by a build server started for it
+    changed    a source's contents have changed, so with -j2 its compile
+               and the archive and link after it are run
+
+The time from start to the first command run is reported for a changed
+source too, as -D prints it: from modular.py's start, and from when the
+server was asked for the build.
+
+The project is the same for the same arguments, so runs can be compared:
+
+    python bench/startup.py
+    git archive REV | tar -x -C /tmp/old
+    python bench/startup.py --modular /tmp/old/modular.py
+
+modular.py's own fabricate.py and rules are used. Python 2.7, gcc, best
+of 10 on one machine, in ms:
+
+                                   snapshot touched server changed   first
+    before the lazy imports (1396242^):  98     207    224     202       -
+    pool started by the first job (24eb11c):
+                                         34     117     62     195  83 / 13
+    pool started before the threads:     40     213    156     215  93 / 24
+    pool started when a command runs:    32     107     52     183  73 / 14
+
+1396242^ doesn't print when its first command runs. Otherwise the first
+figure of "first" is the changed build's, the second that of the same
+build done by a server. Forking the pool from a thread can leave a lock
+held in its workers, so it's started on the main thread before the
+builder's threads. Started whether or not a command needs running, it
+cost even builds with nothing to do the wait at exit for its worker
+handler thread, which polls every 0.1s. It's now started, with the
+threads, only once the main thread finds a command to run.
+
+"""
+
+import optparse
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+MODULES = {
+    'app': ("cc_binary(name='app', sources=['main.c'], deps=['/libb', '/libc'])\n",
+            {'main.c': '#include <stdio.h>\n'
+                       'int b1(void); int a2(void);\n'
+                       'int main(){printf("%d\\n", b1()+a2());return 0;}\n'}),
+    'liba': ("cc_library(name='liba', sources=['a1.c', 'a2.c'], static=True)\n",
+             {'a1.c': 'int a1(void){return 2;}\n',
+              'a2.c': 'int a2(void){return 2;}\n'}),
+    'libb': ("cc_library(name='libb', sources=['b1.c'], static=True, deps=['/liba'])\n",
+             {'b1.c': 'int a1(void); int b1(void){return a1()+1;}\n'}),
+    'libc': ("cc_library(name='libc', sources=['c1.c'], static=True)\n",
+             {'c1.c': 'int c1(void){return 0;}\n'}),
+}
+
+def write_project(root):
+    """ Write the project's MODULAR, MODULE and source files under root,
+        dated a minute ago. A build doesn't save a snapshot if a source
+        changed less than the coarsest mtime resolution before it began. """
+    paths = [os.path.join(root, 'MODULAR')]
+    open(paths[0], 'w').close()
+    for name, (module, sources) in MODULES.items():
+        os.mkdir(os.path.join(root, name))
+        files = [('MODULE', module)] + sources.items()
+        for filename, text in files:
+            paths.append(os.path.join(root, name, filename))
+            with open(paths[-1], 'w') as f:
+                f.write(text)
+    t = time.time() - 60
+    for path in paths:
+        os.utime(path, (t, t))
+
+FIRST_COMMAND = re.compile(r'^DEBUG: first command ([0-9.]+)s after start$',
+                           re.MULTILINE)
+
+def run(modular, *args):
+    """ Run modular.py with args, returning the seconds it took. """
+    start = time.time()
+    subprocess.check_call([sys.executable, modular] + list(args),
+                          stdout=open(os.devnull, 'w'))
+    return time.time() - start
+
+def run_debug(modular, *args):
+    """ Run modular.py -D with args, returning the seconds it took and the
+        seconds after its start it ran its first command, or None if it
+        didn't say. """
+    start = time.time()
+    process = subprocess.Popen([sys.executable, modular, '-D'] + list(args),
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    seconds = time.time() - start
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, modular)
+    match = FIRST_COMMAND.search(output)
+    return seconds, match and float(match.group(1))
+
+def touch(root):
+    """ Change a source's mtime but not its contents. """
+    path = os.path.join(root, 'liba', 'a1.c')
+    t = time.time()
+    os.utime(path, (t, t))
+
+def change(root):
+    """ Change a source's contents, to one of two versions in turn. """
+    path = os.path.join(root, 'liba', 'a2.c')
+    with open(path) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        if 'return 2' in text:
+            f.write(text.replace('return 2', 'return 3'))
+        else:
+            f.write(text.replace('return 3', 'return 2'))
+
+def time_touched(modular, root):
+    touch(root)
+    return run(modular, '/app:app', '-j2')
+
+def time_changed(modular, root):
+    change(root)
+    return run_debug(modular, '/app:app', '-j2')
+
+def best(results):
+    """ Return the shortest seconds of (seconds, first) results, and the
+        shortest first, or None if there are none. """
+    firsts = [first for seconds, first in results if first is not None]
+    return (min(seconds for seconds, first in results),
+            firsts and min(firsts) or None)
+
+def start_server(modular):
+    """ Start a build server and return it once it's listening. """
+    server = subprocess.Popen([sys.executable, modular, '--server'],
+                              stdout=open(os.devnull, 'w'))
+    socket_name = os.path.join('out', '.server')
+    for i in range(100):
+        if os.path.exists(socket_name):
+            return server
+        if server.poll() is not None:
+            break
+        time.sleep(0.05)
+    server.kill()
+    server.wait()
+    return None
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--modular', metavar='FILE',
+                      help='time the modular.py FILE rather than this one')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='report the best of REPEAT builds')
+    options, args = parser.parse_args()
+    if options.modular:
+        modular = os.path.abspath(options.modular)
+    else:
+        modular = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir, 'modular.py')
+        modular = os.path.normpath(modular)
+    cache_dir = tempfile.mkdtemp()
+    root = tempfile.mkdtemp()
+    # an empty build cache of its own, so the first build runs every command
+    os.environ['FABRICATE_CACHE_DIR'] = cache_dir
+    try:
+        write_project(root)
+        os.chdir(root)
+        # the first build saves the snapshot the next ones use
+        run(modular, '/app:app', '-j2')
+        results = []
+        results.append(('snapshot', min(run(modular, '/app:app')
+                                        for i in range(options.repeat))))
+        results.append(('touched', min(time_touched(modular, root)
+                                       for i in range(options.repeat))))
+        changed = best([time_changed(modular, root)
+                        for i in range(options.repeat)])
+        server = start_server(modular)
+        if server is not None:
+            try:
+                results.append(('server', min(time_touched(modular, root)
+                                              for i in range(options.repeat))))
+                served = best([time_changed(modular, root)
+                               for i in range(options.repeat)])
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+        results.append(('changed', changed[0]))
+        firsts = [changed[1]]
+        if server is not None:
+            firsts.append(served[1])
+    finally:
+        os.chdir(os.path.dirname(root))
+        shutil.rmtree(root)
+        shutil.rmtree(cache_dir)
+    print '%s, best of %d:' % (modular, options.repeat)
+    for name, seconds in results:
+        print '  %-9s %4dms' % (name, seconds * 1000)
+    print '  %-9s %s' % ('first', ' / '.join(
+        first is None and '-' or '%dms' % (first * 1000) for first in firsts))
+
+if __name__ == '__main__':
+    main()
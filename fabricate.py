@@ -18,6 +18,12 @@ To get help on fabricate functions:
     from fabricate import *
     help(function)
 
+Upgrading from fabricate 1.26: JSON dependency files are now written as
+version 3, which lists each filename and hash once. Version 2 files are read
+and converted on the next save, but older fabricates can't read version 3
+files and will rebuild everything. The sqlite dependency store and the
+shared hash cache are only used if asked for, see Builder().
+
 """
 
 from __future__ import with_statement
@@ -26,35 +32,47 @@ from __future__ import with_statement
 __version__ = '1.26'
 
 # if version of .deps file has changed, we know to not use it
-deps_version = 2
+deps_version = 3
 
 import atexit
-import optparse
+import errno
 import os
 import platform
+import Queue
 import re
 import shlex
+import shutil
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
 import time
 import threading # NB uses old camelCase names for backward compatibility
-# multiprocessing module only exists on Python >= 2.6
-try:
-    import multiprocessing
-except ImportError:
-    class MultiprocessingModule(object):
-        def __getattr__(self, name):
-            raise NotImplementedError("multiprocessing module not available, can't do parallel builds")
-    multiprocessing = MultiprocessingModule()
+
+# when the program started, for the debug timing of its first command. This
+# is when fabricate was imported unless the program sets it earlier.
+start_time = time.time()
+
+def _multiprocessing():
+    """ Return the multiprocessing module, imported only for parallel builds
+        as it's one of the slowest modules to import. """
+    # multiprocessing module only exists on Python >= 2.6
+    try:
+        import multiprocessing
+    except ImportError:
+        raise NotImplementedError("multiprocessing module not available, can't do parallel builds")
+    return multiprocessing
 
 # so you can do "from fabricate import *" to simplify your build script
 __all__ = ['setup', 'run', 'autoclean', 'main', 'shell', 'fabricate_version',
            'memoize', 'outofdate', 'parse_options', 'after',
            'ExecutionError', 'md5_hasher', 'mtime_hasher',
+           'blake2_hasher', 'xxhash_hasher',
            'Runner', 'AtimesRunner', 'StraceRunner', 'AlwaysRunner',
-           'SmartRunner', 'Builder']
+           'PreloadRunner', 'DepfileRunner', 'SmartRunner', 'Builder',
+           'BuildCache', 'DirectoryBuildCache', 'HttpBuildCache',
+           'build_cache', 'reflink', 'HashCache', 'cache_dir', 'cached_probe']
 
 import textwrap
 
@@ -85,6 +103,19 @@ except ImportError:
     import md5
     md5func = md5.new
 
+# Faster digests for blake2_hasher and xxhash_hasher, if available
+try:
+    blake2func = hashlib.blake2b
+except (NameError, AttributeError):
+    try:
+        from pyblake2 import blake2b as blake2func
+    except ImportError:
+        blake2func = None
+try:
+    from xxhash import xxh64 as xxhashfunc
+except ImportError:
+    xxhashfunc = None
+
 # Use json, or pickle on older Python versions if simplejson not installed
 try:
     import json
@@ -97,10 +128,44 @@ except ImportError:
         class PickleJson:
             def load(self, f):
                 return cPickle.load(f)
-            def dump(self, obj, f, indent=None, sort_keys=None):
+            def dump(self, obj, f, indent=None, sort_keys=None, separators=None):
                 return cPickle.dump(obj, f)
+            def loads(self, data):
+                return cPickle.loads(data)
+            def dumps(self, obj, sort_keys=None):
+                return cPickle.dumps(obj)
         json = PickleJson()
 
+# sqlite3 module only exists on Python >= 2.5 and is optional in some builds
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# scandir gives directory entries' types without a stat() each, if available:
+# it's os.scandir from Python 3.5, but on Python 2 it's the optional scandir
+# package (pip install scandir), without which AtimesRunner stats each entry
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# ctypes is used for inotify on Linux, if available
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# fcntl is used to reflink files on Unix, if available
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 def printerr(message):
     """ Print given message to stderr with a line feed. """
     print >>sys.stderr, message
@@ -205,17 +270,45 @@ def md5_hasher(filename):
         Windows so symlinks without a hashable target fall back to
         a hash of the filename if the symlink target is a directory, 
         or None if the symlink is broken"""
+    return _hash_file(filename, md5func)
+
+def blake2_hasher(filename):
+    """ Return BLAKE2b hash of given filename, as for md5_hasher. BLAKE2b
+        is faster than MD5 but needs Python 3.6 or the pyblake2 module. """
+    if blake2func is None:
+        raise NotImplementedError("blake2_hasher needs Python 3.6 or the pyblake2 module")
+    return _hash_file(filename, blake2func)
+
+def xxhash_hasher(filename):
+    """ Return 64 bit xxHash of given filename, as for md5_hasher. xxHash is
+        a much faster non-cryptographic hash but needs the xxhash module. """
+    if xxhashfunc is None:
+        raise NotImplementedError("xxhash_hasher needs the xxhash module")
+    return _hash_file(filename, xxhashfunc)
+
+# size of the reads used to hash files, so large files aren't read in whole
+hash_chunk_size = 64*1024
+
+def _hash_file(filename, hashfunc):
+    """ Helper function for the content hashers. Return the hexdigest of
+        the hashfunc hash of filename's contents, read in chunks, or of its
+        symlink target or filename as described for md5_hasher. """
     try:
         f = open(filename, 'rb')
         try:
-            return md5func(f.read()).hexdigest()
+            h = hashfunc()
+            chunk = f.read(hash_chunk_size)
+            while chunk:
+                h.update(chunk)
+                chunk = f.read(hash_chunk_size)
+            return h.hexdigest()
         finally:
             f.close()
     except IOError:
         if hasattr(os, 'readlink') and os.path.islink(filename):
-            return md5func(os.readlink(filename)).hexdigest()
+            return hashfunc(os.readlink(filename)).hexdigest()
         elif os.path.isdir(filename):
-            return md5func(filename).hexdigest()
+            return hashfunc(filename).hexdigest()
         return None
 
 def mtime_hasher(filename):
@@ -226,6 +319,905 @@ def mtime_hasher(filename):
     except (IOError, OSError):
         return None
 
+def stat_signature(st):
+    """ Return a string of the size, modification time and inode number in
+        the given os.stat() result, which changes when the file does. """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return '%d %d %d' % (st.st_size, mtime_ns, st.st_ino)
+
+class DepsStore(object):
+    """ Base class for the stores of dependency data, which map command line
+        strings to a dict of {filename: "input-hash" or "output-hash"} for
+        each dependency and output of the command. Stores are created with
+        the name of the dependency file, read it as needed, and write it back
+        when save() is called. Filenames and hashes are interned, so each
+        is held once however many commands it is an entry of.
+
+        Stores also keep the stat_signature() of files when they were last
+        hashed, so a file can be assumed unchanged while that still matches.
+
+        "hasher" is the name of the hasher that made the hashes. Stores
+        record it, and start again empty if a file was made by another. """
+    def __init__(self, filename, hasher=None):
+        self.filename = os.path.abspath(filename)
+        self.hasher = hasher
+        self._strings = {}
+
+    def other_hasher(self, hasher):
+        """ Return True, after saying so, if given hasher name isn't the
+            hasher of this store. """
+        if self.hasher is None or hasher == self.hasher:
+            return False
+        printerr('%s dependency file was made with %s! Rebuilding.'
+                 % (os.path.basename(self.filename), hasher))
+        return True
+
+    def intern(self, string):
+        """ Return the stored copy of string, storing it if it's new. """
+        return self._strings.setdefault(string, string)
+
+    def intern_deps(self, deps):
+        """ Return a copy of the deps dict with its strings interned. """
+        intern = self.intern
+        return dict((intern(name), intern(hashed))
+                    for name, hashed in deps.iteritems())
+
+    def get(self, command, default=None):
+        """ Return the dict of dependencies of command, or default. """
+        raise NotImplementedError("DepsStore subclass didn't define get")
+
+    def __setitem__(self, command, deps):
+        raise NotImplementedError("DepsStore subclass didn't define __setitem__")
+
+    def items(self):
+        """ Return a list of (command, deps) for every command stored. """
+        raise NotImplementedError("DepsStore subclass didn't define items")
+
+    def names(self):
+        """ Return a list of every filename in the stored entries. """
+        names = set()
+        for command, deps in self.items():
+            names.update(deps)
+        return list(names)
+
+    def get_stat(self, name):
+        """ Return (stat signature, hash) of filename when it was last
+            hashed, or None. """
+        raise NotImplementedError("DepsStore subclass didn't define get_stat")
+
+    def set_stat(self, name, signature, hashed):
+        """ Store the stat signature of filename when it had given hash. """
+        raise NotImplementedError("DepsStore subclass didn't define set_stat")
+
+    def save(self, filename=None):
+        """ Write changes out to the dependency file (or given filename). """
+        raise NotImplementedError("DepsStore subclass didn't define save")
+
+    def close(self):
+        """ Release the dependency file without saving. """
+        pass
+
+    def __contains__(self, command):
+        return self.get(command) is not None
+
+    def __getitem__(self, command):
+        deps = self.get(command)
+        if deps is None:
+            raise KeyError(command)
+        return deps
+
+class JsonDeps(DepsStore):
+    """ Dependency store that reads the whole JSON dependency file when
+        created and rewrites all of it on save(). The file has a list of
+        every filename and every hash, and each command's entries are
+        indexes into them. deps_version 2 files, which spelled out every
+        entry in full, are also read. """
+    def __init__(self, filename, hasher=None):
+        super(JsonDeps, self).__init__(filename, hasher)
+        self._stats = {}
+        self._deps = self.read(self.filename)
+
+    def read(self, filename):
+        """ Return the dict of commands in a JSON dependency file, or an
+            empty dict if there isn't a usable one. """
+        try:
+            f = open(filename)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except IOError:
+            return {}
+        except ValueError:
+            data = {}
+        version = data.pop('.deps_version', 0)
+        if version == 2:
+            # version 2 files were always made with md5_hasher (or -t)
+            if self.other_hasher('md5_hasher'):
+                return {}
+            return dict((command, self.intern_deps(deps))
+                        for command, deps in data.iteritems())
+        # make sure the version is correct
+        if version != deps_version:
+            printerr('Bad %s dependency file version! Rebuilding.'
+                     % os.path.basename(filename))
+            return {}
+        if self.other_hasher(data.get('hasher', 'md5_hasher')):
+            return {}
+        names = [self.intern(name) for name in data['names']]
+        hashes = [self.intern(hashed) for hashed in data['hashes']]
+        deps = {}
+        for command, entries in data['commands'].iteritems():
+            # entries is a flat list of name index, hash index pairs
+            deps[command] = dict((names[entries[i]], hashes[entries[i+1]])
+                                 for i in xrange(0, len(entries), 2))
+        for name, signature, hashed in data.get('stats', []):
+            self._stats[names[name]] = signature, hashes[hashed]
+        return deps
+
+    def get(self, command, default=None):
+        return self._deps.get(command, default)
+
+    def __setitem__(self, command, deps):
+        self._deps[command] = self.intern_deps(deps)
+
+    def items(self):
+        return self._deps.items()
+
+    def get_stat(self, name):
+        return self._stats.get(name)
+
+    def set_stat(self, name, signature, hashed):
+        self._stats[self.intern(name)] = signature, self.intern(hashed)
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        names = {}
+        hashes = {}
+        commands = {}
+        for command, deps in self._deps.iteritems():
+            entries = commands[command] = []
+            for name, hashed in deps.iteritems():
+                entries.append(names.setdefault(name, len(names)))
+                entries.append(hashes.setdefault(hashed, len(hashes)))
+        stats = [(names.setdefault(name, len(names)), signature,
+                  hashes.setdefault(hashed, len(hashes)))
+                 for name, (signature, hashed) in self._stats.iteritems()]
+        data = {
+            '.deps_version': deps_version,
+            'names': sorted(names, key=names.get),
+            'hashes': sorted(hashes, key=hashes.get),
+            'commands': commands,
+            'stats': sorted(stats),
+            'hasher': self.hasher,
+            }
+        f = open(filename, 'w')
+        try:
+            json.dump(data, f, sort_keys=True, separators=(',', ':'))
+        finally:
+            f.close()
+
+class SqliteDeps(DepsStore):
+    """ Dependency store in an sqlite database. Each command's entry is only
+        read when the command is first looked up, and save() only writes the
+        entries that have been set since. Entries are rows of ids in tables
+        of filenames and hashes. JSON dependency files, and sqlite ones of
+        deps_version 2, are converted the first time they are opened. """
+    def __init__(self, filename, hasher=None):
+        super(SqliteDeps, self).__init__(filename, hasher)
+        self._deps = {}         # entries read so far, None if not stored
+        self._changed = set()   # commands set since the last save()
+        self._stats = {}        # stats read so far, None if not stored
+        self._changed_stats = set()
+        self._ids = {}          # (table, value) -> id of rows in self._db
+        # done() is called from the parallel results handler thread
+        self._lock = threading.Lock()
+        migrated = []
+        if SqliteDeps.is_json(self.filename):
+            migrated = JsonDeps(self.filename, hasher).items()
+            os.remove(self.filename)
+        self._db, old = SqliteDeps.connect(self.filename)
+        SqliteDeps.create_tables(self._db)
+        # version 2 files were always made with md5_hasher (or -t)
+        if old and not self.other_hasher('md5_hasher'):
+            migrated.extend(old)
+        self.check_hasher()
+        if migrated:
+            for command, deps in migrated:
+                self[command] = deps
+            self.save()
+
+    @staticmethod
+    def is_json(filename):
+        """ Return True if filename is a JSON (not sqlite) dependency file. """
+        try:
+            f = open(filename, 'rb')
+            try:
+                return f.read(1) == '{'
+            finally:
+                f.close()
+        except IOError:
+            return False
+
+    @staticmethod
+    def connect(filename):
+        """ Open the database, starting again if it has another version.
+            Return (connection, list of (command, deps) from a deps_version
+            2 database). """
+        db = sqlite3.connect(filename, check_same_thread=False)
+        try:
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+        except sqlite3.DatabaseError:
+            version = None
+        if version == deps_version:
+            return db, []
+        migrated = []
+        if version == 2:
+            # one row per command with its entries as JSON
+            migrated = [(command, json.loads(deps)) for command, deps in
+                        db.execute('SELECT command, deps FROM deps')]
+        elif version:
+            printerr('Bad %s dependency file version! Rebuilding.'
+                     % os.path.basename(filename))
+        if version != 0:
+            db.close()
+            os.remove(filename)
+            db = sqlite3.connect(filename, check_same_thread=False)
+        db.executescript('''
+            CREATE TABLE names (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+            CREATE TABLE hashes (id INTEGER PRIMARY KEY, hash TEXT UNIQUE);
+            CREATE TABLE commands (id INTEGER PRIMARY KEY, command TEXT UNIQUE);
+            CREATE TABLE deps (command INTEGER, name INTEGER, hash INTEGER);
+            CREATE INDEX deps_command ON deps (command);
+            PRAGMA user_version = %d;
+            ''' % deps_version)
+        db.commit()
+        return db, migrated
+
+    @staticmethod
+    def create_tables(db):
+        """ Add the tables of stat signatures and of settings such as the
+            hasher, which not all version 3 files have. """
+        db.execute('CREATE TABLE IF NOT EXISTS stats '
+                   '(name INTEGER PRIMARY KEY, stat TEXT, hash INTEGER)')
+        db.execute('CREATE TABLE IF NOT EXISTS settings '
+                   '(name TEXT PRIMARY KEY, value TEXT)')
+
+    def check_hasher(self):
+        """ Empty the database if it was made with another hasher, and
+            record this store's hasher. """
+        if self.hasher is None:
+            return
+        row = self._db.execute("SELECT value FROM settings "
+                               "WHERE name = 'hasher'").fetchone()
+        if row is None:
+            hasher = 'md5_hasher'
+        else:
+            hasher = row[0]
+        if (hasher != self.hasher and
+                self._db.execute('SELECT 1 FROM commands LIMIT 1').fetchone() and
+                self.other_hasher(hasher)):
+            for table in ('deps', 'commands', 'stats', 'names', 'hashes'):
+                self._db.execute('DELETE FROM %s' % table)
+        self._db.execute("INSERT OR REPLACE INTO settings VALUES ('hasher', ?)",
+                         (self.hasher,))
+        self._db.commit()
+
+    # query for the entries of commands, with the filenames and hashes
+    _select = ('SELECT commands.command, names.name, hashes.hash FROM deps '
+               'JOIN commands ON deps.command = commands.id '
+               'JOIN names ON deps.name = names.id '
+               'JOIN hashes ON deps.hash = hashes.id ')
+
+    def get(self, command, default=None):
+        with self._lock:
+            if command not in self._deps:
+                rows = self._db.execute(self._select + 'WHERE commands.command = ?',
+                                        (command,)).fetchall()
+                if rows:
+                    intern = self.intern
+                    self._deps[command] = dict((intern(name), intern(hashed))
+                                               for c, name, hashed in rows)
+                elif self._db.execute('SELECT 1 FROM commands WHERE command = ?',
+                                      (command,)).fetchone():
+                    self._deps[command] = {}
+                else:
+                    self._deps[command] = None
+            deps = self._deps[command]
+        if deps is None:
+            return default
+        return deps
+
+    def __setitem__(self, command, deps):
+        deps = self.intern_deps(deps)
+        with self._lock:
+            self._deps[command] = deps
+            self._changed.add(command)
+
+    def items(self):
+        with self._lock:
+            items = {}
+            for command, name, hashed in self._db.execute(self._select):
+                items.setdefault(command, {})[name] = hashed
+            for command, in self._db.execute('SELECT command FROM commands'):
+                items.setdefault(command, {})
+            for command in self._changed:
+                items[command] = self._deps[command]
+        return items.items()
+
+    def names(self):
+        with self._lock:
+            names = set(name for name, in self._db.execute(
+                'SELECT names.name FROM names WHERE id IN '
+                '(SELECT DISTINCT name FROM deps)'))
+            for command in self._changed:
+                names.update(self._deps[command])
+        return list(names)
+
+    def get_stat(self, name):
+        with self._lock:
+            if name not in self._stats:
+                self._stats[name] = self._db.execute(
+                    'SELECT stats.stat, hashes.hash FROM stats '
+                    'JOIN names ON stats.name = names.id '
+                    'JOIN hashes ON stats.hash = hashes.id '
+                    'WHERE names.name = ?', (name,)).fetchone()
+            return self._stats[name]
+
+    def set_stat(self, name, signature, hashed):
+        with self._lock:
+            self._stats[name] = signature, self.intern(hashed)
+            self._changed_stats.add(name)
+
+    def stat_items(self):
+        """ Return a list of (filename, (stat signature, hash)) for every
+            file with a stored stat signature. """
+        with self._lock:
+            stats = dict((name, (signature, hashed)) for name, signature, hashed
+                         in self._db.execute(
+                             'SELECT names.name, stats.stat, hashes.hash FROM stats '
+                             'JOIN names ON stats.name = names.id '
+                             'JOIN hashes ON stats.hash = hashes.id'))
+            for name in self._changed_stats:
+                stats[name] = self._stats[name]
+        return stats.items()
+
+    def save(self, filename=None):
+        if filename is not None and os.path.abspath(filename) != self.filename:
+            # saving somewhere else, so copy everything there
+            db, old = SqliteDeps.connect(filename)
+            try:
+                SqliteDeps.create_tables(db)
+                db.execute("INSERT OR REPLACE INTO settings VALUES ('hasher', ?)",
+                           (self.hasher,))
+                SqliteDeps.write(db, self.items(), self.stat_items(), {})
+            finally:
+                db.close()
+        else:
+            with self._lock:
+                SqliteDeps.write(self._db,
+                                 [(c, self._deps[c]) for c in self._changed],
+                                 [(n, self._stats[n]) for n in self._changed_stats],
+                                 self._ids)
+                self._changed.clear()
+                self._changed_stats.clear()
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def write(db, items, stats, ids):
+        """ Replace the entries of the given (command, deps) items and the
+            (filename, (stat signature, hash)) stats. "ids" caches the ids
+            of rows in db's tables of strings. """
+        if not items and not stats:
+            return
+        def id(table, column, value):
+            key = table, value
+            if key not in ids:
+                db.execute('INSERT OR IGNORE INTO %s (%s) VALUES (?)'
+                           % (table, column), (value,))
+                ids[key] = db.execute('SELECT id FROM %s WHERE %s = ?'
+                                      % (table, column), (value,)).fetchone()[0]
+            return ids[key]
+        for command, deps in items:
+            command = id('commands', 'command', command)
+            db.execute('DELETE FROM deps WHERE command = ?', (command,))
+            db.executemany('INSERT INTO deps VALUES (?, ?, ?)',
+                           [(command, id('names', 'name', name),
+                             id('hashes', 'hash', hashed))
+                            for name, hashed in deps.iteritems()])
+        db.executemany('INSERT OR REPLACE INTO stats VALUES (?, ?, ?)',
+                       [(id('names', 'name', name), signature,
+                         id('hashes', 'hash', hashed))
+                        for name, (signature, hashed) in stats])
+        # forget hashes that nothing uses any more, e.g. old versions
+        db.execute('DELETE FROM hashes WHERE id NOT IN (SELECT hash FROM deps) '
+                   'AND id NOT IN (SELECT hash FROM stats)')
+        for key in [key for key in ids if key[0] == 'hashes']:
+            del ids[key]
+        db.commit()
+
+def cache_dir():
+    """ Return the directory for caches shared by every build on this host:
+        $FABRICATE_CACHE_DIR, or fabricate in $XDG_CACHE_HOME or ~/.cache """
+    if os.environ.get('FABRICATE_CACHE_DIR'):
+        return os.environ['FABRICATE_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'fabricate')
+
+def _find_program(name):
+    """ Return the real path of program name as found on $PATH, or None. """
+    if os.path.dirname(name):
+        paths = [name]
+    else:
+        paths = [os.path.join(dir, name) for dir in
+                 os.environ.get('PATH', os.defpath).split(os.pathsep)]
+    for path in paths:
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return os.path.realpath(path)
+    return None
+
+_probes = None                  # probes.json contents once read
+
+def cached_probe(program, name, probe):
+    """ Return the result of calling probe(), a function finding out
+        something called "name" about a tool, such as which options it
+        supports. Results are cached in probes.json in cache_dir(), keyed by
+        the real path of "program" on $PATH and its size and mtime, so the
+        probe is only run again when the program changes. Results must be
+        JSON serialisable. If the program isn't found probe() is just
+        called. """
+    global _probes
+    path = _find_program(program)
+    if path is None:
+        return probe()
+    st = os.stat(path)
+    key = '%s %s' % (path, name)
+    signature = stat_signature(st)
+    filename = os.path.join(cache_dir(), 'probes.json')
+    if _probes is None:
+        try:
+            with open(filename) as f:
+                _probes = json.load(f)
+        except (IOError, ValueError):
+            _probes = {}
+    entry = _probes.get(key)
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+
+    result = probe()
+    _probes[key] = [signature, result]
+    # write to a temp file and rename so concurrent builds never see a
+    # partly written cache
+    try:
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir())
+        handle, tempname = tempfile.mkstemp(dir=cache_dir())
+        with os.fdopen(handle, 'w') as f:
+            json.dump(_probes, f, sort_keys=True)
+        os.rename(tempname, filename)
+    except (IOError, OSError):
+        pass
+    return result
+
+class HashCache(object):
+    """ Cache of file hashes shared by all builds on this host, in an sqlite
+        database. Hashes are keyed by the hasher and the file's device,
+        inode, size, mtime and ctime rather than its name, so unchanging
+        files such as system headers are hashed once for every build root.
+        Once it has more than "max_entries" the least recently used entries
+        are dropped on save(). Errors using the database, such as another
+        build holding it locked for too long, only make it miss. """
+    def __init__(self, filename, hasher, max_entries=200000):
+        self.filename = filename
+        self.hasher = hasher
+        self.max_entries = max_entries
+        self._new = {}          # key -> hash of entries to insert
+        self._used = set()      # keys of entries found
+        self._lock = threading.Lock()
+        self._db = None
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            self._db = sqlite3.connect(filename, timeout=5,
+                                       check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS hashes '
+                             '(key TEXT PRIMARY KEY, hash TEXT, used INTEGER)')
+            self._db.commit()
+        except (OSError, sqlite3.Error):
+            self._db = None
+
+    def key(self, st):
+        """ Return the cache key of a file from its os.stat() result. """
+        return '%s %d %s %d' % (self.hasher, st.st_dev, stat_signature(st),
+                                int(st.st_ctime * 1000000000))
+
+    def get(self, st):
+        """ Return the cached hash of the file with os.stat() result st, or
+            None. """
+        if self._db is None:
+            return None
+        key = self.key(st)
+        with self._lock:
+            if key in self._new:
+                return self._new[key]
+            try:
+                row = self._db.execute('SELECT hash FROM hashes WHERE key = ?',
+                                       (key,)).fetchone()
+            except sqlite3.Error:
+                return None
+            if row is None:
+                return None
+            self._used.add(key)
+            return row[0]
+
+    def set(self, st, hashed):
+        """ Cache the hash of the file with os.stat() result st. """
+        if self._db is not None:
+            with self._lock:
+                self._new[self.key(st)] = hashed
+
+    def save(self):
+        """ Write new entries, mark the ones found as used now, and drop the
+            least recently used entries beyond max_entries. """
+        if self._db is None:
+            return
+        now = int(time.time())
+        with self._lock:
+            try:
+                self._db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                                     [(key, hashed, now) for key, hashed
+                                      in self._new.iteritems()])
+                self._db.executemany('UPDATE hashes SET used = ? WHERE key = ?',
+                                     [(now, key) for key in self._used])
+                count = self._db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+                if count > self.max_entries:
+                    self._db.execute('DELETE FROM hashes WHERE key IN (SELECT key '
+                                     'FROM hashes ORDER BY used LIMIT ?)',
+                                     (count - self.max_entries,))
+                self._db.commit()
+            except sqlite3.Error:
+                pass
+            self._new.clear()
+            self._used.clear()
+
+class BuildCache(object):
+    """ Base class of the stores Builder's "cache" option uses to share
+        command outputs between builds. Keys are "ac/" followed by a
+        command's cache key for the JSON list of outputs the command made
+        from each set of inputs, and "cas/" followed by a file's hash for
+        its contents. Subclasses define get() and put(), or get_file() and
+        put_file() to move files more directly, and close() to tidy up at
+        the end of the build. Errors raised are EnvironmentErrors, which
+        only make Builder miss the cache. """
+    def get(self, key):
+        """ Return the data stored under key, or None. """
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """ Store data under key. """
+        raise NotImplementedError
+
+    def get_file(self, key, filename, mode):
+        """ Create filename, which doesn't exist, with the data stored under
+            key and the given permission bits, returning False if there's
+            no data. """
+        data = self.get(key)
+        if data is None:
+            return False
+        with open(filename, 'wb') as f:
+            f.write(data)
+        os.chmod(filename, mode)
+        return True
+
+    def put_file(self, key, filename):
+        """ Store the contents of filename under key. """
+        with open(filename, 'rb') as f:
+            self.put(key, f.read())
+
+    def close(self):
+        """ Called at exit once the build is done with the cache. """
+        pass
+
+# the Linux ioctl that makes a file share another's data, copy on write
+FICLONE = 0x40049409
+
+def reflink(source, dest):
+    """ Create dest as a copy of the file source which shares its data, as
+        btrfs, XFS and some others can. Raise an EnvironmentError if the
+        filesystem can't. """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks not supported', dest)
+    with open(source, 'rb') as src:
+        with open(dest, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except EnvironmentError:
+                dst.close()
+                os.remove(dest)
+                raise
+
+def _same_contents(filename1, filename2):
+    """ Return True if the two files have the same contents. """
+    if os.path.getsize(filename1) != os.path.getsize(filename2):
+        return False
+    with open(filename1, 'rb') as f1:
+        with open(filename2, 'rb') as f2:
+            while True:
+                data = f1.read(65536)
+                if data != f2.read(65536):
+                    return False
+                if not data:
+                    return True
+
+class DirectoryBuildCache(BuildCache):
+    """ BuildCache kept in a directory, which may be shared by the builds
+        of several checkouts on a host or over a network filesystem.
+
+        Files are restored by reflinking them from the cache if the
+        filesystem can, else by hard linking them if "link" is True, else
+        by copying them. Hard links save space and time but share the
+        cached copy: Builder removes hard linked outputs before running
+        the command that makes them again, but anything else writing to
+        an output in place changes the cache too. Contents found changed
+        are replaced when the same output is stored again.
+
+        If "max_size" is given, the least recently used entries are removed
+        at the end of a build which takes the cache over max_size bytes. """
+    def __init__(self, path, max_size=None, link=False):
+        self.path = path
+        self.max_size = max_size
+        self.link = link
+        self._added = 0
+
+    def filename(self, key):
+        """ Return the name of the file key is stored in. """
+        kind, name = key.split('/', 1)
+        return os.path.join(self.path, kind, name[:2], name)
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if key.startswith('ac/'):
+            # command entries' mtimes are their last use, for trim(). The
+            # contents' mtimes aren't touched as they may be hard linked.
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+        return data
+
+    def get_file(self, key, filename, mode):
+        if not key.startswith('cas/'):
+            return BuildCache.get_file(self, key, filename, mode)
+        cached = self.filename(key)
+        try:
+            st = os.stat(cached)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        try:
+            reflink(cached, filename)
+        except EnvironmentError:
+            if self.link and stat.S_IMODE(st.st_mode) == mode:
+                try:
+                    os.link(cached, filename)
+                    return True
+                except OSError:
+                    pass
+            shutil.copyfile(cached, filename)
+        os.chmod(filename, mode)
+        return True
+
+    def _make_dir(self, filename):
+        """ Make the directory filename is to be stored in. """
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        return dirname
+
+    def put(self, key, data):
+        filename = self.filename(key)
+        dirname = self._make_dir(filename)
+        # write to a temp file and rename so readers never see part of it
+        handle, tempname = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+            os.rename(tempname, filename)
+        except:
+            os.remove(tempname)
+            raise
+        self._added += len(data)
+
+    def put_file(self, key, filename):
+        if not key.startswith('cas/'):
+            return BuildCache.put_file(self, key, filename)
+        # contents are stored under their hash so needn't be stored twice,
+        # unless the copy stored has been changed since
+        cached = self.filename(key)
+        if os.path.exists(cached) and _same_contents(cached, filename):
+            return
+        dirname = self._make_dir(cached)
+        handle, tempname = tempfile.mkstemp(dir=dirname)
+        os.close(handle)
+        try:
+            try:
+                os.remove(tempname)
+                reflink(filename, tempname)
+            except EnvironmentError:
+                shutil.copyfile(filename, tempname)
+            shutil.copymode(filename, tempname)
+            os.rename(tempname, cached)
+        except:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+            raise
+        self._added += os.path.getsize(cached)
+
+    def close(self):
+        if self.max_size is None or not self._added:
+            return
+        # the cache's size is kept in a file so it needn't be added up
+        # after each build, only when it may have grown over max_size
+        sizename = os.path.join(self.path, 'size')
+        try:
+            with open(sizename) as f:
+                size = int(f.read())
+        except (IOError, ValueError):
+            size = None
+        if size is not None and size + self._added <= self.max_size:
+            size += self._added
+        else:
+            size = self.trim()
+        self._added = 0
+        try:
+            self.put_size(size)
+        except EnvironmentError:
+            pass
+
+    def put_size(self, size):
+        """ Record the cache's size in its "size" file. """
+        handle, tempname = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(handle, 'w') as f:
+            f.write('%d\n' % size)
+        os.rename(tempname, os.path.join(self.path, 'size'))
+
+    def _files(self, kind):
+        """ Yield (filename, os.stat() result) of the files of the given kind
+            of key in the cache. """
+        top = os.path.join(self.path, kind)
+        for dirpath, dirnames, filenames in os.walk(top):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    yield filename, os.stat(filename)
+                except OSError:
+                    pass
+
+    def trim(self, max_size=None):
+        """ Remove the least recently used command entries until the cache
+            is smaller than 90% of max_size, which defaults to
+            self.max_size, then the contents no entries use. Return the
+            cache's size after trimming. """
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self._files('ac'), key=lambda (name, st): st.st_mtime)
+        contents = dict((os.path.basename(name), (name, st.st_size))
+                        for name, st in self._files('cas'))
+        # find which contents each entry uses
+        uses = {}
+        for name, st in entries:
+            try:
+                with open(name, 'rb') as f:
+                    used = json.loads(f.read())
+            except (IOError, ValueError):
+                used = []
+            uses[name] = set(output[1] for entry in used
+                             for output in entry['outputs'] if output[1])
+        users = {}
+        for name in uses:
+            for hashed in uses[name]:
+                users[hashed] = users.get(hashed, 0) + 1
+
+        size = sum(st.st_size for name, st in entries)
+        size += sum(filesize for name, filesize in contents.itervalues())
+        limit = max_size * 9 // 10
+        for name, st in entries:
+            if size <= limit:
+                break
+            try:
+                os.remove(name)
+            except OSError:
+                continue
+            size -= st.st_size
+            for hashed in uses[name]:
+                users[hashed] -= 1
+                if not users[hashed] and hashed in contents:
+                    size -= contents[hashed][1]
+        for hashed, (name, filesize) in contents.iteritems():
+            if not users.get(hashed):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+                if hashed not in users:
+                    size -= filesize
+        return size
+
+class HttpBuildCache(BuildCache):
+    """ BuildCache on an HTTP server which answers GET and PUT requests for
+        the keys under its URL, as used by the HTTP caches of other build
+        tools. """
+    def __init__(self, url, timeout=30):
+        # only imported when used, as they take a while to import
+        import httplib
+        import urllib2
+        self._httplib = httplib
+        self._urllib2 = urllib2
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, key):
+        try:
+            response = self._urllib2.urlopen('%s/%s' % (self.url, key),
+                                             timeout=self.timeout)
+        except self._urllib2.HTTPError, e:
+            if e.code == 404:
+                return None
+            raise
+        except self._httplib.HTTPException, e:
+            raise IOError('bad response from %s: %r' % (self.url, e))
+        try:
+            return response.read()
+        except self._httplib.HTTPException, e:
+            raise IOError('bad response from %s: %r' % (self.url, e))
+        finally:
+            response.close()
+
+    def put(self, key, data):
+        request = self._urllib2.Request('%s/%s' % (self.url, key), data,
+            {'Content-Type': 'application/octet-stream'})
+        request.get_method = lambda: 'PUT'
+        try:
+            self._urllib2.urlopen(request, timeout=self.timeout).close()
+        except self._httplib.HTTPException, e:
+            # such as BadStatusLine from a server that dropped the connection
+            raise IOError('bad response from %s: %r' % (self.url, e))
+
+# default size limit of local build caches
+build_cache_size = 10 * 1024**3
+
+def build_cache(cache, max_size=build_cache_size):
+    """ Return the BuildCache given by "cache", which may be a BuildCache, an
+        http:// or https:// URL of an HttpBuildCache, the directory of a
+        DirectoryBuildCache, or True for the DirectoryBuildCache in
+        cache_dir() shared by the builds on this host. "max_size" is the
+        size limit of a DirectoryBuildCache in bytes. """
+    if cache is None or isinstance(cache, BuildCache):
+        return cache
+    if cache is True:
+        cache = os.path.join(cache_dir(), 'build')
+    if cache.startswith('http://') or cache.startswith('https://'):
+        return HttpBuildCache(cache)
+    return DirectoryBuildCache(cache, max_size=max_size)
+
 class RunnerUnsupportedException(Exception):
     """ Exception raise by Runner constructor if it is not supported
         on the current platform."""
@@ -240,6 +1232,9 @@ class Runner(object):
             to shell()"""
         raise NotImplementedError("Runner subclass called but subclass didn't define __call__")
 
+    # True if commands can be run in parallel with this runner
+    parallel_safe = False
+
     def actual_runner(self):
         """ Return the actual runner object (overriden in SmartRunner). """
         return self
@@ -247,13 +1242,112 @@ class Runner(object):
     def ignore(self, name):
         return self._builder.ignore.search(name)
 
+    def _check_path(self, cwd, name):
+        """ Return (normalised name, relevant) for a path name a command
+            used in directory cwd. Needs self.build_dir. """
+        if cwd != '.':
+            name = os.path.join(cwd, name)
+
+        # normalise path name to ensure files are only listed once
+        name = os.path.normpath(name)
+
+        # if it's an absolute path name under the build directory,
+        # make it relative to build_dir before saving to .deps file
+        if os.path.isabs(name) and name.startswith(self.build_dir):
+            name = name[len(self.build_dir):]
+            name = name.lstrip(os.path.sep)
+
+        relevant = self._builder._is_relevant(name) and not self.ignore(name)
+        return name, relevant
+
+    def _check_paths_memo(self):
+        """ Empty self._paths, the memo of _check_path() results, if the
+            current directory or the builder's settings for which paths are
+            relevant have changed since it was filled. """
+        builder = self._builder
+        key = (os.getcwd(), tuple(builder.dirs), builder.dirdepth,
+               builder.ignoreprefix, builder.ignore.pattern)
+        if key != getattr(self, '_paths_key', None):
+            self._paths_key = key
+            self._paths = {}
+
+class Inotify(object):
+    """ Minimal wrapper of Linux's inotify, using ctypes. Raises OSError if
+        inotify isn't available. """
+    IN_MODIFY      = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_OPEN        = 0x00000020
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ONLYDIR     = 0x01000000
+    IN_ISDIR       = 0x40000000
+    IN_CLOEXEC     = 0x00080000
+    IN_NONBLOCK    = 0x00000800
+
+    _event = struct.Struct('iIII')     # wd, mask, cookie, len of name
+
+    def __init__(self):
+        if ctypes is None or platform.system() != 'Linux':
+            raise OSError(0, 'inotify is not available')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(0, 'inotify is not available')
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        """ Watch path for the events in mask and return the watch descriptor. """
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read_events(self):
+        """ Return a list of (wd, mask, name) for the events queued so far. """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self._event.unpack_from(data, offset)
+                offset += self._event.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
 class AtimesRunner(Runner):
+    # True to use inotify, where available, to learn which files each command
+    # opened and wrote, rather than walking the whole tree before and after
+    incremental = True
+    # number of threads walking the tree, for big trees or slow filesystems
+    walk_threads = 1
+
     def __init__(self, builder):
         self._builder = builder
         self.atimes = AtimesRunner.has_atimes(self._builder.dirs)
         if self.atimes == 0:
             raise RunnerUnsupportedException(
                 'atimes are not supported on this platform')
+        self._inotify = None    # Inotify once watching, False if we can't
+        self._watched = {}      # watch descriptor -> (directory, depth)
 
     @staticmethod
     def file_has_atimes(filename):
@@ -342,28 +1436,108 @@ class AtimesRunner(Runner):
                 os.remove(filename)
         return atimes
 
-    def _file_times(self, path, depth):
-        """ Helper function for file_times().
-            Return a dict of file times, recursing directories that don't
-            start with self._builder.ignoreprefix """
-
+    def _scan_dir(self, path, file_times=True, follow_links=True):
+        """ Return (files, subdirectories) in directory path, skipping names
+            that start with self._builder.ignoreprefix. "files" is a dict of
+            file times of the regular files, or just a list of their names
+            if file_times is False, when (with scandir) no stat is needed.
+            Symlinks to directories are only among the subdirectories if
+            follow_links is True. """
         AtimesRunner.exists(path)
-        names = os.listdir(path)
-        times = {}
         ignoreprefix = self._builder.ignoreprefix
-        for name in names:
+        if file_times:
+            files = {}
+        else:
+            files = []
+        dirs = []
+        if scandir is not None:
+            entries = ((entry.name, entry) for entry in scandir(path))
+        else:
+            entries = ((name, None) for name in os.listdir(path))
+        for name, entry in entries:
             if ignoreprefix and name.startswith(ignoreprefix):
                 continue
             if path == '.':
                 fullname = name
             else:
                 fullname = os.path.join(path, name)
-            st = os.stat(fullname)
-            if stat.S_ISDIR(st.st_mode):
-                if depth > 1:
-                    times.update(self._file_times(fullname, depth-1))
-            elif stat.S_ISREG(st.st_mode):
-                times[fullname] = st.st_atime, st.st_mtime
+            if entry is not None and not entry.is_symlink():
+                # the type is known without a stat
+                is_dir = entry.is_dir()
+                if is_dir or not entry.is_file():
+                    st = None
+                elif file_times:
+                    st = entry.stat()
+                else:
+                    files.append(fullname)
+                    continue
+            else:
+                try:
+                    st = os.stat(fullname)
+                except OSError:
+                    continue    # a broken symlink, so not a file we can use
+                is_dir = stat.S_ISDIR(st.st_mode)
+                if not stat.S_ISREG(st.st_mode):
+                    st = None
+            if is_dir:
+                if follow_links or not (entry.is_symlink() if entry is not None
+                                        else os.path.islink(fullname)):
+                    dirs.append(fullname)
+            elif st is not None:
+                if file_times:
+                    files[fullname] = st.st_atime, st.st_mtime
+                else:
+                    files.append(fullname)
+        return files, dirs
+
+    def _file_times(self, path, depth):
+        """ Helper function for file_times().
+            Return a dict of file times, recursing directories that don't
+            start with self._builder.ignoreprefix """
+        times, dirs = self._scan_dir(path)
+        if depth > 1:
+            for dir in dirs:
+                times.update(self._file_times(dir, depth-1))
+        return times
+
+    def _file_times_threaded(self):
+        """ Return file_times() found by walk_threads threads, each taking
+            the next directory to scan from a queue. """
+        times = {}
+        errors = []
+        queue = Queue.Queue()
+
+        def scan():
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                path, depth = item
+                try:
+                    found, dirs = self._scan_dir(path)
+                    times.update(found)
+                    if depth > 1:
+                        for dir in dirs:
+                            queue.put((dir, depth-1))
+                except Exception:
+                    errors.append(sys.exc_info())
+                finally:
+                    queue.task_done()
+
+        for path in self._builder.dirs:
+            queue.put((path, self._builder.dirdepth))
+        threads = [threading.Thread(target=scan)
+                   for i in range(self.walk_threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        queue.join()
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
         return times
 
     def file_times(self):
@@ -373,6 +1547,8 @@ class AtimesRunner(Runner):
             Recurse directories that don't start with
             self._builder.ignoreprefix and have depth less than
             self._builder.dirdepth. """
+        if self.walk_threads > 1:
+            return self._file_times_threaded()
 
         times = {}
         for path in self._builder.dirs:
@@ -402,9 +1578,125 @@ class AtimesRunner(Runner):
             adjusted[filename] = entry
         return adjusted
 
+    # events meaning a command wrote a file, and all the events watched for
+    _output_events = (Inotify.IN_CREATE | Inotify.IN_MODIFY |
+                      Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+    _watch_events = _output_events | Inotify.IN_OPEN | Inotify.IN_ONLYDIR
+
+    def _watch(self):
+        """ Start watching the build dirs with inotify, if we aren't already.
+            Return False if inotify can't be used. """
+        if self._inotify is None:
+            try:
+                self._inotify = Inotify()
+                self._watch_dirs()
+            except OSError:
+                # no inotify, or out of watches: walk the tree instead
+                if self._inotify:
+                    self._inotify.close()
+                self._inotify = False
+        return bool(self._inotify)
+
+    def _watch_dirs(self):
+        """ Watch every directory in self._builder.dirs, to dirdepth. """
+        for path in self._builder.dirs:
+            AtimesRunner.exists(path)
+            self._add_watches(path, self._builder.dirdepth)
+
+    def _add_watches(self, path, depth, outputs=None):
+        """ Watch directory path and its subdirectories that don't start with
+            self._builder.ignoreprefix, to the given depth. If "outputs" is
+            a set, the directory is new, so add the files already in it.
+            Symlinks to directories aren't followed, as with os.walk(), so
+            a link back up the tree can't have it watched over and over. """
+        wd = self._inotify.add_watch(path, self._watch_events)
+        self._watched[wd] = path, depth
+        files, dirs = self._scan_dir(path, file_times=False, follow_links=False)
+        if depth > 1:
+            for dir in dirs:
+                self._add_watches(dir, depth-1, outputs)
+        if outputs is not None:
+            outputs.update(files)
+
+    def _read_events(self, deps=None, outputs=None):
+        """ Read the inotify events queued so far, adding files opened to
+            the "deps" set and files written to "outputs" if given, and
+            watching new directories. Return True if events were lost
+            because the queue overflowed. """
+        overflowed = False
+        ignoreprefix = self._builder.ignoreprefix
+        for wd, mask, name in self._inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            if mask & Inotify.IN_IGNORED:
+                # the directory was removed
+                self._watched.pop(wd, None)
+                continue
+            if not name or wd not in self._watched:
+                continue        # an event on the watched directory itself
+            if ignoreprefix and name.startswith(ignoreprefix):
+                continue
+            path, depth = self._watched[wd]
+            if path == '.':
+                fullname = name
+            else:
+                fullname = os.path.join(path, name)
+            if mask & Inotify.IN_ISDIR:
+                if (mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO)
+                        and depth > 1 and os.path.isdir(fullname)):
+                    self._add_watches(fullname, depth-1, outputs)
+            elif outputs is not None:
+                if mask & self._output_events:
+                    outputs.add(fullname)
+                else:
+                    deps.add(fullname)
+        return overflowed
+
+    def _watched_call(self, args, kwargs):
+        """ Run command and return its dependencies and outputs, as the
+            files in the build dirs that inotify saw it open and write. """
+        # events so far, like our own hashing, aren't from the command
+        if self._read_events():
+            self._watch_dirs()
+        start = time.time()
+        shell_keywords = dict(silent=False)
+        shell_keywords.update(kwargs)
+        shell(*args, **shell_keywords)
+        deps = set()
+        outputs = set()
+        if self._read_events(deps, outputs):
+            # some events were lost, so fall back to walking the tree for
+            # files accessed or modified since the command started, and
+            # watch any directories we missed being created
+            if self.atimes == 2:
+                # file times come from a coarse kernel clock that can lag
+                # time.time() by a clock tick
+                atime_resolution = mtime_resolution = 0.02
+            else:
+                atime_resolution = FAT_atime_resolution
+                mtime_resolution = FAT_mtime_resolution
+            deps = set()
+            outputs = set()
+            for name, (atime, mtime) in self.file_times().iteritems():
+                if mtime >= start - mtime_resolution:
+                    outputs.add(name)
+                elif atime >= start - atime_resolution:
+                    deps.add(name)
+            self._watch_dirs()
+        deps -= outputs
+        deps = [name for name in deps
+                if os.path.isfile(name) and not self.ignore(name)]
+        outputs = [name for name in outputs
+                   if os.path.isfile(name) and not self.ignore(name)]
+        return deps, outputs
+
     def __call__(self, *args, **kwargs):
         """ Run command and return its dependencies and outputs, using before
-            and after access times to determine dependencies. """
+            and after access times to determine dependencies, or inotify if
+            incremental is True and it's available. """
+        if self.incremental and self._watch():
+            return self._watched_call(args, kwargs)
 
         # For Python pre-2.5, ensure os.stat() returns float atimes
         old_stat_float = os.stat_float_times()
@@ -481,19 +1773,90 @@ class StraceProcess(object):
                (self.cwd, self.deps, self.outputs)
 
 def _call_strace(self, *args, **kwargs):
-    """ Top level function call for Strace that can be run in parallel """
-    return self(*args, **kwargs)
+    """ Top level function call for Strace that can be run in parallel.
+        Exceptions are returned rather than raised so that the pool's
+        completion callback sees them. """
+    try:
+        return self(*args, **kwargs)
+    except Exception, e:
+        return e
+
+# Line written to a FIFO log after the command exits to end the log. Raw NULs
+# never appear in strace output as it escapes them in strings, nor in the
+# path names PreloadRunner logs.
+_end_of_log = '\0\n'
+
+def _read_log(fd, parse_line, log):
+    """ Call parse_line() with each line read from fd up to _end_of_log,
+        counting them in log['lines']. The log is read to the end even if
+        parsing raises an exception, which is saved in log['error'], so the
+        command never blocks writing to a full FIFO. """
+    end = _end_of_log[:-1]
+    partial = ''
+    while True:
+        lines = (partial + os.read(fd, 65536)).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            if line == end:
+                return
+            log['lines'] += 1
+            if log['error'] is None:
+                try:
+                    parse_line(line)
+                except Exception:
+                    log['error'] = sys.exc_info()
 
 class StraceRunner(Runner):
     keep_temps = False
+    parallel_safe = True
+    # True to have strace write its log to a FIFO which is parsed while the
+    # command runs, rather than to a temp file parsed after it exits
+    stream_log = hasattr(os, 'mkfifo')
 
     def __init__(self, builder, build_dir=None):
-        self.strace_system_calls = StraceRunner.get_strace_system_calls()
+        self.strace_system_calls = cached_probe('strace', 'system calls',
+            StraceRunner.get_strace_system_calls)
         if self.strace_system_calls is None:
             raise RunnerUnsupportedException('strace is not available')
+        self.strace_options = cached_probe('strace', 'options',
+            StraceRunner.get_strace_options)
         self._builder = builder
         self.temp_count = 0
         self.build_dir = os.path.abspath(build_dir or os.getcwd())
+        # (cwd, name) -> (normalised name, relevant) for each path seen
+        self._paths = {}
+        self._root_pid = None   # pid of the first process in the log
+
+    def __getstate__(self):
+        """ The path caches aren't sent along with each parallel job. """
+        state = self.__dict__.copy()
+        state['_paths'] = {}
+        return state
+
+    # System calls traced, where strace supports them. The *at() calls and
+    # statx are what modern C libraries use in place of the older calls.
+    possible_system_calls = ['open', 'openat', 'creat',
+        'stat', 'stat64', 'lstat', 'lstat64', 'newfstatat', 'fstatat64',
+        'statx', 'execve', 'execveat', 'exit_group', 'chdir', 'fchdir',
+        'mkdir', 'mkdirat', 'rename', 'renameat', 'renameat2',
+        'symlink', 'symlinkat', 'clone', 'clone3', 'vfork', 'fork']
+
+    # Options used where strace supports them: -y to print the paths of
+    # directory file descriptors given to the *at() calls, -z to only log
+    # calls that succeeded (failed header searches are most of a compile's
+    # log), and --seccomp-bpf to not stop the command for untraced calls
+    possible_options = [['-y'], ['-z'], ['--seccomp-bpf']]
+
+    @staticmethod
+    def _probe_strace(args):
+        """ Run strace with args but no command to trace and return what it
+            printed to stderr, or None if there is no strace. """
+        try:
+            proc = subprocess.Popen(['strace'] + args, stderr=subprocess.PIPE)
+        except OSError:
+            return None
+        stdout, stderr = proc.communicate()
+        return stderr
 
     @staticmethod
     def get_strace_system_calls():
@@ -502,34 +1865,59 @@ class StraceRunner(Runner):
         if platform.system() == 'Windows':
             # even if windows has strace, it's probably a dodgy cygwin one
             return None
-        possible_system_calls = ['open','stat', 'stat64', 'lstat', 'lstat64',
-            'execve','exit_group','chdir','mkdir','rename','clone','vfork',
-            'fork','symlink','creat']
-        valid_system_calls = []
-        try:
-            # check strace is installed and if it supports each type of call
-            for system_call in possible_system_calls:
-                proc = subprocess.Popen(['strace', '-e', 'trace=' + system_call], stderr=subprocess.PIPE)
-                stdout, stderr = proc.communicate()
-                proc.wait()
-                if 'invalid system call' not in stderr:
-                   valid_system_calls.append(system_call)
-        except OSError:
-            return None
-        return ','.join(valid_system_calls)
-
-    # Regular expressions for parsing of strace log
-    _open_re       = re.compile(r'(?P<pid>\d+)\s+open\("(?P<name>[^"]*)", (?P<mode>[^,)]*)')
-    _stat_re       = re.compile(r'(?P<pid>\d+)\s+l?stat(?:64)?\("(?P<name>[^"]*)", .*') # stat,lstat,stat64,lstat64
-    _execve_re     = re.compile(r'(?P<pid>\d+)\s+execve\("(?P<name>[^"]*)", .*')
-    _creat_re      = re.compile(r'(?P<pid>\d+)\s+creat\("(?P<name>[^"]*)", .*')
-    _mkdir_re      = re.compile(r'(?P<pid>\d+)\s+mkdir\("(?P<name>[^"]*)", .*\)\s*=\s(?P<result>-?[0-9]*).*')
-    _rename_re     = re.compile(r'(?P<pid>\d+)\s+rename\("[^"]*", "(?P<name>[^"]*)"\)')
-    _symlink_re    = re.compile(r'(?P<pid>\d+)\s+symlink\("[^"]*", "(?P<name>[^"]*)"\)')
-    _kill_re       = re.compile(r'(?P<pid>\d+)\s+killed by.*')
-    _chdir_re      = re.compile(r'(?P<pid>\d+)\s+chdir\("(?P<cwd>[^"]*)"\)')
-    _exit_group_re = re.compile(r'(?P<pid>\d+)\s+exit_group\((?P<status>.*)\).*')
-    _clone_re      = re.compile(r'(?P<pid_clone>\d+)\s+(clone|fork|vfork)\(.*\)\s*=\s*(?P<pid>\d*)')
+        # strace complains about the first system call it doesn't know, so
+        # probe with them all and drop each one it complains about
+        system_calls = list(StraceRunner.possible_system_calls)
+        while system_calls:
+            stderr = StraceRunner._probe_strace(
+                ['-e', 'trace=' + ','.join(system_calls)])
+            if stderr is None:
+                return None
+            match = re.search(r"invalid system call '([^']*)'", stderr)
+            if match is None:
+                break
+            if match.group(1) not in system_calls:
+                return None         # an strace we don't understand
+            system_calls.remove(match.group(1))
+        return ','.join(system_calls)
+
+    @staticmethod
+    def get_strace_options():
+        """ Return the list of StraceRunner.possible_options this system's
+            strace supports, which then just complains of having no command
+            to trace. """
+        options = []
+        for option in StraceRunner.possible_options:
+            stderr = StraceRunner._probe_strace(['-f'] + option)
+            if stderr is not None and 'must have PROG' in stderr:
+                options.extend(option)
+        return options
+
+    # Regular expression splitting a strace log line into the pid, the name
+    # of the system call and its arguments and result, so each line is only
+    # parsed further by the handler for its system call (lines that aren't
+    # calls, like "123 +++ killed by SIGKILL +++", don't match)
+    _syscall_re = re.compile(r'(?P<pid>\d+)\s+(?P<call>\w+)\((?P<args>.*)')
+    # 3618  +++ exited with 1 +++
+    _exited_re = re.compile(r'(?P<pid>\d+)\s+\+\+\+ (?:exited with (?P<status>\d+)|killed by)')
+
+    # Regular expressions for parsing the arguments of each system call
+    _path_re       = re.compile(r'"(?P<name>[^"]*)"') # first argument is path
+    # a directory file descriptor, shown with its path by strace -y, then
+    # a path relative to it: openat(3</usr/include>, "stdio.h", ...
+    _dirfd = r'(?:AT_FDCWD|\d+)(?:<(?P<dir>[^>]*)>)?, "(?P<name>[^"]*)"'
+    _at_re         = re.compile(_dirfd)
+    _openat_re     = re.compile(_dirfd + r', (?P<mode>[^,)]*)')
+    _mkdirat_re    = re.compile(_dirfd + r', .*\)\s*=\s(?P<result>-?[0-9]*).*')
+    _renameat_re   = re.compile(r'[^,]*, "[^"]*", ' + _dirfd)
+    _symlinkat_re  = re.compile(r'"[^"]*", ' + _dirfd)
+    _fchdir_re     = re.compile(r'\d+<(?P<cwd>[^>]*)>\)')
+    _open_re       = re.compile(r'"(?P<name>[^"]*)", (?P<mode>[^,)]*)')
+    _mkdir_re      = re.compile(r'"(?P<name>[^"]*)", .*\)\s*=\s(?P<result>-?[0-9]*).*')
+    _second_path_re = re.compile(r'"[^"]*", "(?P<name>[^"]*)"\)') # rename,symlink
+    _chdir_re      = re.compile(r'"(?P<cwd>[^"]*)"\)')
+    _exit_group_re = re.compile(r'(?P<status>.*)\).*')
+    _clone_re      = re.compile(r'.*\)\s*=\s*(?P<pid>\d*)')
 
     # Regular expressions for detecting interrupted lines in strace log
     # 3618  clone( <unfinished ...>
@@ -543,7 +1931,7 @@ class StraceRunner(Runner):
         shell_keywords = dict(silent=False)
         shell_keywords.update(kwargs)
         try:
-            shell('strace', '-fo', outname, '-e',
+            shell('strace', '-fo', outname, self.strace_options, '-e',
                   'trace=' + self.strace_system_calls,
                   args, **shell_keywords)
         except ExecutionError, e:
@@ -557,59 +1945,216 @@ class StraceRunner(Runner):
                 outfile.seek(0)
 			
         self.status = 0
+        self._root_pid = None
         processes  = {}  # dictionary of processes (key = pid)
         unfinished = {}  # list of interrupted entries in strace log
         for line in outfile:
            self._match_line(line, processes, unfinished)
- 
+        return self._results(processes)
+
+    def _do_strace_streamed(self, args, kwargs, fifoname):
+        """ Run strace on given command args/kwargs, sending output to the
+            FIFO fifoname which is parsed by another thread as it's written.
+            Return (status code, list of dependencies, list of outputs). """
+        shell_keywords = dict(silent=False)
+        shell_keywords.update(kwargs)
+        self.status = 0
+        self._root_pid = None
+        processes  = {}  # dictionary of processes (key = pid)
+        unfinished = {}  # list of interrupted entries in strace log
+        log = {'lines': 0, 'error': None}
+        # opening read-write doesn't block waiting for a writer, and keeps
+        # the FIFO from seeing end of file until we write _end_of_log
+        fd = os.open(fifoname, os.O_RDWR)
+        try:
+            parse_line = lambda line: self._match_line(line, processes, unfinished)
+            parser = threading.Thread(target=_read_log,
+                                      args=(fd, parse_line, log))
+            parser.daemon = True
+            parser.start()
+            try:
+                shell('strace', '-fo', fifoname, self.strace_options, '-e',
+                      'trace=' + self.strace_system_calls,
+                      args, **shell_keywords)
+            except ExecutionError, e:
+                error = e
+            else:
+                error = None
+            finally:
+                # strace has exited so the whole log is in the FIFO
+                os.write(fd, _end_of_log)
+                parser.join()
+        finally:
+            os.close(fd)
+
+        # if strace failed to run, re-throw the exception
+        # we can tell this happend if there was no log
+        if error is not None and not log['lines']:
+            raise error
+        if log['error'] is not None:
+            raise log['error'][0], log['error'][1], log['error'][2]
+        return self._results(processes)
+
+    def _results(self, processes):
+        """ Return (status code, list of dependencies, list of outputs) from
+            the processes parsed from a strace log. """
         # collect outputs and dependencies from all processes
         deps = set()
         outputs = set()
         for pid, process in processes.items():
-            deps = deps.union(process.deps)
-            outputs = outputs.union(process.outputs)
+            deps.update(process.deps)
+            outputs.update(process.outputs)
 
-        return self.status, list(deps), list(outputs)
+        # only check files exist once the command has finished with them
+        deps = [name for name in deps if os.path.lexists(name)]
+        outputs = [name for name in outputs if os.path.lexists(name)]
+        return self.status, deps, outputs
         
     def _match_line(self, line, processes, unfinished):
         # look for split lines
-        unfinished_start_match = self._unfinished_start_re.match(line)
-        unfinished_end_match = self._unfinished_end_re.match(line)
-        if unfinished_start_match:
-            pid = unfinished_start_match.group('pid')
-            body = unfinished_start_match.group('body')
-            unfinished[pid] = pid + ' ' + body
-            return
-        elif unfinished_end_match:
-            pid = unfinished_end_match.group('pid')
-            body = unfinished_end_match.group('body')
-            line = unfinished[pid] + body
-            del unfinished[pid]
-
-        is_output = False
-        open_match = self._open_re.match(line)
-        stat_match = self._stat_re.match(line)
-        execve_match = self._execve_re.match(line)
-        creat_match = self._creat_re.match(line)
-        mkdir_match = self._mkdir_re.match(line)
-        symlink_match = self._symlink_re.match(line)
-        rename_match = self._rename_re.match(line)
-        clone_match = self._clone_re.match(line)  
-
-        kill_match = self._kill_re.match(line)
-        if kill_match:
-            return None, None, None
-
-        match = None
-        if execve_match:
-            pid = execve_match.group('pid')
-            match = execve_match # Executables can be dependencies
-            if pid not in processes and len(processes) == 0:
-                # This is the first process so create dict entry
-                processes[pid] = StraceProcess()
-        elif clone_match:
-            pid = clone_match.group('pid')
-            pid_clone = clone_match.group('pid_clone')
+        if line.rstrip('\n').endswith('<unfinished ...>'):
+            unfinished_start_match = self._unfinished_start_re.match(line)
+            if unfinished_start_match:
+                pid = unfinished_start_match.group('pid')
+                body = unfinished_start_match.group('body')
+                unfinished[pid] = pid + ' ' + body
+                return
+        elif '<... ' in line:
+            unfinished_end_match = self._unfinished_end_re.match(line)
+            if unfinished_end_match:
+                pid = unfinished_end_match.group('pid')
+                body = unfinished_end_match.group('body')
+                if pid not in unfinished:
+                    return          # start wasn't logged, as with strace -z
+                line = unfinished[pid] + body
+                del unfinished[pid]
+
+        match = self._syscall_re.match(line)
+        if match:
+            handler = self._syscall_handlers.get(match.group('call'))
+            if handler is not None:
+                handler(self, match.group('pid'), match.group('args'), line,
+                        processes, unfinished)
+        elif '+++' in line:
+            match = self._exited_re.match(line)
+            if match and match.group('pid') == self._root_pid:
+                # the exit status of the command is that of its first
+                # process, or None if it was killed
+                status = match.group('status')
+                self.status = int(status) if status is not None else None
+
+    def _add_file(self, pid, name, is_output, line, processes):
+        """ Add name as a dependency or output of process pid, if relevant. """
+        if not self._matching_is_delayed(processes, pid, line):
+            cwd = processes[pid].cwd
+            key = (cwd, name)
+            try:
+                name, relevant = self._paths[key]
+            except KeyError:
+                name, relevant = self._paths[key] = self._check_path(cwd, name)
+            if not relevant:
+                return
+            if is_output:
+                processes[pid].add_output(name)
+            else:
+                processes[pid].add_dep(name)
+
+    def _match_open(self, pid, args, line, processes, unfinished):
+        match = self._open_re.match(args)
+        if match:
+            mode = match.group('mode')
+            # it's an output file if opened for writing
+            is_output = 'O_WRONLY' in mode or 'O_RDWR' in mode
+            self._add_file(pid, match.group('name'), is_output, line, processes)
+
+    def _match_dep(self, pid, args, line, processes, unfinished):
+        match = self._path_re.match(args)
+        if match:
+            self._add_file(pid, match.group('name'), False, line, processes)
+
+    def _match_dep_at(self, pid, args, line, processes, unfinished):
+        match = self._at_re.match(args)
+        if match and match.group('name'):
+            self._add_file(pid, self._at_name(match), False, line, processes)
+
+    def _match_openat(self, pid, args, line, processes, unfinished):
+        match = self._openat_re.match(args)
+        if match:
+            mode = match.group('mode')
+            # it's an output file if opened for writing
+            is_output = 'O_WRONLY' in mode or 'O_RDWR' in mode
+            self._add_file(pid, self._at_name(match), is_output, line, processes)
+
+    def _at_name(self, match):
+        """ Return the path name from a match of an *at() call's directory
+            file descriptor and path name. """
+        name = match.group('name')
+        if match.group('dir'):
+            name = os.path.join(match.group('dir'), name)
+        return name
+
+    def _match_execve(self, pid, args, line, processes, unfinished):
+        match = self._path_re.match(args)
+        if match:
+            self._start_process(pid, processes)
+            # Executables can be dependencies
+            self._add_file(pid, match.group('name'), False, line, processes)
+
+    def _match_execveat(self, pid, args, line, processes, unfinished):
+        match = self._at_re.match(args)
+        if match:
+            self._start_process(pid, processes)
+            self._add_file(pid, self._at_name(match), False, line, processes)
+
+    def _start_process(self, pid, processes):
+        """ Start the first process in the log at its first exec. """
+        if pid not in processes and len(processes) == 0:
+            # This is the first process so create dict entry
+            processes[pid] = StraceProcess()
+            self._root_pid = pid
+
+    def _match_creat(self, pid, args, line, processes, unfinished):
+        match = self._path_re.match(args)
+        if match:
+            # a created file is an output file
+            self._add_file(pid, match.group('name'), True, line, processes)
+
+    def _match_mkdir(self, pid, args, line, processes, unfinished):
+        match = self._mkdir_re.match(args)
+        if match:
+            # a created directory is an output file
+            is_output = match.group('result') == '0'
+            self._add_file(pid, match.group('name'), is_output, line, processes)
+
+    def _match_mkdirat(self, pid, args, line, processes, unfinished):
+        match = self._mkdirat_re.match(args)
+        if match:
+            # a created directory is an output file
+            is_output = match.group('result') == '0'
+            self._add_file(pid, self._at_name(match), is_output, line, processes)
+
+    def _match_second_path(self, pid, args, line, processes, unfinished):
+        match = self._second_path_re.match(args)
+        if match:
+            # the created symlink or destination of a rename is an output file
+            self._add_file(pid, match.group('name'), True, line, processes)
+
+    def _match_renameat(self, pid, args, line, processes, unfinished):
+        match = self._renameat_re.match(args)
+        if match:
+            # the destination of a rename is an output file
+            self._add_file(pid, self._at_name(match), True, line, processes)
+
+    def _match_symlinkat(self, pid, args, line, processes, unfinished):
+        match = self._symlinkat_re.match(args)
+        if match:
+            # the created symlink is an output file
+            self._add_file(pid, self._at_name(match), True, line, processes)
+
+    def _match_clone(self, pid_clone, args, line, processes, unfinished):
+        match = self._clone_re.match(args)
+        if match:
+            pid = match.group('pid')
             if pid not in processes:
                 # Simple case where there are no delayed lines
                 processes[pid] = StraceProcess(processes[pid_clone].cwd)
@@ -621,67 +2166,45 @@ class StraceRunner(Runner):
                     # Process all the delayed lines
                     self._match_line(delayed_line, processes, unfinished) 
                 processes[pid].delayed_lines = [] # Clear the lines
-        elif open_match:
-            match = open_match
-            mode = match.group('mode')
-            if 'O_WRONLY' in mode or 'O_RDWR' in mode:
-                # it's an output file if opened for writing
-                is_output = True
-        elif stat_match:
-            match = stat_match
-        elif creat_match:
-            match = creat_match
-            # a created file is an output file
-            is_output = True
-        elif mkdir_match:
-            match = mkdir_match
-            if match.group('result') == '0':
-                # a created directory is an output file
-                is_output = True
-        elif symlink_match:
-            match =  symlink_match                  
-            # the created symlink is an output file
-            is_output = True
-        elif rename_match:
-            match = rename_match
-            # the destination of a rename is an output file
-            is_output = True
-            
-        if match:
-            name = match.group('name')
-            pid  = match.group('pid')
-            if not self._matching_is_delayed(processes, pid, line):
-                cwd = processes[pid].cwd
-                if cwd != '.':
-                    name = os.path.join(cwd, name)
-
-                # normalise path name to ensure files are only listed once
-                name = os.path.normpath(name)
-
-                # if it's an absolute path name under the build directory,
-                # make it relative to build_dir before saving to .deps file
-                if os.path.isabs(name) and name.startswith(self.build_dir):
-                    name = name[len(self.build_dir):]
-                    name = name.lstrip(os.path.sep)
-
-                if (self._builder._is_relevant(name) 
-                    and not self.ignore(name) 
-                    and os.path.lexists(name)):
-                    if is_output:
-                        processes[pid].add_output(name)
-                    else:
-                        processes[pid].add_dep(name)
-
-        match = self._chdir_re.match(line)
+
+    def _match_chdir(self, pid, args, line, processes, unfinished):
+        match = self._chdir_re.match(args)
         if match:
-            pid  = match.group('pid')
             if not self._matching_is_delayed(processes, pid, line):
                 processes[pid].cwd = os.path.join(processes[pid].cwd, match.group('cwd'))
 
-        match = self._exit_group_re.match(line)
+    def _match_fchdir(self, pid, args, line, processes, unfinished):
+        # only has a path with strace -y
+        match = self._fchdir_re.match(args)
         if match:
+            if not self._matching_is_delayed(processes, pid, line):
+                processes[pid].cwd = match.group('cwd')
+
+    def _match_exit_group(self, pid, args, line, processes, unfinished):
+        match = self._exit_group_re.match(args)
+        if match and pid == self._root_pid:
+            # the exit status of the command is that of its first process
             self.status = int(match.group('status'))
 
+    # Map of system call name to the method that handles its lines
+    _syscall_handlers = {
+        'open': _match_open, 'openat': _match_openat,
+        'stat': _match_dep, 'stat64': _match_dep,
+        'lstat': _match_dep, 'lstat64': _match_dep,
+        'newfstatat': _match_dep_at, 'fstatat64': _match_dep_at,
+        'statx': _match_dep_at,
+        'execve': _match_execve, 'execveat': _match_execveat,
+        'creat': _match_creat,
+        'mkdir': _match_mkdir, 'mkdirat': _match_mkdirat,
+        'rename': _match_second_path,
+        'renameat': _match_renameat, 'renameat2': _match_renameat,
+        'symlink': _match_second_path, 'symlinkat': _match_symlinkat,
+        'clone': _match_clone, 'clone3': _match_clone,
+        'fork': _match_clone, 'vfork': _match_clone,
+        'chdir': _match_chdir, 'fchdir': _match_fchdir,
+        'exit_group': _match_exit_group,
+        }
+
     def _matching_is_delayed(self, processes, pid, line):
         # Check if matching is delayed and cache a delayed line
         if pid not in processes:
@@ -694,11 +2217,9 @@ class StraceRunner(Runner):
         else:
             return False
             
-    def __call__(self, *args, **kwargs):
-        """ Run command and return its dependencies and outputs, using strace
-            to determine dependencies (by looking at what files are opened or
-            modified). """
-        ignore_status = kwargs.pop('ignore_status', False)
+    def _strace_to_file(self, args, kwargs):
+        """ Run strace on given command args/kwargs, sending output to a temp
+            file (or a kept strace log) parsed after the command exits. """
         if self.keep_temps:
             outname = 'strace%03d.txt' % self.temp_count
             self.temp_count += 1
@@ -713,22 +2234,712 @@ class StraceRunner(Runner):
                 os.close(handle)
                 raise
             try:
-                status, deps, outputs = self._do_strace(args, kwargs, outfile, outname)
-                if status is None:
-                    raise ExecutionError(
-                        '%r was killed unexpectedly' % args[0], '', -1)
+                return self._do_strace(args, kwargs, outfile, outname)
             finally:
                 outfile.close()
         finally:
             if not self.keep_temps:
                 os.remove(outname)
 
+    def __call__(self, *args, **kwargs):
+        """ Run command and return its dependencies and outputs, using strace
+            to determine dependencies (by looking at what files are opened or
+            modified). """
+        ignore_status = kwargs.pop('ignore_status', False)
+        self._check_paths_memo()
+        if self.stream_log and not self.keep_temps:
+            tempdir = tempfile.mkdtemp()
+            fifoname = os.path.join(tempdir, 'strace')
+            try:
+                os.mkfifo(fifoname)
+                status, deps, outputs = self._do_strace_streamed(args, kwargs, fifoname)
+            finally:
+                if os.path.exists(fifoname):
+                    os.remove(fifoname)
+                os.rmdir(tempdir)
+        else:
+            status, deps, outputs = self._strace_to_file(args, kwargs)
+        if status is None:
+            raise ExecutionError(
+                '%r was killed unexpectedly' % args[0], '', -1)
+
         if status and not ignore_status:
             raise ExecutionError('%r exited with status %d'
                                  % (os.path.basename(args[0]), status),
                                  '', status)
         return list(deps), list(outputs)
 
+# Source of the LD_PRELOAD library PreloadRunner uses
+_preload_source = r'''/* fabricate LD_PRELOAD library: log files opened, stat'ed, created and
+   renamed to the FIFO named by $FABRICATE_PRELOAD_LOG as lines of
+   "<r|w> <absolute path>", r for dependencies and w for outputs */
+#define _GNU_SOURCE
+#include <dlfcn.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <spawn.h>
+#include <stdarg.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/syscall.h>
+#include <unistd.h>
+
+struct stat;
+struct stat64;
+struct statx;
+
+static int log_fd = -1;
+
+static void log_open(void)
+{
+    const char *name = getenv("FABRICATE_PRELOAD_LOG");
+    int fd;
+    if (!name)
+        return;
+    fd = syscall(SYS_openat, AT_FDCWD, name, O_WRONLY | O_CLOEXEC);
+    if (fd < 0)
+        return;
+    /* keep well clear of the low fds programs expect to manage */
+    log_fd = fcntl(fd, F_DUPFD_CLOEXEC, 500);
+    if (log_fd < 0)
+        log_fd = fd;
+    else
+        close(fd);
+}
+
+__attribute__((constructor)) static void init(void)
+{
+    log_open();
+}
+
+/* log path, relative to directory fd dirfd, as a dependency or output */
+static void log_path(char kind, int dirfd, const char *path)
+{
+    char line[PIPE_BUF];
+    size_t n = 2, len;
+    int saved_errno = errno;
+    if (log_fd < 0 || !path || !*path)
+        return;
+    line[0] = kind;
+    line[1] = ' ';
+    if (path[0] != '/') {
+        if (dirfd == AT_FDCWD) {
+            if (!getcwd(line + n, sizeof(line) - n))
+                goto out;
+        } else {
+            char proc[64];
+            ssize_t r;
+            snprintf(proc, sizeof(proc), "/proc/self/fd/%d", dirfd);
+            r = readlink(proc, line + n, sizeof(line) - n - 1);
+            if (r < 0)
+                goto out;
+            line[n + r] = '\0';
+        }
+        n += strlen(line + n);
+        if (n < sizeof(line))
+            line[n++] = '/';
+    }
+    len = strlen(path);
+    if (n + len + 1 > sizeof(line))
+        goto out;               /* only whole lines are written atomically */
+    memcpy(line + n, path, len);
+    n += len;
+    line[n++] = '\n';
+    write(log_fd, line, n);
+out:
+    errno = saved_errno;
+}
+
+/* find the function name this library stands in front of, or fail with
+   ENOSYS returning failed if there's none */
+#define REAL(name, failed) \
+    static __typeof__(name) *real_##name; \
+    if (!real_##name) \
+        real_##name = (__typeof__(name) *)dlsym(RTLD_NEXT, #name); \
+    if (!real_##name) { \
+        errno = ENOSYS; \
+        return failed; \
+    }
+
+static char open_kind(int flags)
+{
+    return (flags & O_ACCMODE) == O_RDONLY ? 'r' : 'w';
+}
+
+#define OPEN_MODE(flags) \
+    mode_t mode = 0; \
+    if (flags & (O_CREAT | O_TMPFILE)) { \
+        va_list ap; \
+        va_start(ap, flags); \
+        mode = va_arg(ap, mode_t); \
+        va_end(ap); \
+    }
+
+int open(const char *path, int flags, ...)
+{
+    int fd;
+    OPEN_MODE(flags);
+    REAL(open, -1);
+    fd = real_open(path, flags, mode);
+    if (fd >= 0)
+        log_path(open_kind(flags), AT_FDCWD, path);
+    return fd;
+}
+
+int open64(const char *path, int flags, ...)
+{
+    int fd;
+    OPEN_MODE(flags);
+    REAL(open64, -1);
+    fd = real_open64(path, flags, mode);
+    if (fd >= 0)
+        log_path(open_kind(flags), AT_FDCWD, path);
+    return fd;
+}
+
+int openat(int dirfd, const char *path, int flags, ...)
+{
+    int fd;
+    OPEN_MODE(flags);
+    REAL(openat, -1);
+    fd = real_openat(dirfd, path, flags, mode);
+    if (fd >= 0)
+        log_path(open_kind(flags), dirfd, path);
+    return fd;
+}
+
+int openat64(int dirfd, const char *path, int flags, ...)
+{
+    int fd;
+    OPEN_MODE(flags);
+    REAL(openat64, -1);
+    fd = real_openat64(dirfd, path, flags, mode);
+    if (fd >= 0)
+        log_path(open_kind(flags), dirfd, path);
+    return fd;
+}
+
+int creat(const char *path, mode_t mode)
+{
+    int fd;
+    REAL(creat, -1);
+    fd = real_creat(path, mode);
+    if (fd >= 0)
+        log_path('w', AT_FDCWD, path);
+    return fd;
+}
+
+int creat64(const char *path, mode_t mode)
+{
+    int fd;
+    REAL(creat64, -1);
+    fd = real_creat64(path, mode);
+    if (fd >= 0)
+        log_path('w', AT_FDCWD, path);
+    return fd;
+}
+
+static char fopen_kind(const char *mode)
+{
+    return strpbrk(mode, "wa+") ? 'w' : 'r';
+}
+
+FILE *fopen(const char *path, const char *mode)
+{
+    FILE *f;
+    REAL(fopen, NULL);
+    f = real_fopen(path, mode);
+    if (f)
+        log_path(fopen_kind(mode), AT_FDCWD, path);
+    return f;
+}
+
+FILE *fopen64(const char *path, const char *mode)
+{
+    FILE *f;
+    REAL(fopen64, NULL);
+    f = real_fopen64(path, mode);
+    if (f)
+        log_path(fopen_kind(mode), AT_FDCWD, path);
+    return f;
+}
+
+FILE *freopen(const char *path, const char *mode, FILE *stream)
+{
+    FILE *f;
+    REAL(freopen, NULL);
+    f = real_freopen(path, mode, stream);
+    if (f)
+        log_path(fopen_kind(mode), AT_FDCWD, path);
+    return f;
+}
+
+FILE *freopen64(const char *path, const char *mode, FILE *stream)
+{
+    FILE *f;
+    REAL(freopen64, NULL);
+    f = real_freopen64(path, mode, stream);
+    if (f)
+        log_path(fopen_kind(mode), AT_FDCWD, path);
+    return f;
+}
+
+/* stat and friends: functions in newer C libraries, and __xstat and
+   friends that older ones' inline stat()s call */
+#define STAT(name, type) \
+    int name(const char *path, type *buf) \
+    { \
+        int r; \
+        REAL(name, -1); \
+        r = real_##name(path, buf); \
+        if (r == 0) \
+            log_path('r', AT_FDCWD, path); \
+        return r; \
+    }
+#define XSTAT(name, type) \
+    int name(int ver, const char *path, type *buf) \
+    { \
+        int r; \
+        REAL(name, -1); \
+        r = real_##name(ver, path, buf); \
+        if (r == 0) \
+            log_path('r', AT_FDCWD, path); \
+        return r; \
+    }
+
+int stat(const char *, struct stat *);
+int stat64(const char *, struct stat64 *);
+int lstat(const char *, struct stat *);
+int lstat64(const char *, struct stat64 *);
+int __xstat(int, const char *, struct stat *);
+int __xstat64(int, const char *, struct stat64 *);
+int __lxstat(int, const char *, struct stat *);
+int __lxstat64(int, const char *, struct stat64 *);
+STAT(stat, struct stat)
+STAT(stat64, struct stat64)
+STAT(lstat, struct stat)
+STAT(lstat64, struct stat64)
+XSTAT(__xstat, struct stat)
+XSTAT(__xstat64, struct stat64)
+XSTAT(__lxstat, struct stat)
+XSTAT(__lxstat64, struct stat64)
+
+int fstatat(int, const char *, struct stat *, int);
+int fstatat64(int, const char *, struct stat64 *, int);
+int __fxstatat(int, int, const char *, struct stat *, int);
+int __fxstatat64(int, int, const char *, struct stat64 *, int);
+
+int fstatat(int dirfd, const char *path, struct stat *buf, int flags)
+{
+    int r;
+    REAL(fstatat, -1);
+    r = real_fstatat(dirfd, path, buf, flags);
+    if (r == 0)
+        log_path('r', dirfd, path);
+    return r;
+}
+
+int fstatat64(int dirfd, const char *path, struct stat64 *buf, int flags)
+{
+    int r;
+    REAL(fstatat64, -1);
+    r = real_fstatat64(dirfd, path, buf, flags);
+    if (r == 0)
+        log_path('r', dirfd, path);
+    return r;
+}
+
+int __fxstatat(int ver, int dirfd, const char *path, struct stat *buf,
+               int flags)
+{
+    int r;
+    REAL(__fxstatat, -1);
+    r = real___fxstatat(ver, dirfd, path, buf, flags);
+    if (r == 0)
+        log_path('r', dirfd, path);
+    return r;
+}
+
+int __fxstatat64(int ver, int dirfd, const char *path, struct stat64 *buf,
+                 int flags)
+{
+    int r;
+    REAL(__fxstatat64, -1);
+    r = real___fxstatat64(ver, dirfd, path, buf, flags);
+    if (r == 0)
+        log_path('r', dirfd, path);
+    return r;
+}
+
+int statx(int, const char *, int, unsigned int, struct statx *);
+
+int statx(int dirfd, const char *path, int flags, unsigned int mask,
+          struct statx *buf)
+{
+    int r;
+    REAL(statx, -1);
+    r = real_statx(dirfd, path, flags, mask, buf);
+    if (r == 0)
+        log_path('r', dirfd, path);
+    return r;
+}
+
+/* log a program about to be run: exec doesn't return if it works, so only
+   programs that exist are logged, not each place a shell tries in $PATH */
+static void log_exec(const char *path)
+{
+    if (path && access(path, F_OK) == 0)
+        log_path('r', AT_FDCWD, path);
+}
+
+int execve(const char *path, char *const argv[], char *const envp[])
+{
+    REAL(execve, -1);
+    log_exec(path);
+    return real_execve(path, argv, envp);
+}
+
+int execv(const char *path, char *const argv[])
+{
+    REAL(execv, -1);
+    log_exec(path);
+    return real_execv(path, argv);
+}
+
+/* log the program execvp() and execvpe() would run from $PATH */
+static void log_program(const char *file)
+{
+    const char *dirs = getenv("PATH");
+    char path[PATH_MAX];
+    if (strchr(file, '/')) {
+        log_exec(file);
+        return;
+    }
+    if (!dirs)
+        dirs = "/bin:/usr/bin";
+    while (*dirs) {
+        size_t len = strcspn(dirs, ":");
+        if (len && len + strlen(file) + 2 <= sizeof(path)) {
+            memcpy(path, dirs, len);
+            path[len] = '/';
+            strcpy(path + len + 1, file);
+            if (access(path, X_OK) == 0) {
+                log_path('r', AT_FDCWD, path);
+                return;
+            }
+        }
+        dirs += len;
+        if (*dirs == ':')
+            dirs++;
+    }
+}
+
+int execvp(const char *file, char *const argv[])
+{
+    REAL(execvp, -1);
+    log_program(file);
+    return real_execvp(file, argv);
+}
+
+int execvpe(const char *file, char *const argv[], char *const envp[])
+{
+    REAL(execvpe, -1);
+    log_program(file);
+    return real_execvpe(file, argv, envp);
+}
+
+int posix_spawn(pid_t *pid, const char *path,
+                const posix_spawn_file_actions_t *actions,
+                const posix_spawnattr_t *attr,
+                char *const argv[], char *const envp[])
+{
+    int r;
+    REAL(posix_spawn, ENOSYS);
+    r = real_posix_spawn(pid, path, actions, attr, argv, envp);
+    if (r == 0)
+        log_path('r', AT_FDCWD, path);
+    return r;
+}
+
+int posix_spawnp(pid_t *pid, const char *file,
+                 const posix_spawn_file_actions_t *actions,
+                 const posix_spawnattr_t *attr,
+                 char *const argv[], char *const envp[])
+{
+    int r;
+    REAL(posix_spawnp, ENOSYS);
+    r = real_posix_spawnp(pid, file, actions, attr, argv, envp);
+    if (r == 0)
+        log_program(file);
+    return r;
+}
+
+int mkdir(const char *, mode_t);
+int mkdirat(int, const char *, mode_t);
+
+int mkdir(const char *path, mode_t mode)
+{
+    int r;
+    REAL(mkdir, -1);
+    r = real_mkdir(path, mode);
+    if (r == 0)
+        log_path('w', AT_FDCWD, path);
+    return r;
+}
+
+int mkdirat(int dirfd, const char *path, mode_t mode)
+{
+    int r;
+    REAL(mkdirat, -1);
+    r = real_mkdirat(dirfd, path, mode);
+    if (r == 0)
+        log_path('w', dirfd, path);
+    return r;
+}
+
+int rename(const char *old, const char *new)
+{
+    int r;
+    REAL(rename, -1);
+    r = real_rename(old, new);
+    if (r == 0)
+        log_path('w', AT_FDCWD, new);
+    return r;
+}
+
+int renameat(int olddirfd, const char *old, int newdirfd, const char *new)
+{
+    int r;
+    REAL(renameat, -1);
+    r = real_renameat(olddirfd, old, newdirfd, new);
+    if (r == 0)
+        log_path('w', newdirfd, new);
+    return r;
+}
+
+int renameat2(int, const char *, int, const char *, unsigned int);
+
+int renameat2(int olddirfd, const char *old, int newdirfd, const char *new,
+              unsigned int flags)
+{
+    int r;
+    REAL(renameat2, -1);
+    r = real_renameat2(olddirfd, old, newdirfd, new, flags);
+    if (r == 0)
+        log_path('w', newdirfd, new);
+    return r;
+}
+
+int symlink(const char *target, const char *path)
+{
+    int r;
+    REAL(symlink, -1);
+    r = real_symlink(target, path);
+    if (r == 0)
+        log_path('w', AT_FDCWD, path);
+    return r;
+}
+
+int symlinkat(const char *target, int dirfd, const char *path)
+{
+    int r;
+    REAL(symlinkat, -1);
+    r = real_symlinkat(target, dirfd, path);
+    if (r == 0)
+        log_path('w', dirfd, path);
+    return r;
+}
+'''
+
+class PreloadRunner(Runner):
+    """ Runner that finds dependencies and outputs using an LD_PRELOAD
+        library, compiled into cache_dir() on first use, which logs the
+        files commands open, stat, execute, create and rename to a FIFO.
+        It costs far less per command than strace, but can't see into
+        statically linked or setuid programs, so SmartRunner doesn't pick
+        it: use Builder(runner='preload_runner') to. """
+    parallel_safe = True
+
+    def __init__(self, builder, build_dir=None):
+        self.library = PreloadRunner.get_library()
+        if self.library is None:
+            raise RunnerUnsupportedException(
+                'LD_PRELOAD library could not be built')
+        self._builder = builder
+        self.build_dir = os.path.abspath(build_dir or os.getcwd())
+        # normalised name -> (normalised name, relevant) for each path seen
+        self._paths = {}
+
+    def __getstate__(self):
+        """ The path cache isn't sent along with each parallel job. """
+        state = self.__dict__.copy()
+        state['_paths'] = {}
+        return state
+
+    @staticmethod
+    def get_library():
+        """ Return the filename of the LD_PRELOAD library, compiling it with
+            cc into cache_dir() if it isn't there yet, or None if it can't
+            be built here. """
+        if platform.system() != 'Linux' or not hasattr(os, 'mkfifo'):
+            return None
+        library = os.path.join(cache_dir(), 'preload-%s.so'
+                               % md5func(_preload_source).hexdigest()[:16])
+        if os.path.exists(library):
+            return library
+        if ' ' in library or ':' in library:
+            return None         # can't be listed in LD_PRELOAD
+        try:
+            if not os.path.isdir(cache_dir()):
+                os.makedirs(cache_dir())
+            handle, tempname = tempfile.mkstemp(suffix='.so', dir=cache_dir())
+            os.close(handle)
+            try:
+                shell('cc', '-shared', '-fPIC', '-O2', '-o', tempname,
+                      '-x', 'c', '-', '-ldl', input=_preload_source)
+                # rename so concurrent builds never see a partial library
+                os.rename(tempname, library)
+            finally:
+                if os.path.exists(tempname):
+                    os.remove(tempname)
+        except (OSError, ExecutionError):
+            return None
+        return library
+
+    def _add_file(self, line, deps, outputs):
+        """ Add the file in a "r name" or "w name" log line to deps or
+            outputs if it's relevant. """
+        name = line[2:]
+        try:
+            name, relevant = self._paths[name]
+        except KeyError:
+            name, relevant = self._paths[name] = self._check_path('.', name)
+        if relevant:
+            if line[0] == 'w':
+                outputs.add(name)
+            else:
+                deps.add(name)
+
+    def __call__(self, *args, **kwargs):
+        """ Run command and return its dependencies and outputs, using an
+            LD_PRELOAD library to log the files it uses. """
+        self._check_paths_memo()
+        shell_keywords = dict(silent=False)
+        shell_keywords.update(kwargs)
+        env = dict(shell_keywords.get('env') or os.environ)
+        env['LD_PRELOAD'] = ' '.join([self.library] +
+                                     env.get('LD_PRELOAD', '').split())
+        shell_keywords['env'] = env
+
+        deps = set()
+        outputs = set()
+        log = {'lines': 0, 'error': None}
+        tempdir = tempfile.mkdtemp()
+        fifoname = os.path.join(tempdir, 'log')
+        try:
+            os.mkfifo(fifoname)
+            env['FABRICATE_PRELOAD_LOG'] = fifoname
+            # opening read-write doesn't block waiting for a writer, and
+            # keeps the FIFO from seeing end of file until we write
+            # _end_of_log, however many processes open and close it
+            fd = os.open(fifoname, os.O_RDWR)
+            try:
+                parse_line = lambda line: self._add_file(line, deps, outputs)
+                parser = threading.Thread(target=_read_log,
+                                          args=(fd, parse_line, log))
+                parser.daemon = True
+                parser.start()
+                try:
+                    shell(args, **shell_keywords)
+                finally:
+                    # the command has exited so the whole log is in the FIFO
+                    os.write(fd, _end_of_log)
+                    parser.join()
+            finally:
+                os.close(fd)
+        finally:
+            if os.path.exists(fifoname):
+                os.remove(fifoname)
+            os.rmdir(tempdir)
+        if log['error'] is not None:
+            raise log['error'][0], log['error'][1], log['error'][2]
+
+        # only check files exist once the command has finished with them
+        deps = [name for name in deps if os.path.lexists(name)]
+        outputs = [name for name in outputs if os.path.lexists(name)]
+        return deps, outputs
+
+class DepfileRunner(Runner):
+    """ Runner for commands that write a make-style dependency file listing
+        the files they used, as gcc does given -MD -MF depfile. Builder.run()
+        uses it for commands given a "depfile" keyword arg, which is the name
+        of the dependency file. The dependencies and outputs are read from
+        it, so the command isn't traced at all. """
+    parallel_safe = True
+
+    def __init__(self, builder, build_dir=None):
+        self._builder = builder
+        self.build_dir = os.path.abspath(build_dir or os.getcwd())
+
+    # a file name, which may have spaces and #s escaped with backslashes
+    _depfile_token_re = re.compile(r'(?:\\[ #]|\S)+')
+
+    @staticmethod
+    def parse_depfile(text):
+        """ Return (targets, prerequisites) lists of the files named in the
+            text of a make-style dependency file. Targets of rules without
+            prerequisites (like those gcc -MP adds for headers) are left
+            out. """
+        targets = []
+        prerequisites = []
+        text = re.sub(r'\\\r?\n', ' ', text)
+        for line in text.splitlines():
+            names = [re.sub(r'\\([ #])', r'\1', token).replace('$$', '$')
+                     for token in DepfileRunner._depfile_token_re.findall(line)]
+            for i, name in enumerate(names):
+                if name.endswith(':'):
+                    break
+            else:
+                continue
+            rule_targets = names[:i] + [name[:-1]]
+            rule_prerequisites = names[i + 1:]
+            if rule_prerequisites:
+                targets.extend(target for target in rule_targets if target)
+                prerequisites.extend(rule_prerequisites)
+        return targets, prerequisites
+
+    def __call__(self, *args, **kwargs):
+        """ Run command, which must write the dependency file given by the
+            "depfile" keyword arg, and return the dependencies and outputs
+            listed in it. The dependency file is an output too. """
+        depfile = kwargs.pop('depfile')
+        shell_keywords = dict(silent=False)
+        shell_keywords.update(kwargs)
+        cwd = kwargs.get('cwd') or '.'
+        filename = os.path.join(cwd, depfile)
+        # so a dependency file from an earlier run is never read
+        if os.path.lexists(filename):
+            os.remove(filename)
+        shell(*args, **shell_keywords)
+        try:
+            with open(filename) as f:
+                targets, prerequisites = self.parse_depfile(f.read())
+        except IOError:
+            raise ExecutionError('%r did not write dependency file %r'
+                                 % (os.path.basename(args[0]), depfile),
+                                 '', 1)
+
+        deps = set()
+        outputs = set()
+        for names, files in ((prerequisites, deps), (targets + [depfile], outputs)):
+            for name in names:
+                name, relevant = self._check_path(cwd, name)
+                if relevant and os.path.lexists(name):
+                    files.add(name)
+        return list(deps), list(outputs)
+
 class AlwaysRunner(Runner):
     def __init__(self, builder):
         pass
@@ -746,13 +2957,14 @@ class SmartRunner(Runner):
         otherwise AtimesRunner if available, otherwise AlwaysRunner. """
     def __init__(self, builder):
         self._builder = builder
-        try:
-            self._runner = StraceRunner(self._builder)
-        except RunnerUnsupportedException:
+        for runner in (StraceRunner, AtimesRunner):
             try:
-                self._runner = AtimesRunner(self._builder)
+                self._runner = runner(self._builder)
+                break
             except RunnerUnsupportedException:
-                self._runner = AlwaysRunner(self._builder)
+                pass
+        else:
+            self._runner = AlwaysRunner(self._builder)
 
     def actual_runner(self):
         return self._runner
@@ -769,6 +2981,7 @@ class _running(object):
         self.async = async
         self.command = command
         self.results = None
+        self.restored = False   # True if its outputs came from the cache
         
 class _after(object):
     """ Represents something waiting on completion of some previous commands """
@@ -779,6 +2992,7 @@ class _after(object):
         self.afters = afters
         self.do = do
         self.done = False
+        self.released = False   # True once no longer waiting
         
 class _Groups(object):
     """ Thread safe mapping object whose values are lists of _running
@@ -844,6 +3058,8 @@ class _Groups(object):
     
     def get_ok(self, id):
         with self.lock:
+            if id not in self.groups:
+                return True
             return self.groups[id].ok
     
     def set_ok(self, id, to):
@@ -875,77 +3091,187 @@ class _Groups(object):
                 raise ValueError
             self.groups[id].count_in_false = c
 
-    
 # pool of processes to run parallel jobs, must not be part of any object that
-# is pickled for transfer to these processes, ie it must be global
+# is pickled for transfer to these processes, ie it must be global. It's only
+# started once a command needs running, with _pool_processes processes.
 _pool = None
+_pool_processes = 1
 # object holding results, must also be global
 _groups = _Groups()
 # results collecting thread
 _results = None
 _stop_results = threading.Event()
+# events for the results collecting thread: (group, _running, result) tuples
+# put by the pool as commands complete, new _after objects, or None to stop
+_events = Queue.Queue()
+# group id -> list of _after objects waiting on it, for the results handler
+_waiting = {}
+# build cache threads, which do the cache lookups and stores of parallel
+# builds so neither the main thread nor the results handler waits on the
+# cache. Lookups have threads of their own so they're never held up behind
+# the stores of outputs, or behind a lookup waiting on the network.
+_cache_lookup_threads = []
+_cacher = None
+# jobs for the lookup threads and the store thread: (function, args)
+# tuples, or None to stop a thread
+_cache_lookups = Queue.Queue()
+_cache_stores = Queue.Queue()
 
 class _todo(object):
     """ holds the parameters for commands waiting on others """
-    def __init__(self, group, command, arglist, kwargs):
+    def __init__(self, group, command, arglist, kwargs, echo=None):
         self.group = group      # which group it should run as
         self.command = command  # string command
         self.arglist = arglist  # command arguments
         self.kwargs = kwargs    # keywork args for the runner
-        
-def _results_handler( builder, delay=0.01):
+        self.echo = echo        # what to display when the command is run
+
+def _start(group, command, arglist, kwargs, blocked=False, builder=None):
+    """ Put a command on the parallel pool. Its result is delivered to the
+        results handler by the pool's callback when it completes. If
+        "builder" is given and has a build cache, a build cache lookup thread
+        first tries restoring the command's outputs from it instead. """
+    if _pool is None:
+        # the first command to run, found by after() on the main thread
+        _start_pool()
+    r = _running(None, command)
+    # add before starting so the group count includes it before completion
+    if blocked:
+        _groups.add_for_blocked(group, r)
+    else:
+        _groups.add(group, r)
+    if builder is not None and builder.cache is not None:
+        _cache_lookups.put((_restore_or_submit, (builder, group, r, arglist, kwargs)))
+    else:
+        _submit(group, r, arglist, kwargs)
+
+def _submit(group, r, arglist, kwargs):
+    """ Put the command of _running object r on the parallel pool. """
+    def completed(result):
+        _events.put((group, r, result))
+    r.async = _pool.apply_async(_call_strace, arglist, kwargs,
+                                callback=completed)
+
+def _restore_or_submit(builder, group, r, arglist, kwargs):
+    """ Restore the outputs of r's command from the build cache, delivering
+        them to the results handler as if it had run, or else put it on the
+        parallel pool. Run by a build cache lookup thread. """
+    try:
+        restored = builder._cache_fetch(r.command)
+    except Exception, e:
+        printerr('fabricate: cache restore failed: %r' % e)
+        restored = None
+    if restored is None:
+        _submit(group, r, arglist, kwargs)
+    else:
+        r.restored = True
+        _events.put((group, r, restored))
+
+def _cache_handler(jobs):
+    """ Body of a build cache thread, which does the jobs queued for it on
+        Queue jobs in turn until it's given None. """
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        function, args = job
+        try:
+            function(*args)
+        except Exception, e:
+            printerr('fabricate: build cache error: %r' % e)
+
+def _add_after(a):
+    """ Queue an _after object until the groups it waits on complete """
+    _groups.add(False, a)
+    _events.put(a)
+
+def _release(builder, a, no_error):
+    """ Do what the _after object "a" was waiting to do. Return the ids of
+        groups whose count of uncompleted items has changed. """
+    changed = [False]
+    if isinstance(a.do, _todo):
+        # the commands waited on may have changed this
+        # command's inputs, so only now check if it's out of date
+        if no_error and builder.cmdline_outofdate(a.do.command):
+            builder.echo_command(a.do.command, echo=a.do.echo)
+            _start(a.do.group, a.do.command, a.do.arglist, a.do.kwargs,
+                   blocked=True, builder=builder)
+        else:
+            r = _running(None, a.do.command)
+            _groups.add_for_blocked(a.do.group, r)
+            if no_error:
+                # Mark the command as done, it is up to date
+                r.results = (a.do.command, None, None)
+            else:
+                # Mark the command as not done due to errors
+                r.results = False
+                _groups.set_ok(a.do.group, False)
+            _groups.dec_count(a.do.group)
+            changed.append(a.do.group)
+    elif isinstance(a.do, threading._Condition):
+        # is this only for threading._Condition in after()?
+        a.do.acquire()
+        # only mark as done if there is no error
+        a.done = no_error
+        a.do.notify()
+        a.do.release()
+    # else: #are there other cases?
+    _groups.remove_item(False, a)
+    _groups.dec_count(False)
+    return changed
+
+def _handle_event(builder, event):
+    """ Handle an event of the results handler: store the results of a
+        command that has completed, or start waiting on the groups of a new
+        _after object. Then release the _after objects no longer waiting.
+        "builder" the builder used """
+    if isinstance(event, _after):
+        for id in event.afters:
+            _waiting.setdefault(id, []).append(event)
+        check = [event]
+    else:
+        id, r, result = event
+        if isinstance(result, Exception):
+            r.results = result
+            _groups.set_ok(id, False)
+            message, data, status = result
+            printerr("fabricate: " + message)
+        else:
+            d, o = result
+            # save deps, and store the outputs in the build cache
+            # unless they came from it
+            builder.done(r.command, d, o, cache=not r.restored)
+            r.results = (r.command, d, o)
+        _groups.dec_count(id)
+        check = _waiting.get(id, [])[:]
+    # check if can now schedule things waiting on the changed groups
+    while check:
+        a = check.pop(0)
+        if a.released:
+            continue
+        still_to_do = sum(_groups.get_count(g) for g in a.afters)
+        if False in a.afters:
+            still_to_do -= 1 # don't count yourself of course
+        if still_to_do == 0:
+            a.released = True
+            for g in a.afters:
+                _waiting[g].remove(a)
+            no_error = all(_groups.get_ok(g) for g in a.afters)
+            for g in _release(builder, a, no_error):
+                check.extend(_waiting.get(g, []))
+
+def _results_handler(builder):
     """ Body of thread that stores results in .deps and handles 'after'
-        conditions
+        conditions. It sleeps until a command completes or an 'after' is
+        added, and then only looks at the afters waiting on groups that
+        changed.
        "builder" the builder used """
     try:
         while not _stop_results.isSet():
-            # go through the lists and check any results available
-            for id in _groups.ids():
-                if id is False: continue # key of False is _afters not _runnings
-                for r in _groups.item_list(id):
-                    if r.results is None and r.async.ready():
-                        try:
-                            d, o = r.async.get()
-                        except Exception, e:
-                            r.results = e
-                            _groups.set_ok(id, False)
-                            message, data, status = e
-                            printerr("fabricate: " + message)
-                        else:
-                            builder.done(r.command, d, o) # save deps
-                            r.results = (r.command, d, o)
-                        _groups.dec_count(id)
-            # check if can now schedule things waiting on the after queue
-            for a in _groups.item_list(False):
-                still_to_do = sum(_groups.get_count(g) for g in a.afters)
-                no_error = all(_groups.get_ok(g) for g in a.afters)
-                if False in a.afters:
-                    still_to_do -= 1 # don't count yourself of course
-                if still_to_do == 0:
-                    if isinstance(a.do, _todo):
-                        if no_error:
-                            async = _pool.apply_async(_call_strace, a.do.arglist,
-                                        a.do.kwargs)
-                            _groups.add_for_blocked(a.do.group, _running(async, a.do.command))
-                        else:
-                            # Mark the command as not done due to errors
-                            r = _running(None, a.do.command)
-                            _groups.add_for_blocked(a.do.group, r)
-                            r.results = False;
-                            _groups.set_ok(a.do.group, False)
-                            _groups.dec_count(a.do.group)
-                    elif isinstance(a.do, threading._Condition):
-                        # is this only for threading._Condition in after()?
-                        a.do.acquire()
-                        # only mark as done if there is no error
-                        a.done = no_error 
-                        a.do.notify()
-                        a.do.release()
-                    # else: #are there other cases?
-                    _groups.remove_item(False, a)
-                    _groups.dec_count(False)
-                    
-            _stop_results.wait(delay)
+            event = _events.get()
+            if event is None:
+                break
+            _handle_event(builder, event)
     except Exception:
         etype, eval, etb = sys.exc_info()
         printerr("Error: exception " + repr(etype) + " at line " + str(etb.tb_lineno))
@@ -956,6 +3282,66 @@ def _results_handler( builder, delay=0.01):
             # Note: sys.exit() only kills me
             printerr("Error: unexpected results handler exit")
             os._exit(1)
+
+def _handle_events_here(builder, a):
+    """ Handle the events queued so far on the main thread, as the results
+        handler would, until the _after object "a" is released, returning
+        True. Used by after() while no command has needed running, so a
+        build with nothing to do never starts the pool or threads. Once a
+        command is put on the pool, or nothing is left to handle, it starts
+        the results handler to carry on, and returns False. """
+    while _pool is None:
+        try:
+            event = _events.get_nowait()
+        except Queue.Empty:
+            break
+        _handle_event(builder, event)
+        if a.released:
+            return True
+    _start_threads(builder)
+    return False
+
+def _start_pool():
+    """ Start the pool of processes that run parallel jobs. Only called on
+        the main thread before the results handler and build cache threads
+        start, as forking with other threads running can leave locks held
+        in the child processes. """
+    global _pool
+    _pool = _multiprocessing().Pool(_pool_processes)
+
+def _start_threads(builder):
+    """ Start the pool, if it isn't yet, and then the results handler and
+        build cache threads of "builder", if they aren't yet. Called on the
+        main thread once a command needs running. """
+    global _results, _cacher
+    if _results is not None:
+        return
+    if _pool is None:
+        _start_pool()
+    _results = threading.Thread(target=_results_handler, args=[builder])
+    _results.setDaemon(True)
+    _results.start()
+    if builder.cache is not None:
+        for i in range(builder.cache_lookup_threads):
+            thread = threading.Thread(target=_cache_handler,
+                                      args=[_cache_lookups])
+            thread.setDaemon(True)
+            thread.start()
+            _cache_lookup_threads.append(thread)
+        _cacher = threading.Thread(target=_cache_handler,
+                                   args=[_cache_stores])
+        _cacher.setDaemon(True)
+        _cacher.start()
+    atexit.register(builder._join_results_handler)
+
+def _stop_results_handler():
+    """ Tell the results handler thread to finish """
+    _stop_results.set()
+    _events.put(None)
+
+# held while a builder opens its shared HashCache, global as a builder with a
+# lock of its own couldn't be pickled for the parallel jobs
+_shared_hashes_lock = threading.Lock()
         
 class Builder(object):
     """ The Builder.
@@ -976,15 +3362,17 @@ class Builder(object):
 
     def __init__(self, runner=None, dirs=None, dirdepth=100, ignoreprefix='.',
                  ignore=None, hasher=md5_hasher, depsname='.deps',
-                 quiet=False, debug=False, inputs_only=False, parallel_ok=False):
+                 quiet=False, debug=False, inputs_only=False, parallel_ok=False,
+                 deps_store=None, stat_cache=True, shared_hash_cache=False,
+                 depfiles=False, cache=None):
         """ Initialise a Builder with the given options.
 
         "runner" specifies how programs should be run.  It is either a
             callable compatible with the Runner class, or a string selecting
             one of the standard runners ("atimes_runner", "strace_runner",
-            "always_runner", or "smart_runner").
+            "preload_runner", "always_runner", or "smart_runner").
         "dirs" is a list of paths to look for dependencies (or outputs) in
-            if using the strace or atimes runners.
+            if using the strace, preload or atimes runners.
         "dirdepth" is the depth to recurse into the paths in "dirs" (default
             essentially means infinitely). Set to 1 to just look at the
             immediate paths in "dirs" and not recurse at all. This can be
@@ -999,8 +3387,12 @@ class Builder(object):
             comments allowed -- use \ prefix to insert these characters)
         "hasher" is a function which returns a string which changes when
             the contents of its filename argument changes, or None on error.
-            Default is md5_hasher, but can also be mtime_hasher.
-        "depsname" is the name of the JSON dependency file to load/save.
+            Default is md5_hasher, but can also be mtime_hasher,
+            blake2_hasher, xxhash_hasher, or the name of one of these
+            ("md5", "mtime", and "blake2" or "xxhash" if available). The
+            dependency file records the hasher, and is started afresh if it
+            changes.
+        "depsname" is the name of the dependency file to load/save.
         "quiet" set to True tells the builder to not display the commands being
             executed (or other non-error output).
         "debug" set to True makes the builder print debug output, such as why
@@ -1009,6 +3401,33 @@ class Builder(object):
             have changed (ignores output hashes); use with tools that touch
             files that shouldn't cause a rebuild; e.g. g++ collect phase
         "parallel_ok" set to True to indicate script is safe for parallel running
+        "deps_store" is how the dependency file is stored: a DepsStore
+            subclass, or "json" (the default) or "sqlite", which only reads
+            and writes the entries of the commands checked and run, for big
+            builds. The sqlite store converts a JSON dependency file the
+            first time it opens it, but the JSON store can't read an sqlite
+            one, so everything is rebuilt after switching back.
+        "stat_cache" set to True (the default) makes the builder keep the
+            size, mtime and inode of each file it hashes in the dependency
+            file, and only hash the file again once one of those changes.
+            It is not used with mtime_hasher, which gains nothing from it.
+        "shared_hash_cache" set to True also keeps file hashes in a
+            HashCache shared by all builds on this host, found in
+            cache_dir(), or can be the filename of the HashCache to use.
+            Default is False. The --shared-hash-cache option of main()
+            sets it to True, and --no-shared-hash-cache to False.
+            Like stat_cache it is not used with mtime_hasher, and it needs
+            the sqlite3 module.
+        "depfiles" set to True runs commands given a "depfile" keyword arg
+            with DepfileRunner, taking their dependencies from the
+            dependency file they write rather than from the runner. Default
+            is False, which runs them with the runner as any other command.
+        "cache" is a BuildCache, or the directory or http:// URL of one, or
+            True for the directory in cache_dir() shared by the builds on
+            this host, to share command outputs between builds. A command whose inputs
+            match those of an earlier run of the same command line has its
+            outputs restored from the cache rather than being run. It isn't
+            used with mtime_hasher, as it needs content hashes.
         """
         if dirs is None:
             dirs = ['.']
@@ -1019,12 +3438,38 @@ class Builder(object):
             ignore = r'$x^'         # something that can't match
         self.ignore = re.compile(ignore, re.VERBOSE)
         self.depsname = depsname
+        if deps_store is None:
+            deps_store = 'json'
+        self.deps_store = self._deps_store_map.get(deps_store, deps_store)
+        if isinstance(hasher, basestring):
+            hasher = self._hasher_map[hasher]
         self.hasher = hasher
+        self.stat_cache = stat_cache and hasher is not mtime_hasher
+        if shared_hash_cache is True:
+            shared_hash_cache = os.path.join(cache_dir(), 'hashes.db')
+        if not shared_hash_cache or sqlite3 is None or hasher is mtime_hasher:
+            shared_hash_cache = None
+        self.shared_hash_cache = shared_hash_cache
+        self.depfiles = depfiles
+        self.depfile_runner = DepfileRunner(self)
+        if hasher is mtime_hasher:
+            cache = None
+        self.cache = build_cache(cache)
+        if self.cache is not None:
+            atexit.register(self.cache.close)
+        # command lines given to run() in this build, in order
+        self.commands = []
+        # program name -> its path on $PATH, for _program_hash()
+        self._program_paths = {}
         self.quiet = quiet
         self.debug = debug
+        self._command_echoed = False
         self.inputs_only = inputs_only
         self.checking = False
         self.hash_cache = {}
+        # dependency file entry last found up to date for each filename, so
+        # an entry shared by many commands is only compared once
+        self.unchanged = {}
 
         # instantiate runner after the above have been set in case it needs them
         if runner is not None:
@@ -1036,17 +3481,26 @@ class Builder(object):
         else:
             self.runner = SmartRunner(self)
 
-        is_strace = isinstance(self.runner.actual_runner(), StraceRunner)
-        self.parallel_ok = parallel_ok and is_strace and _pool is not None
+        parallel_safe = self.runner.actual_runner().parallel_safe
+        self.parallel_ok = parallel_ok and parallel_safe and \
+            (_pool is not None or _pool_processes > 1)
         if self.parallel_ok:
-            global _results
-            _results = threading.Thread(target=_results_handler,
-                                        args=[self])
-            _results.setDaemon(True)
-            _results.start()
-            atexit.register(self._join_results_handler)
+            # the pool and the threads are started once a command needs
+            # running, so a build with nothing to do needn't wait for them
             StraceRunner.keep_temps = False # unsafe for parallel execution
             
+    def __getstate__(self):
+        """ The runner and so the builder are pickled for each parallel job,
+            which doesn't need the dependency data or hash cache. """
+        state = self.__dict__.copy()
+        state.pop('_deps', None)
+        state.pop('_shared_hashes', None)
+        state['cache'] = None
+        state['commands'] = []
+        state['hash_cache'] = {}
+        state['unchanged'] = {}
+        return state
+
     def echo(self, message):
         """ Print message, but only if builder is not in quiet mode. """
         if not self.quiet:
@@ -1058,6 +3512,10 @@ class Builder(object):
         """
         if echo is not None:
             command = str(echo)
+        if self.debug and not self._command_echoed:
+            self.echo_debug('first command %.3fs after start'
+                            % (time.time() - start_time))
+        self._command_echoed = True
         self.echo(command)
 
     def echo_delete(self, filename, error=None):
@@ -1078,11 +3536,32 @@ class Builder(object):
         after = kwargs.pop('after', None)
         group = kwargs.pop('group', True)
         echo = kwargs.pop('echo', None)
+        runner = self.runner
+        if 'depfile' in kwargs:
+            if self.depfiles:
+                runner = self.depfile_runner
+            else:
+                del kwargs['depfile']
         arglist = args_to_list(args)
         if not arglist:
             raise TypeError('run() takes at least 1 argument (0 given)')
         # we want a command line string for the .deps file key and for display
         command = subprocess.list2cmdline(arglist)
+        self.commands.append(command)
+        if self.parallel_ok and after is not None and not self.checking:
+            # the commands waited on may produce this command's inputs, so
+            # the up-to-date check is deferred until they have finished
+            if not hasattr(after, '__iter__'):
+                after = [after]
+            arglist.insert(0, runner)
+            # This command is registered to False group firstly,
+            # but the actual group of this command should 
+            # count this blocked command as well as usual commands
+            _groups.inc_count_for_blocked(group)
+            _add_after(_after(after, _todo(group, command, arglist,
+                                           kwargs, echo)))
+            return None
+
         if not self.cmdline_outofdate(command):
             if self.parallel_ok:
                 _groups.ensure(group)
@@ -1098,23 +3577,15 @@ class Builder(object):
         # use runner to run command and collect dependencies
         self.echo_command(command, echo=echo)
         if self.parallel_ok:
-            arglist.insert(0, self.runner)
-            if after is not None:
-                if not hasattr(after, '__iter__'):
-                    after = [after]
-                # This command is registered to False group firstly,
-                # but the actual group of this command should 
-                # count this blocked command as well as usual commands
-                _groups.inc_count_for_blocked(group)
-                _groups.add(False,
-                            _after(after, _todo(group, command, arglist,
-                                                kwargs)))
-            else:
-                async = _pool.apply_async(_call_strace, arglist, kwargs)
-                _groups.add(group, _running(async, command))
+            arglist.insert(0, runner)
+            _start_threads(self)
+            _start(group, command, arglist, kwargs, builder=self)
             return None
         else:
-            deps, outputs = self.runner(*arglist, **kwargs)
+            restored = self.restore(command)
+            if restored is not None:
+                return restored
+            deps, outputs = runner(*arglist, **kwargs)
             return self.done(command, deps, outputs)
         
     def run(self, *args, **kwargs):
@@ -1125,10 +3596,17 @@ class Builder(object):
 
             Parallel operation keyword args "after" specifies a group or 
             iterable of groups to wait for after they finish, "group" specifies 
-            the group to add this command to.
+            the group to add this command to. A command with "after" is only
+            checked for changed dependencies once those groups are finished.
 
             Optional "echo" keyword arg is passed to echo_command() so you can
             override its output if you want.
+
+            Optional "depfile" keyword arg names a make-style dependency file
+            the command writes (for example with gcc -MD -MF depfile), which
+            is read for its dependencies in place of running it with the
+            builder's runner if the builder has depfiles set. See
+            DepfileRunner.
         """
         try:
             return self._run(*args, **kwargs)
@@ -1136,35 +3614,217 @@ class Builder(object):
             sys.stderr.flush()
             sys.stdout.flush()
 
-    def done(self, command, deps, outputs):
-        """ Store the results in the .deps file when they are available """
+    def done(self, command, deps, outputs, cache=True):
+        """ Store the results in the .deps file when they are available,
+            and the outputs in the build cache if "cache" is True """
         if deps is not None or outputs is not None:
             deps_dict = {}
 
             # hash the dependency inputs and outputs
             for dep in deps:
-                if dep in self.hash_cache:
-                    # already hashed so don't repeat hashing work
-                    hashed = self.hash_cache[dep]
-                else:
-                    hashed = self.hasher(dep)
+                hashed = self.hash(dep)
                 if hashed is not None:
                     deps_dict[dep] = "input-" + hashed
-                    # store hash in hash cache as it may be a new file
-                    self.hash_cache[dep] = hashed
 
             for output in outputs:
-                hashed = self.hasher(output)
+                # don't use the hash cache as this file should already be in
+                # there but has probably changed
+                hashed = self.hash(output, cached=False)
                 if hashed is not None:
                     deps_dict[output] = "output-" + hashed
-                    # update hash cache as this file should already be in
-                    # there but has probably changed
-                    self.hash_cache[output] = hashed
+                self.unchanged.pop(output, None)
 
             self.deps[command] = deps_dict
+            if cache and self.cache is not None:
+                if self.parallel_ok:
+                    _cache_stores.put((self._cache_store, (command, deps_dict)))
+                else:
+                    self._cache_store(command, deps_dict)
         
         return command, deps, outputs
 
+    # number of sets of inputs and outputs kept in the cache per command
+    cache_entries = 8
+    # number of threads looking up parallel commands in the build cache, so
+    # that many lookups waiting on a remote cache don't hold up the rest
+    cache_lookup_threads = 4
+
+    def _cache_key(self, command):
+        """ Return the "ac/" key of command's entries in the build cache,
+            which covers the program the command runs as well as its
+            command line, so outputs of another compiler aren't used. """
+        hasher = getattr(self.hasher, '__name__', repr(self.hasher))
+        return 'ac/' + md5func('%s\0%s\0%s' % (hasher,
+            self._program_hash(command), command)).hexdigest()
+
+    def _program_hash(self, command):
+        """ Return the hash of the program command line command runs, found
+            on $PATH, or '' if it isn't found. """
+        if command.startswith('"'):
+            program = command[1:].split('"', 1)[0]
+        else:
+            program = command.split(None, 1)[0]
+        try:
+            path = self._program_paths[program]
+        except KeyError:
+            path = self._program_paths[program] = _find_program(program)
+        if path is None:
+            return ''
+        return self.hash(path) or ''
+
+    def _cache_entries(self, command):
+        """ Return the list of entries stored for command in the build
+            cache, each {"inputs": [[name, hash], ...],
+            "outputs": [[name, hash, mode], ...]} with a hash of None for
+            directories, most recent first. """
+        try:
+            data = self.cache.get(self._cache_key(command))
+            if data is None:
+                return []
+            return json.loads(data)
+        except (EnvironmentError, ValueError), e:
+            if self.debug:
+                printerr('fabricate: cache lookup failed: %s' % e)
+            return []
+
+    def restore(self, command):
+        """ Restore the outputs of command from the build cache, if it has
+            them for command's current inputs, and return done()'s
+            results, as if it had run. Return None if there's no cache or
+            it doesn't have the outputs, after removing any outputs of the
+            command's last run that are hard links, which may be to the
+            cache, so the command can't write to the cache through them. """
+        if self.cache is None:
+            return None
+        restored = self._cache_fetch(command)
+        if restored is None:
+            return None
+        deps, outputs = restored
+        return self.done(command, deps, outputs, cache=False)
+
+    def _cache_fetch(self, command):
+        """ Restore the outputs of command from the build cache as restore()
+            does, but return (deps, outputs) without storing them in the
+            dependency file, or None. """
+        for entry in self._cache_entries(command):
+            for name, hashed in entry['inputs']:
+                if self.hash(name) != hashed:
+                    break
+            else:
+                if self._cache_restore(entry['outputs']):
+                    if self.debug:
+                        printerr('fabricate: restored outputs from cache')
+                    deps = [name for name, hashed in entry['inputs']]
+                    outputs = [name for name, hashed, mode in entry['outputs']]
+                    return deps, outputs
+        self._unlink_outputs(command)
+        return None
+
+    def _unlink_outputs(self, command):
+        """ Remove the outputs of command's last run that are hard links. """
+        for name, value in self.deps.get(command, {}).iteritems():
+            if not value.startswith('output-'):
+                continue
+            try:
+                st = os.lstat(name)
+                if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                    os.remove(name)
+            except OSError:
+                pass
+
+    def _cache_restore(self, outputs):
+        """ Restore the given outputs from the build cache, returning False
+            if it couldn't. Files are only put in place once they've all
+            been fetched and checked. """
+        for name, hashed, mode in outputs:
+            if not self._cache_output_ok(name):
+                if self.debug:
+                    printerr('fabricate: cache entry has bad output %r' % name)
+                return False
+        fetched = []
+        try:
+            try:
+                for name, hashed, mode in outputs:
+                    if hashed is None:
+                        continue
+                    dirname = os.path.dirname(name)
+                    if dirname and not os.path.isdir(dirname):
+                        os.makedirs(dirname)
+                    handle, tempname = tempfile.mkstemp(dir=dirname or '.',
+                        prefix=self.ignoreprefix + 'fabricate')
+                    os.close(handle)
+                    os.remove(tempname)
+                    fetched.append((tempname, name))
+                    if (not self.cache.get_file('cas/' + hashed, tempname,
+                                                mode) or
+                            self.hasher(tempname) != hashed):
+                        return False
+            except EnvironmentError, e:
+                if self.debug:
+                    printerr('fabricate: cache restore failed: %s' % e)
+                return False
+            for name, hashed, mode in outputs:
+                if hashed is None and not os.path.isdir(name):
+                    os.makedirs(name)
+            for tempname, name in fetched:
+                os.rename(tempname, name)
+            fetched = []
+            return True
+        finally:
+            for tempname, name in fetched:
+                if os.path.exists(tempname):
+                    os.remove(tempname)
+
+    def _cache_output_ok(self, name):
+        """ Return True if output name of a build cache entry may be written:
+            a relative name in the dependency search directories, without
+            "..", and not in or named with ignoreprefix, such as the
+            dependency file. The content hashes only show an entry's files
+            are the ones it names, so its names must be checked too. """
+        if not isinstance(name, basestring) or os.path.isabs(name):
+            return False
+        parts = os.path.normpath(name).split(os.sep)
+        if '..' in parts:
+            return False
+        if self.ignoreprefix and any(part.startswith(self.ignoreprefix)
+                                     for part in parts):
+            return False
+        return self._is_relevant(name)
+
+    def _cache_store(self, command, deps_dict):
+        """ Store the outputs of command, given its done() deps_dict, in the
+            build cache under its current inputs. Commands with no outputs,
+            or outputs that are neither files nor directories, are not
+            stored, as they're run for some effect the cache can't give. """
+        inputs = []
+        outputs = []
+        for name, value in sorted(deps_dict.iteritems()):
+            kind, hashed = value.split('-', 1)
+            if kind == 'input':
+                inputs.append([name, hashed])
+                continue
+            st = os.lstat(name)
+            if stat.S_ISDIR(st.st_mode):
+                outputs.append([name, None, 0])
+            elif stat.S_ISREG(st.st_mode):
+                outputs.append([name, hashed, stat.S_IMODE(st.st_mode)])
+            else:
+                return
+        if not outputs:
+            return
+        entry = {'inputs': inputs, 'outputs': outputs}
+        try:
+            for name, hashed, mode in outputs:
+                if hashed is not None:
+                    self.cache.put_file('cas/' + hashed, name)
+            entries = [e for e in self._cache_entries(command) if e != entry]
+            entries = [entry] + entries[:self.cache_entries-1]
+            self.cache.put(self._cache_key(command),
+                           json.dumps(entries, sort_keys=True))
+        except EnvironmentError, e:
+            if self.debug:
+                printerr('fabricate: cache store failed: %s' % e)
+
     def memoize(self, command, **kwargs):
         """ Run the given command, but only if its dependencies have changed --
             like run(), but returns the status code instead of raising an
@@ -1193,28 +3853,93 @@ class Builder(object):
         self.checking = False
         return self.outofdate_flag
 
+    def hash(self, filename, cached=True):
+        """ Return the hasher's hash of filename, or None if it doesn't
+            exist. Files already hashed are not hashed again unless "cached"
+            is False, and with stat_cache the hash is reused from the
+            dependency file while the file's stat signature is unchanged,
+            or else from the shared hash cache. """
+        if cached and filename in self.hash_cache:
+            # already hashed so don't repeat hashing work
+            return self.hash_cache[filename]
+        hashed = st = None
+        shared = self.shared_hashes
+        if self.stat_cache or shared is not None:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                pass
+        if st is not None and self.stat_cache:
+            signature = stat_signature(st)
+            stored = self.deps.get_stat(filename)
+            if stored is not None and stored[0] == signature:
+                hashed = stored[1]
+        if hashed is None and st is not None and shared is not None:
+            hashed = shared.get(st)
+            if hashed is not None and self.stat_cache:
+                self.deps.set_stat(filename, signature, hashed)
+        if hashed is None:
+            hash_time = time.time()
+            hashed = self.hasher(filename)
+            # a file changed again within the filesystem's timestamp
+            # resolution could keep its signature, so only store
+            # signatures of files that had stopped changing
+            if (hashed is not None and st is not None
+                    and hash_time - st.st_mtime > FAT_mtime_resolution):
+                if self.stat_cache:
+                    self.deps.set_stat(filename, signature, hashed)
+                if shared is not None:
+                    shared.set(st, hashed)
+        if hashed is not None:
+            self.hash_cache[filename] = hashed
+        return hashed
+
+    def prehash(self, threads):
+        """ Hash every file in the dependency file entries not yet in the
+            hash cache, using given number of threads, so the hash cache is
+            filled before the build functions check the commands rather than
+            one file at a time. """
+        start = time.time()
+        names = [name for name in self.deps.names()
+                 if name not in self.hash_cache]
+        if len(names) < 2:
+            return
+        threads = min(threads, len(names))
+        queue = Queue.Queue()
+        for name in names:
+            queue.put(name)
+        def hash_queued():
+            while True:
+                try:
+                    name = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                self.hash(name)
+        hashers = [threading.Thread(target=hash_queued) for i in range(threads)]
+        for thread in hashers:
+            thread.start()
+        for thread in hashers:
+            thread.join()
+        self.echo_debug('hashed %d files with %d threads in %.3fs'
+                        % (len(names), threads, time.time() - start))
+
     def cmdline_outofdate(self, command):
         """ Return True if given command line is out of date. """
-        if command in self.deps:
+        entries = self.deps.get(command)
+        if entries is not None:
             # command has been run before, see if deps have changed
-            for dep, oldhash in self.deps[command].items():
+            for dep, oldhash in entries.iteritems():
+                if self.unchanged.get(dep) == oldhash:
+                    # entry shared with a command already checked
+                    continue
+                entry = oldhash
                 assert oldhash.startswith('input-') or \
                        oldhash.startswith('output-'), \
                     "%s file corrupt, do a clean!" % self.depsname
                 io_type, oldhash = oldhash.split('-', 1)
 
                 # make sure this dependency or output hasn't changed
-                if dep in self.hash_cache:
-                    # already hashed so don't repeat hashing work
-                    newhash = self.hash_cache[dep]
-                else:
-                    # not in hash_cache so make sure this dependency or
-                    # output hasn't changed
-                    newhash = self.hasher(dep)
-                    if newhash is not None:
-                       # Add newhash to the hash cache
-                       self.hash_cache[dep] = newhash
-
+                newhash = self.hash(dep)
                 if newhash is None:
                     self.echo_debug("rebuilding %r, %s %s doesn't exist" %
                                     (command, io_type, dep))
@@ -1223,6 +3948,8 @@ class Builder(object):
                     self.echo_debug("rebuilding %r, hash for %s %s (%s) != old hash (%s)" %
                                     (command, io_type, dep, newhash, oldhash))
                     break
+                if newhash == oldhash:
+                    self.unchanged[dep] = entry
             else:
                 # all dependencies are unchanged
                 return False
@@ -1239,9 +3966,10 @@ class Builder(object):
         outputs = []
         dirs = []
         for command, deps in self.deps.items():
-            outputs.extend(dep for dep, hashed in deps.items()
+            outputs.extend(dep for dep, hashed in deps.iteritems()
                            if hashed.startswith('output-'))
         outputs.append(self.depsname)
+        self._deps.close()
         self._deps = None
         for output in outputs:
             try:
@@ -1274,40 +4002,48 @@ class Builder(object):
             atexit.register(self.write_deps, depsname=os.path.abspath(self.depsname))
         return self._deps
 
+    @property
+    def shared_hashes(self):
+        """ Lazy open the shared HashCache, or None if it isn't used. """
+        if self.shared_hash_cache is None:
+            return None
+        with _shared_hashes_lock:
+            # prehash threads may all want it at once
+            if getattr(self, '_shared_hashes', None) is None:
+                hasher = getattr(self.hasher, '__name__', repr(self.hasher))
+                self._shared_hashes = HashCache(self.shared_hash_cache, hasher)
+                atexit.register(self._shared_hashes.save)
+        return self._shared_hashes
+
     def read_deps(self):
-        """ Read dependency JSON file into deps object. """
-        try:
-            f = open(self.depsname)
-            try:
-                self._deps = json.load(f)
-                # make sure the version is correct
-                if self._deps.get('.deps_version', 0) != deps_version:
-                    printerr('Bad %s dependency file version! Rebuilding.'
-                             % self.depsname)
-                    self._deps = {}
-                self._deps.pop('.deps_version', None)
-            finally:
-                f.close()
-        except IOError:
-            self._deps = {}
+        """ Open the dependency file as the deps object. """
+        hasher = getattr(self.hasher, '__name__', repr(self.hasher))
+        self._deps = self.deps_store(self.depsname, hasher)
 
     def write_deps(self, depsname=None):
-        """ Write out deps object into JSON dependency file. """
+        """ Write changes to the deps object out to the dependency file. """
         if self._deps is None:
             return                      # we've cleaned so nothing to save
-        self.deps['.deps_version'] = deps_version
-        if depsname is None:
-            depsname = self.depsname
-        f = open(depsname, 'w')
-        try:
-            json.dump(self.deps, f, indent=4, sort_keys=True)
-        finally:
-            f.close()
-            self._deps.pop('.deps_version', None)
+        self._deps.save(depsname)
+
+    _hasher_map = {
+        'md5' : md5_hasher,
+        'mtime' : mtime_hasher,
+        }
+    if blake2func is not None:
+        _hasher_map['blake2'] = blake2_hasher
+    if xxhashfunc is not None:
+        _hasher_map['xxhash'] = xxhash_hasher
+
+    _deps_store_map = {
+        'json' : JsonDeps,
+        'sqlite' : SqliteDeps,
+        }
 
     _runner_map = {
         'atimes_runner' : AtimesRunner,
         'strace_runner' : StraceRunner,
+        'preload_runner' : PreloadRunner,
         'always_runner' : AlwaysRunner,
         'smart_runner' : SmartRunner,
         }
@@ -1316,7 +4052,7 @@ class Builder(object):
         """Set the runner for this builder.  "runner" is either a Runner
            subclass (e.g. SmartRunner), or a string selecting one of the
            standard runners ("atimes_runner", "strace_runner",
-           "always_runner", or "smart_runner")."""
+           "preload_runner", "always_runner", or "smart_runner")."""
         try:
             self.runner = self._runner_map[runner](self)
         except KeyError:
@@ -1332,9 +4068,9 @@ class Builder(object):
         """ Return True if file is in the dependency search directories. """
 
         # need to abspath to compare rel paths with abs
-        fullname = os.path.abspath(fullname)
-        for path in self.dirs:
-            path = os.path.abspath(path)
+        cwd = os.getcwd()
+        fullname = os.path.normpath(os.path.join(cwd, fullname))
+        for path in self._abs_dirs(cwd):
             if fullname.startswith(path):
                 rest = fullname[len(path):]
                 # files in dirs starting with ignoreprefix are not relevant
@@ -1346,10 +4082,28 @@ class Builder(object):
                 return True
         return False
 
+    def _abs_dirs(self, cwd):
+        """ Return self.dirs as absolute paths from the current directory
+            cwd, only redoing the abspaths when either changes. """
+        key = (cwd, tuple(self.dirs))
+        if getattr(self, '_dirs_key', None) != key:
+            self._dirs_key = key
+            self._abs_dirs_list = [os.path.normpath(os.path.join(cwd, path))
+                                   for path in self.dirs]
+        return self._abs_dirs_list
+
     def _join_results_handler(self):
-        """Stops then joins the results handler thread"""
-        _stop_results.set()
+        """Stops then joins the results handler thread, and then the build
+           cache threads once they have done the jobs queued for them"""
+        _stop_results_handler()
         _results.join()
+        for thread in _cache_lookup_threads:
+            _cache_lookups.put(None)
+        for thread in _cache_lookup_threads:
+            thread.join()
+        if _cacher is not None:
+            _cache_stores.put(None)
+            _cacher.join()
 
 # default Builder instance, used by helper run() and main() helper functions
 default_builder = None
@@ -1401,8 +4155,9 @@ def after(*args):
         cond = threading.Condition()
         cond.acquire()
         a = _after(args, cond)
-        _groups.add(False, a)
-        cond.wait()
+        _add_after(a)
+        if _results is not None or not _handle_events_here(default_builder, a):
+            cond.wait()
         if not a.done:
             sys.exit(1)
         results = []
@@ -1441,13 +4196,36 @@ _usage = '[options] build script functions to run'
 
 def parse_options(usage=_usage, extra_options=None, command_line=None):
     """ Parse command line options and return (parser, options, args). """
+    import optparse # only imported when used, as it's slow to import
     parser = optparse.OptionParser(usage='Usage: %prog '+usage,
                                    version='%prog '+__version__)
     parser.disable_interspersed_args()
     parser.add_option('-t', '--time', action='store_true',
                       help='use file modification times instead of MD5 sums')
+    parser.add_option('--hasher', type='choice',
+                      choices=sorted(Builder._hasher_map.keys()),
+                      help='use HASHER (%s) to detect changed files'
+                           % ', '.join(sorted(Builder._hasher_map.keys())))
     parser.add_option('-d', '--dir', action='append',
                       help='add DIR to list of relevant directories')
+    parser.add_option('--deps-store', type='choice',
+                      choices=sorted(Builder._deps_store_map.keys()),
+                      help='store the dependency file as STORE (%s, default '
+                           'json)' % ', '.join(sorted(Builder._deps_store_map.keys())))
+    parser.add_option('--shared-hash-cache', action='store_true',
+                      help="keep file hashes in the cache shared by this "
+                           "host's builds, so files no build has seen "
+                           "change aren't hashed again")
+    parser.add_option('--no-shared-hash-cache', action='store_false',
+                      dest='shared_hash_cache',
+                      help="don't use the shared hash cache")
+    parser.add_option('--cache',
+                      help='share command outputs in the build cache CACHE '
+                           '(a directory or http:// URL, or "local" for the '
+                           "one shared by this host's builds; ./local for a "
+                           'directory named local)')
+    parser.add_option('--cache-size', type='int', metavar='MB',
+                      help='limit a build cache directory to MB megabytes')
     parser.add_option('-c', '--clean', action='store_true',
                       help='autoclean build outputs before running')
     parser.add_option('-q', '--quiet', action='store_true',
@@ -1500,11 +4278,13 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
         be used to prevent the default parsing of sys.argv. Used to intercept
         and modify the command line passed to the build script.
         "default" is the default user script function to call, None = 'build'
+        "jobs" is the number of parallel jobs, which is also the number of
+        threads used to hash the commands' dependencies before the build
         "extra_options" is an optional list of options created with
         optparse.make_option(). The pseudo-global variable main.options
         is set to the parsed options list.
         "kwargs" is any other keyword arguments to pass to the builder """
-    global default_builder, default_command, _pool
+    global default_builder, default_command, _pool_processes
 
     kwargs.update(_setup_kwargs)
     if _parsed_options is not None:
@@ -1513,10 +4293,24 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
         parser, options, actions = parse_options(extra_options=extra_options, command_line=command_line)
     kwargs['quiet'] = options.quiet
     kwargs['debug'] = options.debug
+    if options.hasher:
+        kwargs['hasher'] = options.hasher
     if options.time:
         kwargs['hasher'] = mtime_hasher
     if options.dir:
         kwargs['dirs'] = options.dir
+    if options.deps_store:
+        kwargs['deps_store'] = options.deps_store
+    if options.shared_hash_cache is not None:
+        kwargs['shared_hash_cache'] = options.shared_hash_cache
+    if options.cache:
+        cache = options.cache
+        if cache == 'local':
+            cache = True
+        max_size = build_cache_size
+        if options.cache_size is not None:
+            max_size = options.cache_size * 1024**2
+        kwargs['cache'] = build_cache(cache, max_size=max_size)
     if options.keep:
         StraceRunner.keep_temps = options.keep
     main.options = options
@@ -1548,7 +4342,7 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
             print "Entering directory '%s'" % build_dir
         os.chdir(build_dir)
     if _pool is None and jobs > 1:
-        _pool = multiprocessing.Pool(jobs)
+        _pool_processes = jobs
 
     use_builder = Builder
     if _setup_builder is not None:
@@ -1559,6 +4353,9 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
 
     if options.clean:
         default_builder.autoclean()
+    elif jobs > 1:
+        # hash the dependencies of every command once, all at the same time
+        default_builder.prehash(jobs)
 
     status = 0
     try:
@@ -1578,7 +4375,7 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
         message, data, status = exc
         printerr('fabricate: ' + message)
     finally:
-        _stop_results.set() # stop the results gatherer so I don't hang
+        _stop_results_handler() # stop the results gatherer so I don't hang
         if not options.quiet and os.path.abspath(build_dir) != original_path:
             print "Leaving directory '%s' back to '%s'" % (build_dir, original_path)
         os.chdir(original_path)
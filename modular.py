@@ -1,15 +1,28 @@
 #!/usr/bin/python
 
+import time
+start_time = time.time()
+
 import sys
 sys.dont_write_bytecode = True
 
+# fabricate and the rule classes are only imported once needed, so builds
+# with nothing to do and builds done by a build server start quickly
 import argparse
-import fabricate
-from optparse import make_option
+import atexit
+import errno
+import fcntl
+import hashlib
+import heapq
+import json
+import marshal
 import os
 import re
-import shutil
-import subprocess
+import select
+import signal
+import socket
+import struct
+import traceback
 
 # Build rule classes
 from rules import RULE_CLASSES
@@ -31,31 +44,199 @@ def cross_tool(tool, cross):
     return "%s-%s" % (cross, tool)
 
 
+def rule_classes_key():
+    """ Returns a string naming the rule functions and the classes they
+        construct, which cached modules are only valid for """
+    return ' '.join('%s=%s' % (name, RULE_CLASSES.class_name(name))
+                    for name in sorted(RULE_CLASSES.keys()))
+
+class ModuleCache(object):
+    """ The rule declarations of each MODULE file, saved in out/.modules
+        with the hash of the file's contents so unchanged modules can be
+        loaded without executing them. Declarations are marshalled, so
+        only modules that pass plain values to the rule functions are
+        cached. """
+    def __init__(self, root):
+        self.filename = os.path.join(root, 'out', '.modules')
+        self.key = rule_classes_key()
+        self.changed = False
+        try:
+            with open(self.filename, 'rb') as f:
+                key, self.modules = marshal.load(f)
+            if key != self.key:
+                self.modules = {}
+        except (IOError, EOFError, ValueError, TypeError):
+            self.modules = {}
+
+    def get(self, path, digest):
+        """ Returns the list of (function, name, args, kwargs) calls the
+            module at path made if its contents hash to digest, or None """
+        entry = self.modules.get(path)
+        if entry is not None and entry[0] == digest:
+            return entry[1]
+        return None
+
+    def put(self, path, digest, calls):
+        try:
+            marshal.dumps(calls)
+        except ValueError:
+            # not plain values, so the module is executed every time
+            self.modules.pop(path, None)
+            return
+        self.modules[path] = (digest, calls)
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tempname = self.filename + '.%d' % os.getpid()
+        with open(tempname, 'wb') as f:
+            marshal.dump((self.key, self.modules), f)
+        os.rename(tempname, self.filename)
+        self.changed = False
+
+
 class Module(object):
     def __init__(self, path, root):
         self.root = root
         self.path = path
         self.rules = {}
+        self.calls = []
         self.eval_globals = {}
 
-        def make_call(module, classname, ruleclass):
+        def make_call(module, classname):
             def call(name, *args, **kwargs):
+                self.calls.append((classname, name, args, kwargs))
+                # rule classes are loaded when first used
+                ruleclass = RULE_CLASSES[classname]
                 self.rules[name] = ruleclass(module, name, *args, **kwargs)
             return call
 
         for classname in RULE_CLASSES.keys():
-            self.eval_globals[classname] = make_call(self, classname, RULE_CLASSES[classname])
+            self.eval_globals[classname] = make_call(self, classname)
 
     def __repr__(self):
         return type(self).__name__ + "(" + ", ".join(print_attrs(self, ['path', 'rules'])) + ")"
 
-    def parse(self):
+    def parse(self, cache=None):
+        filename = self.root + '/' + self.path + '/' + 'MODULE'
+        with open(filename) as f:
+            source = f.read()
+        digest = hashlib.md5(source).hexdigest()
+        calls = None
+        if cache is not None:
+            calls = cache.get(self.path, digest)
+        if calls is not None:
+            for classname, name, args, kwargs in calls:
+                self.eval_globals[classname](name, *args, **kwargs)
+            return
         eval_locals = {}
-        execfile(self.root + '/' + self.path + '/' + 'MODULE', self.eval_globals, eval_locals)
+        exec compile(source, filename, 'exec') in self.eval_globals, eval_locals
+        if cache is not None:
+            cache.put(self.path, digest, self.calls)
+
+
+def file_signature(filename):
+    """ Returns the size, modification time and inode of filename, which
+        change when it does """
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+SNAPSHOT_NAME = os.path.join('out', '.snapshot')
+
+def snapshot_key(targets, relpath, args):
+    return hashlib.md5(repr((sorted(targets), relpath, args))).hexdigest()
+
+def load_snapshots():
+    try:
+        with open(SNAPSHOT_NAME, 'rb') as f:
+            return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return {}
+
+def snapshot_up_to_date(key):
+    """ Returns True if a build with the given snapshot key has been done and
+        none of the files it used has changed since, so there's nothing to
+        build. Files are MODULE files, the build system's sources and every
+        command's dependencies and outputs. """
+    files = load_snapshots().get(key)
+    if files is None:
+        return False
+    for filename, signature in files.iteritems():
+        try:
+            if file_signature(filename) != signature:
+                return False
+        except OSError:
+            return False
+    return True
+
+def source_files(cwd):
+    """ Returns the absolute names of the build system's source files that
+        have been loaded, given the directory modular.py was started in """
+    import fabricate
+    pymodules = [sys.modules['__main__'], fabricate]
+    for name, pymodule in sys.modules.items():
+        if pymodule is not None and (name == 'rules' or name.startswith('rules.')):
+            pymodules.append(pymodule)
+    filenames = []
+    for pymodule in pymodules:
+        filename = pymodule.__file__
+        if filename.endswith('.pyc') or filename.endswith('.pyo'):
+            filename = filename[:-1]
+        filenames.append(os.path.normpath(os.path.join(cwd, filename)))
+    return filenames
 
+def save_snapshot(key, modules, builder, sources, started):
+    """ Saves the signature of each file used by the build just done under
+        the given snapshot key, unless a command's results are missing or
+        a file other than the build's outputs was modified after the time
+        "started" the build began, less the coarsest mtime resolution. Such
+        a file may have changed after a command used it, or may change
+        again without its signature changing. """
+    import fabricate
+    filenames = set()
+    outputs = set()
+    for command in builder.commands:
+        entries = builder.deps.get(command)
+        if entries is None:
+            return
+        filenames.update(entries)
+        outputs.update(name for name, value in entries.iteritems()
+                       if value.startswith('output-'))
+    for module in modules.values():
+        filenames.add(module.root + '/' + module.path + '/' + 'MODULE')
+    filenames.update(sources)
+    newest = started - fabricate.FAT_mtime_resolution
+    files = {}
+    for filename in filenames:
+        try:
+            files[filename] = signature = file_signature(filename)
+        except OSError:
+            return
+        if signature[1] >= newest and filename not in outputs:
+            return
+    snapshots = load_snapshots()
+    snapshots[key] = files
+    if not os.path.isdir(os.path.dirname(SNAPSHOT_NAME)):
+        return
+    tempname = SNAPSHOT_NAME + '.%d' % os.getpid()
+    with open(tempname, 'wb') as f:
+        marshal.dump(snapshots, f)
+    os.rename(tempname, SNAPSHOT_NAME)
 
 def build():
-    eval_targets(build.targets, root=build.root, relpath=build.relpath)
+    import fabricate
+    cache = ModuleCache(build.root)
+    modules = build.modules
+    eval_targets(build.targets, root=build.root, relpath=build.relpath, modules=modules, cache=cache)
+    if build.snapshot_key is not None:
+        # wait for the commands so their dependencies are known
+        fabricate.after()
+        save_snapshot(build.snapshot_key, modules, fabricate.default_builder,
+                      source_files(build.cwd), build.started)
 
 def parse_target_path_rule(target):
     m = RE_TARGET.match(target)
@@ -75,42 +256,143 @@ def abs_module_path(relpath, path):
         path = '/' + path
     return path
 
-def eval_targets(targets, root, relpath=None, modules={}, queue=[]):
+def eval_targets(targets, root, relpath=None, modules={}, queue=[], cache=None):
+    graph = TargetGraph(root, modules, cache)
+    rules = []
     for target in targets:
-        eval_target(target, root, relpath, modules, queue)
+        rules.extend(graph.resolve(target, relpath))
+    if cache is not None:
+        cache.save()
+    execute_rules(rules)
 
-def eval_target(target, root, relpath=None, modules={}, queue=[]):
-    path, rulename = parse_target_path_rule(target)
-    path = abs_module_path(relpath, path)
-    try:
-        module = modules[path]
-    except KeyError:
-        module = Module(path, root)
+def rule_deps(rule):
+    deps = []
+    for deprules in rule.deprules.values():
+        deps.extend(deprules)
+    return deps
+
+def rule_cost(rule):
+    # one job per source plus one to archive or link them
+    return len(getattr(rule, 'sources', [])) + 1
+
+def rule_closure(targets):
+    """ Returns the given rules and every rule they depend on, in the order
+        they were found """
+    rules = []
+    seen = set()
+    pending = list(targets)
+    while pending:
+        rule = pending.pop(0)
+        if rule not in seen:
+            seen.add(rule)
+            rules.append(rule)
+            pending.extend(rule_deps(rule))
+    return rules
+
+def critical_paths(rules, dependents):
+    """ Returns a dict of the cost of the longest chain of rules starting at
+        each rule and ending at one that nothing depends on """
+    costs = {}
+    def cost(rule):
+        if rule not in costs:
+            costs[rule] = rule_cost(rule) + max([cost(d) for d in dependents[rule]] or [0])
+        return costs[rule]
+    for rule in rules:
+        cost(rule)
+    return costs
+
+def execute_rules(targets):
+    """ Executes every rule once all of the rules it depends on have been
+        executed, taking the ready rule on the most expensive path first so
+        the commands of the critical path reach the job pool first """
+    rules = rule_closure(targets)
+    dependents = dict((rule, []) for rule in rules)
+    waiting = {}
+    for rule in rules:
+        deps = set(rule_deps(rule))
+        waiting[rule] = len(deps)
+        for dep in deps:
+            dependents[dep].append(rule)
+    costs = critical_paths(rules, dependents)
+    order = dict((rule, index) for index, rule in enumerate(rules))
+    ready = [(-costs[rule], order[rule], rule) for rule in rules if waiting[rule] == 0]
+    heapq.heapify(ready)
+    while ready:
+        cost, index, rule = heapq.heappop(ready)
+        rule.execute()
+        for dependent in dependents[rule]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                heapq.heappush(ready, (-costs[dependent], order[dependent], dependent))
+
+class TargetGraph(object):
+    """ The rules that targets resolve to and the rules they depend on, each
+        resolved once however many rules depend on it. Raises ValueError if
+        targets can't be resolved or depend on themselves. """
+    def __init__(self, root, modules=None, cache=None):
+        self.root = root
+        self.modules = {} if modules is None else modules
+        self.cache = cache
+        self.rules = {}         # (module path, rule name) -> resolved rule
+        self.order = []         # resolved rules, after the rules they depend on
+        self.resolving = []     # (module path, rule name) of rules being resolved
+        self.in_progress = set()
+
+    def module(self, path):
         try:
-            module.parse()
-        except IOError:
-            raise ValueError('module %s does not exist' % (path))    
-        modules[path] = module
+            return self.modules[path]
+        except KeyError:
+            module = Module(path, self.root)
+            try:
+                module.parse(self.cache)
+            except IOError:
+                raise ValueError('module %s does not exist' % (path))
+            self.modules[path] = module
+            return module
 
-    if rulename is None:
-        rulename = os.path.basename(path)
+    def resolve(self, target, relpath=None):
+        """ Returns the rules target, relative to module relpath, names """
+        path, rulename = parse_target_path_rule(target)
+        path = abs_module_path(relpath, path)
+        module = self.module(path)
+        if rulename is None:
+            rulename = os.path.basename(path)
+        if rulename == "all":
+            return [self.resolve_rule(module, name) for name in module.rules.keys()]
+        return [self.resolve_rule(module, rulename)]
 
-    if rulename == "all":
-        deptargets = []
-        for rule in module.rules.keys():
-            deptargets.extend(eval_target(':' + rule, root, path, modules, queue))
-	return deptargets
-    else:
+    def resolve_rule(self, module, rulename):
+        key = (module.path, rulename)
+        rule = self.rules.get(key)
+        if rule is not None:
+            return rule
+        if key in self.in_progress:
+            cycle = self.resolving[self.resolving.index(key):] + [key]
+            raise ValueError('circular dependency: %s' % ' -> '.join('%s:%s' % k for k in cycle))
         try:
             rule = module.rules[rulename]
         except KeyError:
-            raise ValueError('in %s: target %s could not be resolved' % (path + '/' + 'MODULE', module.path + ':' + rulename))
-        # TODO: detect and abort on circular dependencies
-        for dep in rule.deps:
-            deptargets = eval_target(dep, root, path, modules, queue)
-            rule.deprules[dep] = deptargets
-        rule.execute()
-    return [rule]
+            raise ValueError('in %s: target %s could not be resolved' % (module.path + '/' + 'MODULE', module.path + ':' + rulename))
+        self.resolving.append(key)
+        self.in_progress.add(key)
+        try:
+            for dep in rule.deps:
+                rule.deprules[dep] = self.resolve(dep, module.path)
+        finally:
+            self.resolving.pop()
+            self.in_progress.remove(key)
+        self.rules[key] = rule
+        self.order.append(rule)
+        return rule
+
+    def edges(self):
+        """ Returns a dict of the name of each resolved rule to the names of the
+            rules it depends on """
+        return dict((rule_name(rule), [rule_name(dep) for dep in rule_deps(rule)])
+                    for rule in self.order)
+
+def rule_name(rule):
+    return '%s:%s' % (rule.module.path, rule.name)
 
 def module_relative_path(buildroot, path):
     relpath = os.path.relpath(os.getcwd() + '/', buildroot)
@@ -118,19 +400,457 @@ def module_relative_path(buildroot, path):
         return None
     return "/" + relpath
 
+def run_build(targets, relpath, args, modules={}, builder=None, started=None):
+    """ Builds targets given on the command line in module relpath, with the
+        command line's fabricate options args, and returns the exit status.
+        Must be run in the build root. "started" is when the build was asked
+        for, for the debug timing of the first command, and the time after
+        which files the build uses mustn't change for it to save a
+        snapshot. """
+    build.targets = targets
+    build.relpath = relpath
+    build.modules = modules
+    # a build of the same targets with the same options needn't do
+    # anything if none of the files the last one used have changed. Only
+    # builds whose options allow snapshots save them, so there's no need
+    # to parse the options first.
+    key = snapshot_key(targets, relpath, args)
+    if snapshot_up_to_date(key):
+        return 0
+    import fabricate
+    if started is None:
+        started = time.time()
+    fabricate.start_time = build.started = started
+    build.snapshot_key = None
+    parser, fabricate_options, actions = fabricate.parse_options(command_line=args)
+    if not fabricate_options.clean and not actions:
+        build.snapshot_key = key
+    try:
+        fabricate.main(default="build", build_dir=os.getcwd(), command_line=args,
+                       parallel_ok=True, depfiles=True, shared_hash_cache=True,
+                       builder=builder)
+    except SystemExit, e:
+        return e.code
+    return 0
+
+SERVER_SOCKET = os.path.join('out', '.server')
+
+def set_cloexec(fd):
+    """ Has file descriptor fd closed in the programs the process runs """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def build_on_server(targets, relpath, args):
+    """ Has the build server of the build root, if one is running, do the
+        build and returns its exit status. Returns None if there's no server
+        or it won't do the build, which is then for this process to do. The
+        server does the build in this process's environment and umask, and
+        writes the build's output to this process's stdout and stderr
+        itself. Once it has taken on the build
+        the server's status is returned even if it fails to give one, as
+        it may still be building. """
+    umask = os.umask(0)
+    os.umask(umask)
+    request = {'targets': targets, 'relpath': relpath, 'args': args,
+               'environ': dict(os.environ), 'umask': umask}
+    try:
+        request = json.dumps(request) + '\n'
+    except UnicodeDecodeError:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(SERVER_SOCKET)
+            sock.sendall(request)
+            replies = sock.makefile('rb')
+            reply = replies.readline()
+        except socket.error:
+            return None
+        try:
+            if not json.loads(reply)['accepted']:
+                return None
+        except (ValueError, KeyError, TypeError):
+            return None
+        # the server is doing the build, so it mustn't be done here too
+        try:
+            return json.loads(replies.readline())['status']
+        except (socket.error, ValueError, KeyError, TypeError):
+            sys.stderr.write('modular: the build server failed to give the '
+                             'status of the build\n')
+            return 1
+    finally:
+        sock.close()
+
+class BuildServer(object):
+    """ Serves builds of the build root to clients over a Unix socket, keeping
+        the modules parsed and the hashes of files between builds. inotify
+        tells it which files change so their hashes and the modules can be
+        dropped. Each build is run by a child process forked for it, which
+        writes to the client's stdout and stderr and sends the server the
+        hashes it made. The child is killed if the client goes away.
+
+        The client sends a line of JSON giving the build's targets, relpath
+        and fabricate args, and its environ and umask, which the child
+        builds with. The build system's sources are those the server loaded,
+        found from the directory it was started in. The server replies with a line {"accepted": false} if
+        the client should do the build itself, or else {"accepted": true}
+        and, once the build is done, {"status": exit status}. """
+    # seconds a client has to send its request in once it has connected
+    request_timeout = 2
+
+    def __init__(self, root, cwd, argv):
+        import fabricate
+        Inotify = fabricate.Inotify
+        self.watch_events = (Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE |
+                             Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO |
+                             Inotify.IN_CREATE | Inotify.IN_DELETE |
+                             Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF |
+                             Inotify.IN_ONLYDIR)
+        self.root = root
+        self.cwd = cwd
+        self.argv = argv
+        self.sources = {}
+        self.add_sources()
+        self.modules = {}
+        self.hashes = {}
+        self.inotify = None
+        self.watched = {}
+        self.reset()
+
+    def reset(self):
+        """ Forgets everything and starts watching the tree afresh """
+        import fabricate
+        if self.inotify is not None:
+            self.inotify.close()
+        self.inotify = fabricate.Inotify()
+        self.watched = {}
+        self.modules.clear()
+        self.hashes.clear()
+        self.watch('')
+
+    def watch(self, path):
+        """ Watches directory path, relative to the root, and those under it
+            whose names don't start with a '.' """
+        for dirpath, dirnames, filenames in os.walk(path or '.'):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            try:
+                wd = self.inotify.add_watch(dirpath, self.watch_events)
+            except OSError:
+                continue
+            self.watched[wd] = os.path.relpath(dirpath)
+
+    def update(self):
+        """ Drops what has changed since the last update """
+        import fabricate
+        Inotify = fabricate.Inotify
+        for wd, mask, name in self.inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self.reset()
+                return
+            dirname = self.watched.get(wd)
+            if dirname is None:
+                continue
+            if mask & Inotify.IN_IGNORED:
+                del self.watched[wd]
+                continue
+            if mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF) or \
+                    mask & Inotify.IN_ISDIR and mask & Inotify.IN_MOVED_FROM:
+                # names under a moved directory are out of date
+                self.reset()
+                return
+            filename = os.path.normpath(os.path.join(dirname, name))
+            self.hashes.pop(filename, None)
+            if name == 'MODULE':
+                # modules' rules refer to each other, so all are reparsed
+                self.modules.clear()
+            if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                if not name.startswith('.'):
+                    self.watch(filename)
+
+    def add_sources(self):
+        """ Notes the signatures of the sources loaded since the last call """
+        for filename in source_files(self.cwd):
+            if filename not in self.sources:
+                self.sources[filename] = file_signature(filename)
+
+    def sources_changed(self):
+        for filename, signature in self.sources.iteritems():
+            try:
+                if file_signature(filename) != signature:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def serve(self):
+        dirname = os.path.dirname(SERVER_SOCKET)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(SERVER_SOCKET)
+        except socket.error:
+            if os.path.exists(SERVER_SOCKET):
+                os.remove(SERVER_SOCKET)
+        else:
+            raise ValueError('a build server is already running in %s' % self.root)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # not for the commands of builds, which may leave processes running
+        set_cloexec(sock.fileno())
+        sock.bind(SERVER_SOCKET)
+        sock.listen(16)
+        print 'Serving builds of %s' % self.root
+        sys.stdout.flush()
+        try:
+            while True:
+                conn, address = sock.accept()
+                try:
+                    restart = self.handle(conn)
+                finally:
+                    conn.close()
+                if restart:
+                    break
+        finally:
+            sock.close()
+            os.remove(SERVER_SOCKET)
+        # the build system's sources have changed, so restart with them
+        os.execv(sys.executable, [sys.executable] + self.argv)
+
+    def handle(self, conn):
+        """ Does the build requested on conn and replies with its status.
+            Returns True if the server needs restarting. Only the server's
+            own user is served, and a client that doesn't send its request
+            within request_timeout seconds is dropped. """
+        credentials = conn.getsockopt(socket.SOL_SOCKET,
+                                      getattr(socket, 'SO_PEERCRED', 17),
+                                      struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', credentials)
+        if uid != os.getuid():
+            return False
+        try:
+            conn.settimeout(self.request_timeout)
+            request = json.loads(conn.makefile('rb').readline())
+            conn.settimeout(None)
+            started = time.time()
+            # json gives unicode, which would make the command lines unicode
+            utf8 = lambda string: string.encode('utf-8')
+            targets = [utf8(target) for target in request['targets']]
+            relpath = request['relpath'] and utf8(request['relpath'])
+            args = [utf8(arg) for arg in request['args']]
+            environ = dict((utf8(name), utf8(value)) for name, value
+                           in request['environ'].iteritems())
+            umask = int(request['umask'])
+        except (ValueError, KeyError, TypeError, AttributeError, socket.error):
+            return False
+        if self.sources_changed():
+            # the client builds it itself while the server restarts
+            self.reply(conn, {'accepted': False})
+            return True
+        self.update()
+        outputs = []
+        try:
+            for fd in (1, 2):
+                outputs.append(os.open('/proc/%d/fd/%d' % (pid, fd),
+                                       os.O_WRONLY | os.O_APPEND))
+        except OSError:
+            # without the client's output, it does the build itself
+            for output in outputs:
+                os.close(output)
+            self.reply(conn, {'accepted': False})
+            return False
+        try:
+            if not self.reply(conn, {'accepted': True}):
+                return False
+            try:
+                # parse the modules here so they're kept for later builds
+                cache = ModuleCache(self.root)
+                graph = TargetGraph(self.root, self.modules, cache)
+                for target in targets:
+                    graph.resolve(target, relpath)
+                cache.save()
+            except Exception:
+                # the build reports it
+                pass
+            self.add_sources()
+            status = self.fork_build(conn, outputs, targets, relpath, args,
+                                     environ, umask, started)
+        finally:
+            for output in outputs:
+                os.close(output)
+        self.update()
+        self.reply(conn, {'status': status})
+        return False
+
+    def reply(self, conn, reply):
+        """ Sends reply to the client, returning False if it's gone """
+        try:
+            conn.sendall(json.dumps(reply) + '\n')
+        except socket.error:
+            return False
+        return True
+
+    def make_builder(self, **kwargs):
+        """ Returns the Builder of a build, which starts with the hashes of
+            the files the server knows haven't changed since they were
+            hashed """
+        import fabricate
+        builder = fabricate.Builder(**kwargs)
+        builder.hash_cache.update(self.hashes)
+        return builder
+
+    def fork_build(self, conn, outputs, targets, relpath, args, environ,
+                   umask, started):
+        """ Does the build in a child process writing to the file descriptors
+            outputs, the stdout and stderr of the client on conn, with the
+            client's environ and umask. Adds the hashes the child made
+            of files that are watched to self.hashes and returns its exit
+            status. The child and the commands it runs are killed if the
+            client goes away. """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        readfd, writefd = os.pipe()
+        # the commands of the build mustn't hold the pipe open
+        set_cloexec(readfd)
+        set_cloexec(writefd)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                # in a process group of its own, to be killed with its commands
+                os.setpgid(0, 0)
+                os.close(readfd)
+                conn.close()
+                for fd, output in zip((1, 2), outputs):
+                    if output != fd:
+                        os.dup2(output, fd)
+                        os.close(output)
+                null = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(null, 0)
+                os.close(null)
+                os.environ.clear()
+                os.environ.update(environ)
+                os.umask(umask)
+                # the sources' names are relative to where the server started
+                build.cwd = self.cwd
+                status = run_build(targets, relpath, args, self.modules,
+                                   self.make_builder, started)
+            except BaseException:
+                traceback.print_exc()
+            try:
+                # as at exit, so the dependencies are written
+                atexit._run_exitfuncs()
+                import fabricate
+                builder = fabricate.default_builder
+                if builder is not None:
+                    watched = set(self.watched.values())
+                    hashes = dict((filename, hashed) for filename, hashed
+                                  in builder.hash_cache.iteritems()
+                                  if (os.path.dirname(filename) or '.') in watched)
+                    with os.fdopen(writefd, 'wb') as f:
+                        marshal.dump(hashes, f)
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status or 0)
+        os.close(writefd)
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass                # the child has done it already
+        # read the hashes, watching for the client going away meanwhile.
+        # Reading stops at the child's exit, as a process the build left
+        # running could still hold the pipe open.
+        chunks = []
+        waiting = [readfd, conn]
+        killed = False
+        exited = None
+        while exited is None:
+            ready = select.select(waiting, [], [], 0.5)[0]
+            if conn in ready:
+                try:
+                    gone = not conn.recv(4096)
+                except socket.error:
+                    gone = True
+                if gone:
+                    # the client was stopped, so stop the build too
+                    waiting.remove(conn)
+                    try:
+                        os.killpg(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                    killed = True
+            if readfd in ready:
+                data = os.read(readfd, 65536)
+                if not data:
+                    break
+                chunks.append(data)
+                continue
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done == pid:
+                exited = status
+                # what the child wrote before exiting is in the pipe
+                flags = fcntl.fcntl(readfd, fcntl.F_GETFL)
+                fcntl.fcntl(readfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                try:
+                    while True:
+                        data = os.read(readfd, 65536)
+                        if not data:
+                            break
+                        chunks.append(data)
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+        os.close(readfd)
+        if exited is None:
+            exited = os.waitpid(pid, 0)[1]
+        status = os.WEXITSTATUS(exited) if os.WIFEXITED(exited) else 1
+        if chunks and not killed:
+            # changes during the build, read after this, drop those that
+            # may be out of date
+            try:
+                self.hashes.update(marshal.loads(''.join(chunks)))
+            except (EOFError, ValueError, TypeError):
+                pass
+        return status
+
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
     # todo: add 'run' command to rules where applicable
     #parser.add_argument('command', nargs=1, choices=['build','run'])
-    parser.add_argument('target', nargs='+')
+    parser.add_argument('target', nargs='*')
+    parser.add_argument('--server', action='store_true',
+                        help='serve builds of the build root to later runs, '
+                             'which have the server do their builds')
+    parser.add_argument('--graph', action='store_true',
+                        help="print the targets' rules and the rules each "
+                             "depends on as JSON rather than building")
     (options, args) = parser.parse_known_args()
-    build.targets = options.target
-    build.root = find_buildroot()
-    if build.root is None:
+    if not options.target and not options.server:
+        parser.error('no targets given')
+    root = find_buildroot()
+    if root is None:
         raise AssertionError("Could not locate the buildroot")
-    build.relpath = module_relative_path(build.root, os.getcwd())
-    os.chdir(build.root)
-    fabricate.main(default="build", build_dir=os.getcwd(), command_line=args)
+    relpath = module_relative_path(root, os.getcwd())
+    build.root = root
+    build.cwd = os.getcwd()
+    argv = [os.path.abspath(sys.argv[0])] + sys.argv[1:]
+    os.chdir(root)
+    if options.server:
+        BuildServer(root, build.cwd, argv).serve()
+    if options.graph:
+        graph = TargetGraph(root, cache=ModuleCache(root))
+        for target in options.target:
+            graph.resolve(target, relpath)
+        print json.dumps(graph.edges(), indent=2, sort_keys=True)
+        sys.exit(0)
+    status = None
+    if snapshot_up_to_date(snapshot_key(options.target, relpath, args)):
+        status = 0
+    if status is None:
+        status = build_on_server(options.target, relpath, args)
+    if status is None:
+        status = run_build(options.target, relpath, args, started=start_time)
+    sys.exit(status)
 
 
 
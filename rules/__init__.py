@@ -1,8 +1,26 @@
-from cc import CcLibraryRule, CcBinaryRule
-from avr import AvrLibraryRule, AvrBinaryRule
+class RuleClasses(dict):
+    """ Maps build file functions to the rule classes they construct. Classes
+        may be registered by name, as 'module.Class' within this package, so
+        that their modules are only imported when a build file first uses
+        them. """
+    def __getitem__(self, name):
+        cls = dict.__getitem__(self, name)
+        if isinstance(cls, basestring):
+            modulename, classname = cls.rsplit('.', 1)
+            module = __import__(modulename, globals(), fromlist=[classname])
+            cls = getattr(module, classname)
+            self[name] = cls
+        return cls
+
+    def class_name(self, name):
+        """ Returns the full name of the class for name, without importing it """
+        cls = dict.__getitem__(self, name)
+        if isinstance(cls, basestring):
+            return '%s.%s' % (__name__, cls)
+        return '%s.%s' % (cls.__module__, cls.__name__)
 
 # Used by the build system to map module functions to classes
-RULE_CLASSES = {}
+RULE_CLASSES = RuleClasses()
 
 # maps build file functions to a class to construct
 # the only required argument in the build file function is 'name'
@@ -10,8 +28,7 @@ def register_rule(name, classname):
     RULE_CLASSES[name] = classname
 
 
-register_rule('cc_library', CcLibraryRule)
-register_rule('cc_binary', CcBinaryRule)
-register_rule('avr_library', AvrLibraryRule)
-register_rule('avr_binary', AvrBinaryRule)
-
+register_rule('cc_library', 'cc.CcLibraryRule')
+register_rule('cc_binary', 'cc.CcBinaryRule')
+register_rule('avr_library', 'avr.AvrLibraryRule')
+register_rule('avr_binary', 'avr.AvrBinaryRule')
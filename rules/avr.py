@@ -49,11 +49,11 @@ class AvrBinaryRule(CcBinaryRule):
         elf = target + '.elf'
         super(AvrBinaryRule, self).link(elf, full_ldflags, objfiles)
         # hex image for flashing
-        fabricate.run([["avr-objcopy", "-j", ".text", "-j", ".data", "-O", "ihex", elf, target + ".hex"]])
+        fabricate.run([["avr-objcopy", "-j", ".text", "-j", ".data", "-O", "ihex", elf, target + ".hex"]], after=self.group('link'))
         # eeprom image
-        fabricate.run([["avr-objcopy", "-j", ".eeprom", "--change-section-lma", ".eeprom=0", "-O", "ihex", elf, target + ".eeprom"]])
+        fabricate.run([["avr-objcopy", "-j", ".eeprom", "--change-section-lma", ".eeprom=0", "-O", "ihex", elf, target + ".eeprom"]], after=self.group('link'))
         # dump assembly listing
-        fabricate.run([["avr-objdump", "-S", elf, ">", target + ".lst"]], shell=True)
+        fabricate.run([["avr-objdump", "-S", elf, ">", target + ".lst"]], shell=True, after=self.group('link'))
         # show sizes
-        fabricate.run([["avr-size", "-C", "--mcu=%s" % self.mcu, elf]])
+        fabricate.run([["avr-size", "-C", "--mcu=%s" % self.mcu, elf]], after=self.group('link'))
 
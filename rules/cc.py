@@ -8,9 +8,9 @@ from core import BuildRule
 from util import replace_ext
 import subprocess
 
-def get_gcc_target_machine():
+def probe_gcc_target_machine(gcc='gcc'):
     try:
-        return subprocess.check_output(['gcc', '-dumpmachine'], shell=False).strip()
+        return subprocess.check_output([gcc, '-dumpmachine'], shell=False).strip()
     except subprocess.CalledProcessError as e:
         print "Error: failed to identify machine type for toolchain '%s': %s" % (gcc, e.message)
         raise e
@@ -18,9 +18,18 @@ def get_gcc_target_machine():
         print "Error: failed to identify machine type for toolchain: '%s': %s" % (gcc, e.message)
         raise e
 
-class CcRule(BuildRule):
-    host_abi = get_gcc_target_machine()
+def get_gcc_target_machine(gcc='gcc'):
+    return str(fabricate.cached_probe(gcc, 'dumpmachine',
+                                      lambda: probe_gcc_target_machine(gcc)))
+
+def host_abi():
+    # probed when a rule first needs it, not when the rules are imported
+    if host_abi.machine is None:
+        host_abi.machine = get_gcc_target_machine()
+    return host_abi.machine
+host_abi.machine = None
 
+class CcRule(BuildRule):
     def __init__(self, module, name, static=False, abi=None, cflags=[], ldflags=[], deps=[], *args, **kwargs):
         super(CcRule, self).__init__(module, name, deps, *args, **kwargs)
         self.outputs = []
@@ -35,14 +44,14 @@ class CcRule(BuildRule):
     def init(self):
         super(CcRule, self).init()
         if self.abi is None:
-            self.abi = self.host_abi
+            self.abi = host_abi()
         self.cc = '%s-gcc' % (self.abi)
         self.ar = '%s-ar' % (self.abi)
         self.mkdirs(self.outdir)
 
     def compile(self, source):
         compile = [self.cc]
-        compile.extend(["-I" + self.module.root])
+        compile.extend(["-I" + os.path.relpath(self.module.root)])
         compile.extend(self.cflags)
         srcfile = os.path.join(self.indir, source)
         objfile = os.path.join(self.outdir, replace_ext(source, 'o'))
@@ -50,8 +59,15 @@ class CcRule(BuildRule):
             compile.append('-fpic')
         compile.extend(['-c', srcfile])
         compile.extend(['-o', objfile])
+        # have gcc list the headers used rather than tracing it
+        depfile = replace_ext(objfile, 'd')
+        compile.extend(['-MD', '-MF', depfile])
         self.objfiles.append(objfile)
-        fabricate.run([compile])
+        fabricate.run([compile], depfile=depfile, group=self.group('compile'), after=self.group('mkdirs'))
+
+    def objgroups(self):
+        # groups to wait on before the object files can be used
+        return [self.group('mkdirs'), self.group('compile')]
 
 
 class CcLibraryRule(CcRule):
@@ -73,19 +89,21 @@ class CcLibraryRule(CcRule):
             libfile = os.path.join(self.outdir, self.name + '.a')
             archive = [self.ar, 'rc', os.path.join(self.outdir, self.name + '.a')]
             archive.extend(self.objfiles)
-            fabricate.run([archive])
+            fabricate.run([archive], group=self.group('output'), after=self.objgroups())
             self.add_output([libfile])
         else:
             libfile = os.path.join(self.outdir, 'lib' + self.name + '.so')
             sharedlib = [self.cc, '-shared', '-o', libfile]
             sharedlib.extend(self.objfiles)
-            fabricate.run([sharedlib])
+            fabricate.run([sharedlib], group=self.group('output'), after=self.objgroups())
             self.add_output(libfile)
+        self.add_output_groups([self.group('output')])
 
         for deps in self.deprules.values():
             for dep in deps:
                 if isinstance(dep, CcLibraryRule):
                     self.add_outputs(dep.outputs)
+                    self.add_output_groups(dep.output_groups)
                 else:
                     raise ValueError("Unsupported dependency type %s" % (type(dep)))
 
@@ -110,10 +128,12 @@ class CcBinaryRule(CcRule):
         link.extend(ldflags)
         link.extend(['-o', target])
         link.extend(self.objfiles)
+        after = self.objgroups()
         for deps_key in self.deprules.keys():
             deps = self.deprules[deps_key]
             for dep in deps:
                 if isinstance(dep, CcLibraryRule):
+                    after.extend(dep.output_groups)
                     if dep.static == True:
                         link.extend(dep.outputs)
                     else:
@@ -125,6 +145,6 @@ class CcBinaryRule(CcRule):
                         link.extend(['-l' + dep.name])
                 else:
                     raise ValueError("Unsupported link dependency ('%s') of type %s" % (deps_key, type(dep).__name__))
-        fabricate.run([link])
+        fabricate.run([link], group=self.group('link'), after=after)
 
 
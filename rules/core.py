@@ -7,6 +7,7 @@ class BuildRule(object):
         self.name = name
         self.deps = deps
         self.outputs = []
+        self.output_groups = []
         self.executed = False
 
     def init(self):
@@ -14,9 +15,14 @@ class BuildRule(object):
         self.outroot = os.path.relpath(self.module.root + '/out')
         self.outdir = os.path.normpath(os.path.join(self.outroot + self.module.path, self.name))
 
+    def group(self, stage):
+        # Commands of one stage of this rule share a fabricate group so that
+        # later stages (and dependent rules) can wait on them with 'after'
+        return '%s:%s:%s' % (self.module.path, self.name, stage)
+
     def mkdirs(self, path):
         # Uses a shell conditional so fabricate can see the target dir as an input
-        fabricate.run([['/bin/sh', '-c', '[ -d ' + path + ' ] || mkdir -p ' + path]], echo="mkdir -p %s" % (path))
+        fabricate.run([['/bin/sh', '-c', '[ -d ' + path + ' ] || mkdir -p ' + path]], echo="mkdir -p %s" % (path), group=self.group('mkdirs'))
 
     def add_output(self, output):
         self.outputs.append(output)
@@ -24,6 +30,9 @@ class BuildRule(object):
     def add_outputs(self, outputs=[]):
         self.outputs.extend(outputs)
 
+    def add_output_groups(self, groups=[]):
+        self.output_groups.extend(groups)
+
     def execute(self):
         if not self.executed:
             self.executed = True
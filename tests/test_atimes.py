@@ -0,0 +1,91 @@
+import os
+import time
+import unittest
+
+from util import TempDirTestCase
+import fabricate
+
+class ScanDirTests(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.write('a/x.c', '')
+        os.symlink('..', 'a/up')
+        os.symlink('x.c', 'a/y.c')
+        self.runner = fabricate.AtimesRunner.__new__(fabricate.AtimesRunner)
+        self.runner._builder = fabricate.Builder(runner='always_runner')
+        self.scandir = fabricate.scandir
+
+    def tearDown(self):
+        fabricate.scandir = self.scandir
+        TempDirTestCase.tearDown(self)
+
+    def check_scan_dir(self):
+        files, dirs = self.runner._scan_dir('a', file_times=False)
+        self.assertEqual(sorted(files), ['a/x.c', 'a/y.c'])
+        self.assertEqual(dirs, ['a/up'])
+        files, dirs = self.runner._scan_dir('a', file_times=False,
+                                            follow_links=False)
+        self.assertEqual(sorted(files), ['a/x.c', 'a/y.c'])
+        self.assertEqual(dirs, [])
+
+    def test_scan_dir(self):
+        self.check_scan_dir()
+
+    def test_scan_dir_without_scandir(self):
+        fabricate.scandir = None
+        self.check_scan_dir()
+
+class InotifyTests(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        try:
+            fabricate.Inotify().close()
+        except OSError:
+            self.skipTest('inotify is not available')
+        self.write('in.txt', 'input')
+        # read long after it was written, so the atime fallback sees it
+        before = time.time() - 100
+        os.utime('in.txt', (before, before))
+        self.builder = fabricate.Builder(runner='atimes_runner')
+        self.runner = self.builder.runner.actual_runner()
+        self.assertTrue(self.runner._watch())
+
+    def run_command(self, command):
+        deps, outputs = self.runner('sh', '-c', command)
+        return sorted(deps), sorted(outputs)
+
+    def test_deps_and_outputs(self):
+        self.assertEqual(self.run_command('cat in.txt > out.txt'),
+                         (['in.txt'], ['out.txt']))
+        # the output is now a dependency of a command reading it
+        self.assertEqual(self.run_command('cat out.txt > out2.txt'),
+                         (['out.txt'], ['out2.txt']))
+
+    def test_new_directory_watched(self):
+        self.assertEqual(self.run_command('mkdir sub && cat in.txt > sub/a'),
+                         (['in.txt'], ['sub/a']))
+        self.assertEqual(self.run_command('cat sub/a > sub/b'),
+                         (['sub/a'], ['sub/b']))
+
+    def test_overflow_walks_tree(self):
+        inotify = self.runner._inotify
+        read_events = inotify.read_events
+        calls = []
+        def overflowing_read_events():
+            # lose the command's events, which are read on the second call
+            calls.append(None)
+            events = read_events()
+            if len(calls) == 2:
+                events = [(-1, fabricate.Inotify.IN_Q_OVERFLOW, '')]
+            return events
+        inotify.read_events = overflowing_read_events
+        self.assertEqual(self.run_command('cat in.txt > out.txt'),
+                         (['in.txt'], ['out.txt']))
+        self.assertEqual(len(calls), 2)
+        # watching goes on as before once the tree has been walked
+        inotify.read_events = read_events
+        self.assertEqual(self.run_command('cat out.txt > out2.txt'),
+                         (['out.txt'], ['out2.txt']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import unittest
+
+from util import TempDirTestCase
+import fabricate
+
+class CopyRunner(fabricate.Runner):
+    """ Runs "cp source dest" commands itself, giving source as the
+        dependency and dest as the output, and counts the commands run. """
+    def __init__(self, builder):
+        self.runs = 0
+
+    def __call__(self, *args, **kwargs):
+        self.runs += 1
+        source, dest = args[-2:]
+        shutil.copy(source, dest)
+        return [source], [dest]
+
+class BuildCacheTests(TempDirTestCase):
+    def builder(self, depsname):
+        return fabricate.Builder(runner=CopyRunner, depsname=depsname,
+                                 cache='cache', quiet=True)
+
+    def cached_files(self):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join('cache', 'cas')):
+            files.extend(os.path.join(dirpath, name) for name in filenames)
+        return files
+
+    def test_round_trip(self):
+        self.write('a', 'contents of a')
+        builder = self.builder('.deps1')
+        builder.run('cp', 'a', 'b')
+        self.assertEqual(builder.runner.runs, 1)
+        os.remove('b')
+        # another checkout, which hasn't run the command
+        builder = self.builder('.deps2')
+        builder.run('cp', 'a', 'b')
+        self.assertEqual(builder.runner.runs, 0)
+        self.assertEqual(self.read('b'), 'contents of a')
+        self.assertTrue('b' in builder.deps['cp a b'])
+
+    def test_changed_input_runs(self):
+        self.write('a', 'contents of a')
+        self.builder('.deps1').run('cp', 'a', 'b')
+        self.write('a', 'new contents of a')
+        builder = self.builder('.deps2')
+        builder.run('cp', 'a', 'b')
+        self.assertEqual(builder.runner.runs, 1)
+        self.assertEqual(self.read('b'), 'new contents of a')
+
+    def test_poisoned_contents_not_restored(self):
+        self.write('a', 'contents of a')
+        self.builder('.deps1').run('cp', 'a', 'b')
+        os.remove('b')
+        [cached] = self.cached_files()
+        os.chmod(cached, 0644)
+        self.write(cached, 'poison')
+        builder = self.builder('.deps2')
+        builder.run('cp', 'a', 'b')
+        self.assertEqual(builder.runner.runs, 1)
+        self.assertEqual(self.read('b'), 'contents of a')
+
+    def test_poisoned_contents_replaced(self):
+        self.write('a', 'contents of a')
+        self.builder('.deps1').run('cp', 'a', 'b')
+        [cached] = self.cached_files()
+        os.chmod(cached, 0644)
+        self.write(cached, 'poison')
+        # the same output made again is stored again
+        self.builder('.deps2').run('cp', 'a', 'b')
+        self.assertEqual(self.read(cached), 'contents of a')
+
+    def test_restored_outputs_are_copies(self):
+        self.write('a', 'contents of a')
+        self.builder('.deps1').run('cp', 'a', 'b')
+        os.remove('b')
+        self.builder('.deps2').run('cp', 'a', 'b')
+        self.write('b', 'written in place')
+        [cached] = self.cached_files()
+        self.assertEqual(self.read(cached), 'contents of a')
+
+    def test_bad_output_names_not_restored(self):
+        os.mkdir('build')
+        os.chdir('build')
+        self.write('a', 'contents of a')
+        builder = self.builder('.deps1')
+        builder.run('cp', 'a', 'b')
+        key = builder._cache_key('cp a b')
+        [entry] = json.loads(builder.cache.get(key))
+        [[name, hashed, mode]] = entry['outputs']
+        for name in ['../escaped', 'sub/../../escaped',
+                     os.path.join(self.dir, 'escaped'), '.deps2', '.hidden/b']:
+            entry['outputs'] = [[name, hashed, mode]]
+            builder.cache.put(key, json.dumps([entry]))
+            builder = self.builder('.deps2')
+            builder.run('cp', 'a', 'b')
+            self.assertEqual(builder.runner.runs, 1, name)
+            self.assertFalse(os.path.exists(os.path.join(self.dir, 'escaped')))
+            self.assertFalse(os.path.exists('.hidden'))
+
+    def test_key_covers_program(self):
+        self.write('tool', '#!/bin/sh\n')
+        os.chmod('tool', 0755)
+        key = self.builder('.deps1')._cache_key('./tool x')
+        self.assertEqual(self.builder('.deps1')._cache_key('./tool x'), key)
+        self.write('tool', '#!/bin/sh\necho\n')
+        self.assertNotEqual(self.builder('.deps1')._cache_key('./tool x'), key)
+
+class HttpBuildCacheTests(unittest.TestCase):
+    def test_bad_status_is_environment_error(self):
+        import httplib
+        cache = fabricate.HttpBuildCache('http://localhost:1')
+        class urllib2(object):
+            HTTPError = cache._urllib2.HTTPError
+            @staticmethod
+            def urlopen(*args, **kwargs):
+                raise httplib.BadStatusLine('')
+            Request = cache._urllib2.Request
+        cache._urllib2 = urllib2
+        self.assertRaises(EnvironmentError, cache.get, 'ac/x')
+        self.assertRaises(EnvironmentError, cache.put, 'ac/x', 'data')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import json
+import unittest
+
+from util import TempDirTestCase
+import fabricate
+
+class DepsStoreTests(object):
+    """ Tests every DepsStore subclass must pass, mixed in with store set. """
+    store = None
+
+    def test_round_trip(self):
+        deps = self.store('.deps', 'md5_hasher')
+        deps['cc -c a.c'] = {'a.c': 'input-1', 'a.o': 'output-2'}
+        deps['cc -c b.c'] = {'b.c': 'input-3', 'b.o': 'output-4'}
+        deps.set_stat('a.c', '1 2 3', '1')
+        deps.save()
+        deps.close()
+        deps = self.store('.deps', 'md5_hasher')
+        self.assertEqual(deps.get('cc -c a.c'),
+                         {'a.c': 'input-1', 'a.o': 'output-2'})
+        self.assertEqual(deps['cc -c b.c'],
+                         {'b.c': 'input-3', 'b.o': 'output-4'})
+        self.assertEqual(deps.get('cc -c c.c'), None)
+        self.assertEqual(tuple(deps.get_stat('a.c')), ('1 2 3', '1'))
+        self.assertEqual(sorted(deps.names()), ['a.c', 'a.o', 'b.c', 'b.o'])
+        deps.close()
+
+    def test_other_hasher_starts_again(self):
+        deps = self.store('.deps', 'md5_hasher')
+        deps['true'] = {'a': 'input-1'}
+        deps.save()
+        deps.close()
+        deps = self.store('.deps', 'mtime_hasher')
+        self.assertEqual(deps.get('true'), None)
+        deps.close()
+
+    def test_reads_version_2(self):
+        self.write('.deps', json.dumps({
+            '.deps_version': 2,
+            'cc -c a.c': {'a.c': 'input-1', 'a.o': 'output-2'},
+        }))
+        deps = self.store('.deps', 'md5_hasher')
+        self.assertEqual(deps.get('cc -c a.c'),
+                         {'a.c': 'input-1', 'a.o': 'output-2'})
+        deps.close()
+
+class JsonDepsTests(DepsStoreTests, TempDirTestCase):
+    store = fabricate.JsonDeps
+
+    def test_bad_version_starts_again(self):
+        self.write('.deps', json.dumps({'.deps_version': 99}))
+        deps = self.store('.deps', 'md5_hasher')
+        self.assertEqual(deps.items(), [])
+
+@unittest.skipIf(fabricate.sqlite3 is None, 'needs the sqlite3 module')
+class SqliteDepsTests(DepsStoreTests, TempDirTestCase):
+    store = fabricate.SqliteDeps
+
+    def test_converts_json(self):
+        deps = fabricate.JsonDeps('.deps', 'md5_hasher')
+        deps['cc -c a.c'] = {'a.c': 'input-1', 'a.o': 'output-2'}
+        deps.save()
+        deps = self.store('.deps', 'md5_hasher')
+        self.assertEqual(deps.get('cc -c a.c'),
+                         {'a.c': 'input-1', 'a.o': 'output-2'})
+        deps.close()
+
+class BuilderDefaultsTests(TempDirTestCase):
+    def test_default_is_json(self):
+        builder = fabricate.Builder(runner='always_runner')
+        self.assertTrue(builder.deps_store is fabricate.JsonDeps)
+        builder.done('true', ['a'], [])
+        builder.write_deps()
+        self.assertEqual(json.loads(self.read('.deps'))['.deps_version'],
+                         fabricate.deps_version)
+
+    def test_shared_hash_cache_is_opt_in(self):
+        builder = fabricate.Builder(runner='always_runner')
+        self.assertEqual(builder.shared_hashes, None)
+        builder = fabricate.Builder(runner='always_runner',
+                                    shared_hash_cache='hashes.db')
+        if fabricate.sqlite3 is not None:
+            self.assertEqual(builder.shared_hashes.filename, 'hashes.db')
+
+    def test_shared_hash_cache_options(self):
+        for args, value in (([], None), (['--shared-hash-cache'], True),
+                            (['--no-shared-hash-cache'], False)):
+            parser, options, actions = fabricate.parse_options(command_line=args)
+            self.assertEqual(options.shared_hash_cache, value)
+
+    def test_prehash_fills_hash_cache(self):
+        for name in 'abc':
+            self.write(name, name)
+        builder = fabricate.Builder(runner='always_runner')
+        builder.deps['cc a'] = {'a': 'input-1', 'b': 'output-2'}
+        builder.deps['cc c'] = {'c': 'input-3', 'gone': 'input-4'}
+        builder.hash_cache['a'] = 'already hashed'
+        builder.prehash(2)
+        self.assertEqual(builder.hash_cache['a'], 'already hashed')
+        self.assertEqual(builder.hash_cache['b'], fabricate.md5_hasher('b'))
+        self.assertEqual(builder.hash_cache['c'], fabricate.md5_hasher('c'))
+        self.assertEqual(builder.hash_cache.get('gone'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import hashlib
+import unittest
+
+from util import TempDirTestCase
+import modular
+
+MODULE = "cc_library(name='liba', sources=['a.c'], static=True)\n"
+
+class ModuleCacheTests(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.write('MODULAR', '')
+        self.write('liba/MODULE', MODULE)
+
+    def parse(self):
+        cache = modular.ModuleCache(self.dir)
+        module = modular.Module('/liba', self.dir)
+        module.parse(cache)
+        cache.save()
+        return module
+
+    def test_hit(self):
+        self.parse()
+        cache = modular.ModuleCache(self.dir)
+        digest = hashlib.md5(MODULE).hexdigest()
+        [(function, name, args, kwargs)] = cache.get('/liba', digest)
+        self.assertEqual((function, name), ('cc_library', 'liba'))
+        # the cached calls are made rather than the file executed
+        cache.put('/liba', digest, [('cc_library', 'cached', (),
+                                     {'sources': ['a.c']})])
+        cache.save()
+        module = self.parse()
+        self.assertEqual(module.rules.keys(), ['cached'])
+
+    def test_miss_when_contents_change(self):
+        self.parse()
+        self.write('liba/MODULE', MODULE.replace("'liba'", "'libb'"))
+        module = self.parse()
+        self.assertEqual(module.rules.keys(), ['libb'])
+        cache = modular.ModuleCache(self.dir)
+        self.assertEqual(cache.get('/liba', hashlib.md5(MODULE).hexdigest()),
+                         None)
+
+    def test_invalid_when_rule_classes_change(self):
+        self.parse()
+        self.assertNotEqual(modular.ModuleCache(self.dir).modules, {})
+        modular.RULE_CLASSES['test_rule'] = 'cc.CcLibraryRule'
+        try:
+            self.assertEqual(modular.ModuleCache(self.dir).modules, {})
+        finally:
+            del modular.RULE_CLASSES['test_rule']
+        self.assertNotEqual(modular.ModuleCache(self.dir).modules, {})
+
+    def test_unmarshallable_module_executed(self):
+        self.write('liba/MODULE', MODULE.replace(
+            "static=True", "static=True, cflags=[object()]"))
+        self.assertEqual(self.parse().rules.keys(), ['liba'])
+        self.assertEqual(modular.ModuleCache(self.dir).modules, {})
+        self.assertEqual(self.parse().rules.keys(), ['liba'])
+
+if __name__ == '__main__':
+    unittest.main()
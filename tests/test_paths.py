@@ -0,0 +1,35 @@
+import os
+import unittest
+
+from util import TempDirTestCase
+import fabricate
+
+class RelevanceTests(TempDirTestCase):
+    def test_dirs_follow_current_directory(self):
+        os.mkdir('sub')
+        builder = fabricate.Builder(runner='always_runner', dirs=['sub'])
+        name = os.path.join(os.getcwd(), 'sub', 'x')
+        self.assertTrue(builder._is_relevant(name))
+        os.chdir('sub')
+        # dirs are now sub/sub
+        self.assertFalse(builder._is_relevant(name))
+
+    def test_path_memo_emptied_when_dirs_change(self):
+        builder = fabricate.Builder(runner='always_runner')
+        runner = fabricate.Runner()
+        runner._builder = builder
+        runner._check_paths_memo()
+        runner._paths['x'] = ('x', True)
+        runner._check_paths_memo()
+        self.assertEqual(runner._paths, {'x': ('x', True)})
+        builder.dirs.append('sub')
+        runner._check_paths_memo()
+        self.assertEqual(runner._paths, {})
+        runner._paths['x'] = ('x', True)
+        os.mkdir('sub')
+        os.chdir('sub')
+        runner._check_paths_memo()
+        self.assertEqual(runner._paths, {})
+
+if __name__ == '__main__':
+    unittest.main()
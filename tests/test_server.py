@@ -0,0 +1,106 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from util import TempDirTestCase, root
+import fabricate
+
+MODULAR = os.path.join(root, 'modular.py')
+
+# compiles by copying the source, and leaves a process running as some
+# compilers' helpers do. It notes the parent of the build running it.
+FAKE_GCC = '''#!/bin/sh
+out= dep= src=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) out=$2; shift;;
+        -MF) dep=$2; shift;;
+        *.c) src=$1;;
+    esac
+    shift
+done
+cp "$src" "$out"
+[ -n "$dep" ] && echo "$out: $src" > "$dep"
+cut -d' ' -f4 /proc/$PPID/stat > build.ppid
+(sleep 5 >/dev/null 2>&1 </dev/null &)
+exit 0
+'''
+
+FAKE_AR = '''#!/bin/sh
+shift; out=$1; shift; cat "$@" > "$out"
+'''
+
+class BuildServerTests(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        try:
+            fabricate.Inotify().close()
+        except OSError:
+            self.skipTest('inotify is not available')
+        self.write('MODULAR', '')
+        self.write('liba/MODULE',
+                   "cc_library(name='liba', sources=['a.c'], static=True, abi='x')\n")
+        self.write('liba/a.c', 'int a;\n')
+        self.write('bin/x-gcc', FAKE_GCC)
+        self.write('bin/x-ar', FAKE_AR)
+        # written well before the builds, so they can save snapshots
+        before = time.time() - 100
+        for dirpath, dirnames, filenames in os.walk('.'):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if dirpath == './bin':
+                    os.chmod(path, 0755)
+                os.utime(path, (before, before))
+        self.env = dict(os.environ)
+        self.env['PATH'] = os.path.join(self.dir, 'bin') + os.pathsep + self.env['PATH']
+        # started by a name relative to the build root, which its sources'
+        # names are then relative to as well
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.relpath(MODULAR), '--server'],
+            stdout=open(os.devnull, 'w'), env=self.env)
+        for i in range(100):
+            if os.path.exists(os.path.join('out', '.server')):
+                break
+            time.sleep(0.05)
+        else:
+            self.fail('the build server did not start')
+
+    def tearDown(self):
+        if getattr(self, 'server', None) is not None:
+            self.server.terminate()
+            self.server.wait()
+        TempDirTestCase.tearDown(self)
+
+    def build(self, cwd='.'):
+        """ Run modular.py /liba in cwd, returning its status and time. """
+        start = time.time()
+        status = subprocess.call([sys.executable, MODULAR, '/liba'], cwd=cwd,
+                                 stdout=open(os.devnull, 'w'), env=self.env)
+        return status, time.time() - start
+
+    def test_build_from_subdirectory(self):
+        status, seconds = self.build(cwd='liba')
+        self.assertEqual(status, 0)
+        self.assertEqual(self.read('out/liba/liba/liba.a'), 'int a;\n')
+        # done by a child of the server, not by the client
+        self.assertEqual(int(self.read('build.ppid')), self.server.pid)
+        # the compiler's process left running didn't hold up the reply
+        self.assertTrue(seconds < 4, seconds)
+        # and the snapshot was saved, as the server's sources were found
+        self.assertTrue(os.path.exists(os.path.join('out', '.snapshot')))
+
+    def test_idle_client_dropped(self):
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(os.path.join('out', '.server'))
+        try:
+            status, seconds = self.build()
+        finally:
+            idle.close()
+        self.assertEqual(status, 0)
+        self.assertEqual(int(self.read('build.ppid')), self.server.pid)
+
+if __name__ == '__main__':
+    unittest.main()
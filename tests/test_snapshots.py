@@ -0,0 +1,59 @@
+import os
+import time
+import unittest
+
+from util import TempDirTestCase
+import modular
+
+class FakeBuilder(object):
+    """ What save_snapshot() uses of a fabricate Builder. """
+    def __init__(self, deps):
+        self.deps = deps
+        self.commands = deps.keys()
+
+class SnapshotTests(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        os.mkdir('out')
+        self.write('a.c', 'int a;')
+        self.write('a.o', 'object')
+        # sources last modified well before the build
+        before = time.time() - 100
+        os.utime('a.c', (before, before))
+        self.builder = FakeBuilder({'cc -c a.c': {'a.c': 'input-1',
+                                                  'a.o': 'output-2'}})
+
+    def test_up_to_date_until_a_file_changes(self):
+        modular.save_snapshot('key', {}, self.builder, [], time.time() - 10)
+        self.assertTrue(modular.snapshot_up_to_date('key'))
+        self.assertFalse(modular.snapshot_up_to_date('other key'))
+        self.write('a.c', 'int a = 1;')
+        self.assertFalse(modular.snapshot_up_to_date('key'))
+
+    def test_output_changed(self):
+        modular.save_snapshot('key', {}, self.builder, [], time.time() - 10)
+        os.remove('a.o')
+        self.assertFalse(modular.snapshot_up_to_date('key'))
+
+    def test_not_saved_if_source_changed_during_build(self):
+        modular.save_snapshot('key', {}, self.builder, [], time.time() - 10)
+        started = time.time()
+        self.write('a.c', 'int a = 1;')
+        modular.save_snapshot('key 2', {}, self.builder, [], started)
+        self.assertFalse(modular.snapshot_up_to_date('key 2'))
+        # the earlier snapshot is still there, but out of date
+        self.assertFalse(modular.snapshot_up_to_date('key'))
+
+    def test_not_saved_if_source_changed_just_before_build(self):
+        started = time.time()
+        os.utime('a.c', (started - 1, started - 1))
+        modular.save_snapshot('key', {}, self.builder, [], started)
+        self.assertFalse(modular.snapshot_up_to_date('key'))
+
+    def test_not_saved_without_results(self):
+        self.builder.commands.append('cc -c b.c')
+        modular.save_snapshot('key', {}, self.builder, [], time.time() - 10)
+        self.assertFalse(modular.snapshot_up_to_date('key'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import unittest
+
+from util import TempDirTestCase
+import fabricate
+
+class StraceLogTests(TempDirTestCase):
+    """ Parse strace logs without running strace, which needn't be here. """
+    def parse(self, log):
+        runner = fabricate.StraceRunner.__new__(fabricate.StraceRunner)
+        runner._builder = fabricate.Builder(runner='always_runner')
+        runner.build_dir = os.getcwd()
+        runner._paths = {}
+        runner._root_pid = None
+        runner.status = 0
+        processes = {}
+        unfinished = {}
+        for line in log.splitlines(True):
+            runner._match_line(line, processes, unfinished)
+        return runner.status, processes
+
+    def test_status_is_root_process_exit_group(self):
+        status, processes = self.parse(
+            '10 execve("/bin/sh", ["sh", "-c", "x"], 0x0 /* 1 var */) = 0\n'
+            '10 clone(child_stack=NULL, flags=SIGCHLD) = 11\n'
+            '11 exit_group(3)                   = ?\n'
+            '10 exit_group(0)                   = ?\n'
+            '12 exit_group(4)                   = ?\n')
+        self.assertEqual(status, 0)
+
+    def test_dependencies_of_children(self):
+        self.write('a.h', '')
+        status, processes = self.parse(
+            '10 execve("/bin/sh", ["sh", "-c", "x"], 0x0 /* 1 var */) = 0\n'
+            '10 clone(child_stack=NULL, flags=SIGCHLD) = 11\n'
+            '11 openat(AT_FDCWD, "a.h", O_RDONLY) = 3\n'
+            '11 openat(AT_FDCWD, "a.o", O_WRONLY|O_CREAT, 0666) = 4\n'
+            '11 exit_group(0)                   = ?\n'
+            '10 exit_group(2)                   = ?\n')
+        self.assertEqual(status, 2)
+        self.assertEqual(processes['11'].deps, set(['a.h']))
+        self.assertEqual(processes['11'].outputs, set(['a.o']))
+
+if __name__ == '__main__':
+    unittest.main()
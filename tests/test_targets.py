@@ -0,0 +1,59 @@
+import os
+import unittest
+
+from util import TempDirTestCase
+import modular
+
+class TargetGraphTests(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.write('MODULAR', '')
+
+    def module(self, path, text):
+        self.write(os.path.join(path, 'MODULE'), text)
+
+    def graph(self):
+        return modular.TargetGraph(self.dir)
+
+    def test_cycle_reported(self):
+        self.module('app', "cc_binary(name='app', sources=['main.c'], deps=['/libb'])\n")
+        self.module('libb', "cc_library(name='libb', sources=['b.c'], deps=['/liba'])\n")
+        self.module('liba', "cc_library(name='liba', sources=['a.c'], deps=['/app'])\n")
+        with self.assertRaises(ValueError) as raised:
+            self.graph().resolve('/app')
+        self.assertEqual(str(raised.exception), 'circular dependency: '
+                         '/app:app -> /libb:libb -> /liba:liba -> /app:app')
+
+    def test_cycle_below_target_reported(self):
+        self.module('app', "cc_binary(name='app', sources=['main.c'], deps=['/liba'])\n")
+        self.module('liba', "cc_library(name='liba', sources=['a.c'], deps=[':liba'])\n")
+        with self.assertRaises(ValueError) as raised:
+            self.graph().resolve('/app')
+        self.assertEqual(str(raised.exception),
+                         'circular dependency: /liba:liba -> /liba:liba')
+
+    def test_shared_dependency_resolved_once(self):
+        self.module('app', "cc_binary(name='app', sources=['main.c'], deps=['/libb', '/libc'])\n")
+        self.module('libb', "cc_library(name='libb', sources=['b.c'], deps=['/liba'])\n")
+        self.module('libc', "cc_library(name='libc', sources=['c.c'], deps=['/liba'])\n")
+        self.module('liba', "cc_library(name='liba', sources=['a.c'])\n")
+        graph = self.graph()
+        [app] = graph.resolve('/app')
+        self.assertIs(app.deprules['/libb'][0].deprules['/liba'][0],
+                      app.deprules['/libc'][0].deprules['/liba'][0])
+        edges = dict((name, sorted(deps)) for name, deps in graph.edges().items())
+        self.assertEqual(edges, {
+            '/app:app': ['/libb:libb', '/libc:libc'],
+            '/libb:libb': ['/liba:liba'],
+            '/libc:libc': ['/liba:liba'],
+            '/liba:liba': [],
+        })
+
+    def test_missing_module(self):
+        self.module('app', "cc_binary(name='app', sources=['main.c'], deps=['/nothere'])\n")
+        with self.assertRaises(ValueError) as raised:
+            self.graph().resolve('/app')
+        self.assertEqual(str(raised.exception), 'module /nothere does not exist')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.dont_write_bytecode = True
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+    sys.path.insert(0, root)
+
+class TempDirTestCase(unittest.TestCase):
+    """ Test case run in a temporary directory of its own, which is removed
+        afterwards, with fabricate's cache directory in it too. Exit
+        functions registered by the test, such as Builder writing its
+        dependency file, are dropped as the directory is gone by then. """
+    def setUp(self):
+        self.exit_handlers = len(atexit._exithandlers)
+        self.old_cwd = os.getcwd()
+        self.old_cache_dir = os.environ.get('FABRICATE_CACHE_DIR')
+        self.dir = tempfile.mkdtemp()
+        os.environ['FABRICATE_CACHE_DIR'] = os.path.join(self.dir, '.cache')
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        del atexit._exithandlers[self.exit_handlers:]
+        os.chdir(self.old_cwd)
+        if self.old_cache_dir is None:
+            del os.environ['FABRICATE_CACHE_DIR']
+        else:
+            os.environ['FABRICATE_CACHE_DIR'] = self.old_cache_dir
+        shutil.rmtree(self.dir)
+
+    def write(self, filename, text):
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(filename, 'w') as f:
+            f.write(text)
+
+    def read(self, filename):
+        with open(filename) as f:
+            return f.read()